@@ -0,0 +1,219 @@
+import contextlib
+import os
+from a2wsgi import WSGIMiddleware
+from flask import Flask, request as flask_request
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+from cloud_run_main import hello_http, ndjson_line, parse_process_videos_params, parse_search_params
+from genai_async_helper import AsyncVideoAiProcessor
+from resilience_helper import deadline
+
+# ASGI 入口，与 cloud_run_main.hello_http 并存：
+# - 语义搜索和视频处理使用 AsyncVideoAiProcessor，等待 Gemini / Supabase 期间不占用 worker
+# - 其它路由转发给 hello_http 同步处理
+# 启动方式: uvicorn asgi_main:app --host 0.0.0.0 --port 8000
+
+
+async def handle_semantic_search(request):
+    """
+    处理语义搜索请求，参数与 cloud_run_main.handle_semantic_search 一致。
+
+    参数:
+        query_str (str): 搜索查询字符串 (必需)
+        match_threshold (float): 匹配阈值 (可选，默认 0.7)
+        match_count (int): 返回结果数量 (可选，默认 10)
+        ef_search (int): HNSW 检索的候选集大小 (可选)
+        probes (int): IVFFlat 检索的聚类数量 (可选)
+        filters (str): 素材过滤条件的 JSON (可选)
+        group_by (str): shot 或 material (可选，默认 shot)，material 时支持 aggregate_mode、top_n、shots_per_material
+        page_size / cursor (可选): 分页返回，响应中的 next_cursor 用于获取下一页
+        stream / max_results (可选): 以 NDJSON 流式返回
+        mode (str): vector 或 hybrid (可选，默认 vector)，hybrid 时支持 candidate_count、rrf_k
+    """
+    params, error = parse_search_params(request.query_params)
+    if error:
+        return JSONResponse(error, 400)
+
+    try:
+        processor = request.app.state.processor
+        search_params = dict(params)
+        group_by = search_params.pop('group_by')
+        mode = search_params.pop('mode')
+        if search_params.pop('stream', False):
+            pages = processor.iter_semantic_search_pages(**search_params)
+            first_page = await pages.__anext__()
+            return StreamingResponse(stream_search_pages(first_page, pages), media_type='application/x-ndjson')
+
+        if 'page_size' in search_params:
+            page = await processor.semantic_search_page(**search_params)
+            return JSONResponse({
+                'status': 'success',
+                'results': page['results'],
+                'count': len(page['results']),
+                'next_cursor': page['next_cursor'],
+                'query': params
+            }, 200)
+
+        if group_by == 'material':
+            results = await processor.semantic_search_materials(**search_params)
+        elif mode == 'hybrid':
+            results = await processor.semantic_search_hybrid(**search_params)
+        else:
+            results = await processor.semantic_search(**search_params)
+
+        return JSONResponse({
+            'status': 'success',
+            'results': results,
+            'count': len(results),
+            'query': params
+        }, 200)
+
+    except ValueError as e:
+        return JSONResponse({'error': 'Invalid parameter', 'message': str(e)}, 400)
+
+    except Exception as e:
+        return JSONResponse({'error': 'Server error', 'message': str(e)}, 500)
+
+
+async def stream_search_pages(first_page, pages):
+    """逐行输出分页搜索结果，格式与 cloud_run_main.stream_search_pages 一致"""
+    count = 0
+    next_cursor = None
+    page = first_page
+    try:
+        while page is not None:
+            for row in page['results']:
+                yield ndjson_line({'type': 'result', 'data': row})
+            count += len(page['results'])
+            next_cursor = page['next_cursor']
+            page = await anext(pages, None)
+        yield ndjson_line({'type': 'end', 'count': count, 'next_cursor': next_cursor})
+    except Exception as e:
+        yield ndjson_line({'type': 'error', 'count': count, 'next_cursor': next_cursor, 'message': str(e)})
+
+
+async def handle_process_video(request):
+    """
+    处理视频处理请求，参数与 cloud_run_main.handle_process_video 一致。
+
+    参数 (JSON):
+        material_id (int): 素材 ID (必需)
+        video_path (str): 视频文件路径 (必需)
+        force (bool): 为 true 时即使视频没有变化也重新分析 (可选，默认 false)
+    """
+    try:
+        request_json = await request.json()
+    except ValueError:
+        request_json = None
+
+    if not request_json:
+        return JSONResponse({'error': 'Invalid payload', 'message': 'JSON required'}, 400)
+
+    material_id = request_json.get('material_id')
+    video_path = request_json.get('video_path')
+    force = request_json.get('force', False)
+
+    if material_id is None:
+        return JSONResponse({'error': 'Missing parameter', 'message': 'material_id is required'}, 400)
+
+    if not isinstance(material_id, int):
+        return JSONResponse({'error': 'Invalid parameter',
+                             'message': 'material_id must be an integer'}, 400)
+
+    if not video_path:
+        return JSONResponse({'error': 'Missing parameter', 'message': 'video_path is required'}, 400)
+
+    if not isinstance(force, bool):
+        return JSONResponse({'error': 'Invalid parameter', 'message': 'force must be a boolean'}, 400)
+
+    try:
+        # 与 hello_http 一样按 REQUEST_DEADLINE_SECONDS 设置截止时间
+        with deadline(float(os.getenv('REQUEST_DEADLINE_SECONDS', 0))):
+            processed_shots = await request.app.state.processor.run(
+                material_id=material_id,
+                video_path=video_path,
+                force=force
+            )
+
+        return JSONResponse({
+            'status': 'success',
+            'message': f'Processed and saved {processed_shots} shots',
+            'material_id': material_id,
+            'video_path': video_path,
+            'processed_shots': processed_shots
+        }, 200)
+
+    except Exception as e:
+        return JSONResponse({'error': 'Server error', 'message': str(e)}, 500)
+
+
+async def handle_process_videos(request):
+    """
+    处理批量视频处理请求，参数与 cloud_run_main.handle_process_videos 一致。
+
+    参数 (JSON):
+        materials (list): 素材列表，每项为 {"material_id": int, "video_path": str, "force": bool (可选)} (必需)
+        force (bool): 未单独指定 force 的素材是否强制重新分析 (可选，默认 false)
+        max_workers (int): 同时处理的素材数 (可选，默认使用环境变量 PROCESS_VIDEOS_MAX_WORKERS 或 4，最大 16)
+    素材数上限和重复素材的处理见 cloud_run_main.parse_process_videos_params
+    """
+    try:
+        request_json = await request.json()
+    except ValueError:
+        request_json = None
+
+    if not request_json:
+        return JSONResponse({'error': 'Invalid payload', 'message': 'JSON required'}, 400)
+
+    params, error = parse_process_videos_params(request_json)
+    if error:
+        return JSONResponse(error, 400)
+
+    try:
+        with deadline(float(os.getenv('REQUEST_DEADLINE_SECONDS', 0))):
+            results = await request.app.state.processor.run_batch(
+                materials=params['materials'],
+                max_concurrency=params['max_workers']
+            )
+        succeeded = sum(1 for result in results if result['status'] == 'success')
+
+        return JSONResponse({
+            'status': 'success',
+            'message': f'Processed {succeeded}/{len(results)} materials',
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'duplicates': params['duplicates'],
+            'results': results
+        }, 200)
+
+    except Exception as e:
+        return JSONResponse({'error': 'Server error', 'message': str(e)}, 500)
+
+
+# 其它路由仍由 hello_http 同步处理
+flask_app = Flask(__name__)
+
+
+@flask_app.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
+@flask_app.route('/<path:path>', methods=['GET', 'POST'])
+def sync_routes(path):
+    return hello_http(flask_request)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # 进程启动时创建一次异步处理器，所有请求共享
+    app.state.processor = await AsyncVideoAiProcessor.create()
+    yield
+
+
+app = Starlette(
+    routes=[
+        Route('/semantic_search', handle_semantic_search, methods=['GET']),
+        Route('/process_video', handle_process_video, methods=['POST']),
+        Route('/process_videos', handle_process_videos, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app)),
+    ],
+    lifespan=lifespan,
+)
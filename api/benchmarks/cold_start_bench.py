@@ -0,0 +1,141 @@
+"""
+冷启动基准测试：在全新的 Python 子进程中测量
+
+1. 各个重量级依赖以及 cloud_run_main 的导入耗时
+2. 各路由从进程启动（导入 cloud_run_main）到返回第一个响应的耗时
+
+每个测量项都在独立子进程中重复执行，避免模块缓存影响结果。
+路由测试会真实调用 Gemini / Supabase / BigQuery 等服务，需要与线上一致的环境变量。
+
+用法:
+    python benchmarks/cold_start_bench.py                       # 默认的导入项和路由
+    python benchmarks/cold_start_bench.py --repeat 5 --json     # 输出 JSON
+    python benchmarks/cold_start_bench.py --routes "GET /stats" "GET /semantic_search?query_str=口红"
+    python benchmarks/cold_start_bench.py --skip-routes         # 只测导入耗时
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MODULES = [
+    "cloud_run_main",
+    "google.genai",
+    "supabase",
+    "google.cloud.bigquery",
+    "google.cloud.tasks_v2",
+]
+
+DEFAULT_ROUTES = [
+    "GET /stats",
+    "GET /semantic_search?query_str=带银色项链的男子&match_threshold=0.5&match_count=5",
+    "GET /report/query_advertisers_by_post?post_id=7271356491472016386",
+]
+
+# 子进程中执行的测量代码
+IMPORT_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+__import__(sys.argv[1])
+print(json.dumps({"seconds": time.perf_counter() - start}))
+"""
+
+ROUTE_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import cloud_run_main
+imported = time.perf_counter()
+from flask import Flask
+method, path = sys.argv[1].split(" ", 1)
+body = json.loads(sys.argv[2]) if sys.argv[2] else None
+with Flask(__name__).test_request_context(path, method=method, json=body):
+    from flask import request
+    response = cloud_run_main.hello_http(request)
+done = time.perf_counter()
+status = response[1] if isinstance(response, tuple) else response.status_code
+print(json.dumps({"import_seconds": imported - start, "first_response_seconds": done - start, "status": status}))
+"""
+
+
+def run_child(code: str, args: list) -> dict:
+    """在全新的 Python 进程中执行测量代码，返回其输出的 JSON"""
+    completed = subprocess.run(
+        [sys.executable, "-c", code] + args,
+        cwd=API_DIR,
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, PYTHONPATH=API_DIR)
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1] if completed.stderr else "child failed")
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def summarize(samples: list) -> dict:
+    """汇总多次测量的结果（毫秒）"""
+    values = [sample * 1000 for sample in samples]
+    return {
+        "min_ms": round(min(values), 1),
+        "median_ms": round(statistics.median(values), 1),
+        "max_ms": round(max(values), 1)
+    }
+
+
+def bench_imports(modules: list, repeat: int) -> dict:
+    results = {}
+    for module in modules:
+        try:
+            results[module] = summarize([run_child(IMPORT_CHILD, [module])["seconds"] for _ in range(repeat)])
+        except Exception as e:
+            results[module] = {"error": str(e)}
+    return results
+
+
+def bench_routes(routes: list, repeat: int, body: str) -> dict:
+    results = {}
+    for route in routes:
+        try:
+            samples = [run_child(ROUTE_CHILD, [route, body]) for _ in range(repeat)]
+            results[route] = {
+                "status": samples[-1]["status"],
+                "import": summarize([sample["import_seconds"] for sample in samples]),
+                "first_response": summarize([sample["first_response_seconds"] for sample in samples])
+            }
+        except Exception as e:
+            results[route] = {"error": str(e)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cloud_run_main 冷启动基准测试")
+    parser.add_argument("--repeat", type=int, default=3, help="每项测量的重复次数")
+    parser.add_argument("--modules", nargs="*", default=DEFAULT_MODULES, help="需要测量导入耗时的模块")
+    parser.add_argument("--routes", nargs="*", default=DEFAULT_ROUTES, help='需要测量的路由，格式为 "METHOD /path?query"')
+    parser.add_argument("--body", default="", help="POST 路由使用的 JSON 请求体")
+    parser.add_argument("--skip-routes", action="store_true", help="只测量导入耗时")
+    parser.add_argument("--json", action="store_true", help="以 JSON 格式输出")
+    args = parser.parse_args()
+
+    report = {"imports": bench_imports(args.modules, args.repeat)}
+    if not args.skip_routes:
+        report["routes"] = bench_routes(args.routes, args.repeat, args.body)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+
+    print(f"导入耗时（{args.repeat} 次，毫秒）")
+    for module, result in report["imports"].items():
+        print(f"  {module:<28} {result}")
+    if "routes" in report:
+        print(f"\n首个响应耗时（从进程启动开始，{args.repeat} 次，毫秒）")
+        for route, result in report["routes"].items():
+            print(f"  {route}\n      {result}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+match_videos（pgvector HNSW 索引）的召回率 / 延迟基准测试
+
+以本地全精度暴力检索为准确结果，对不同的 ef_search（或 probes）调用 match_videos，统计：
+- recall@k：与准确结果的重合比例
+- 单次调用延迟（p50 / p95，毫秒，包含网络往返）
+
+准确结果需要全部分镜向量，默认从 video_storyboard 分页读取，也可以用 VectorIndex.save 保存的快照（需与数据库一致）。
+查询向量二选一：
+- --queries-file：每行一个查询文本，调用 embedding 模型生成向量
+- 默认：从分镜向量中抽样并加噪声
+
+用法:
+    python benchmarks/pgvector_recall_bench.py --queries 100 --k 10
+    python benchmarks/pgvector_recall_bench.py --ef-search 20 40 80 200 --queries-file queries.txt
+    python benchmarks/pgvector_recall_bench.py --snapshot /tmp/vector_index.npz --probes 1 5 10   # IVFFlat 索引
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index_helper import BruteForceVectorIndex, normalize  # noqa: E402
+
+
+def load_exact_index(args, supabase_client) -> BruteForceVectorIndex:
+    index = BruteForceVectorIndex(dim=1536, initial_capacity=args.expected_size)
+    if args.snapshot:
+        index.load_snapshot(args.snapshot)
+    else:
+        index.load_from_supabase(supabase_client)
+    return index
+
+
+def make_queries(args, index: BruteForceVectorIndex, processor) -> np.ndarray:
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()][:args.queries]
+        return np.asarray(processor.get_embedding(texts), dtype=np.float32)
+
+    _, vectors = index.all_vectors()
+    rng = np.random.default_rng(args.seed)
+    picked = vectors[rng.integers(0, len(vectors), size=args.queries)]
+    return normalize(picked + args.noise / np.sqrt(vectors.shape[1]) * rng.normal(size=picked.shape).astype(np.float32))
+
+
+def run_rpc(supabase_client, queries: np.ndarray, k: int, **options):
+    results = []
+    latencies = []
+    for query in queries:
+        params = {"query_embedding": query.tolist(), "match_threshold": -1, "match_count": k}
+        params.update({name: value for name, value in options.items() if value is not None})
+        start = time.perf_counter()
+        response = supabase_client.rpc("match_videos", params).execute()
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([row["shot_id"] for row in response.data])
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="match_videos 召回率基准测试")
+    parser.add_argument("--snapshot", help="向量索引快照文件（.npz），不传时从数据库读取全部分镜")
+    parser.add_argument("--expected-size", type=int, default=10000, help="分镜数量的估计值，用于预分配内存")
+    parser.add_argument("--queries-file", help="查询文本文件，每行一条")
+    parser.add_argument("--queries", type=int, default=100, help="查询条数")
+    parser.add_argument("--noise", type=float, default=0.3, help="抽样查询向量时加入的噪声大小")
+    parser.add_argument("--k", type=int, default=10, help="每次检索返回的条数（最多 50）")
+    parser.add_argument("--ef-search", type=int, nargs="*", default=[10, 20, 40, 80, 200, 400],
+                        help="需要测试的 hnsw.ef_search 取值")
+    parser.add_argument("--probes", type=int, nargs="*", default=[], help="需要测试的 ivfflat.probes 取值")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    from genai_helper import VideoAiProcessor
+    processor = VideoAiProcessor()
+    supabase_client = processor.supabase_client
+
+    index = load_exact_index(args, supabase_client)
+    queries = make_queries(args, index, processor)
+    truth = [[row["shot_id"] for row in index.search(query, match_threshold=-1, match_count=args.k)] for query in queries]
+    print(f"分镜 {len(index)} 条，查询 {len(queries)} 条，k={args.k}\n")
+
+    configs = [("default", {})]
+    configs += [(f"ef_search={value}", {"ef_search": value}) for value in args.ef_search]
+    configs += [(f"probes={value}", {"probes": value}) for value in args.probes]
+
+    print(f"{'config':<18}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, options in configs:
+        results, latencies = run_rpc(supabase_client, queries, args.k, **options)
+        recall = np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth) if t])
+        print(f"{name:<18}{recall:>10.4f}{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+压缩向量检索的召回率 / 延迟 / 内存基准测试
+
+以全精度暴力检索为基准，对比 fp16、int8、PCA 等压缩方式在不同 oversample 下的：
+- recall@k：与全精度检索结果的重合比例
+- 单次检索延迟（p50 / p95，毫秒）
+- 常驻内存的向量数据大小
+
+数据来源二选一：
+- --snapshot：VectorIndex.save 保存的快照（真实分镜向量），查询向量从语料中抽样并加噪声
+- --synthetic：随机生成带簇结构的向量
+
+用法:
+    python benchmarks/quantization_bench.py --synthetic 50000
+    python benchmarks/quantization_bench.py --snapshot /tmp/vector_index.npz --queries 200 --k 10
+"""
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from vector_index_helper import BruteForceVectorIndex, QuantizedVectorIndex, normalize  # noqa: E402
+
+DEFAULT_CONFIGS = [
+    ("fp16", 1), ("fp16", 2),
+    ("int8", 1), ("int8", 2), ("int8", 4),
+    ("pca", 2), ("pca", 4), ("pca", 8),
+]
+
+
+def load_vectors(args) -> np.ndarray:
+    if args.snapshot:
+        return np.load(args.snapshot)["vectors"].astype(np.float32)
+    rng = np.random.default_rng(args.seed)
+    centers = rng.normal(size=(max(args.synthetic // 100, 1), args.dim)).astype(np.float32)
+    labels = rng.integers(0, len(centers), size=args.synthetic)
+    return centers[labels] + 0.5 * rng.normal(size=(args.synthetic, args.dim)).astype(np.float32)
+
+
+def make_queries(vectors: np.ndarray, count: int, seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed + 1)
+    picked = vectors[rng.integers(0, len(vectors), size=count)]
+    return normalize(picked + 0.3 * np.linalg.norm(picked, axis=1, keepdims=True) / np.sqrt(vectors.shape[1])
+                     * rng.normal(size=picked.shape).astype(np.float32))
+
+
+def build(index, vectors: np.ndarray):
+    rows = [{"shot_id": i + 1, "material_id": i // 20, "content_vector": vector} for i, vector in enumerate(vectors)]
+    for start in range(0, len(rows), 10000):
+        index.upsert_rows(rows[start:start + 10000])
+    return index
+
+
+def run_queries(index, queries: np.ndarray, k: int):
+    results = []
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        matches = index.search(query, match_threshold=-1, match_count=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append([match["shot_id"] for match in matches])
+    return results, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="压缩向量检索基准测试")
+    parser.add_argument("--snapshot", help="向量索引快照文件（.npz）")
+    parser.add_argument("--synthetic", type=int, default=20000, help="随机生成的向量数量")
+    parser.add_argument("--dim", type=int, default=1536, help="随机向量的维度")
+    parser.add_argument("--queries", type=int, default=100, help="查询条数")
+    parser.add_argument("--k", type=int, default=10, help="每次检索返回的条数")
+    parser.add_argument("--pca-dim", type=int, default=256, help="PCA 降维后的维度")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args)
+    dim = vectors.shape[1]
+    queries = make_queries(vectors, args.queries, args.seed)
+    print(f"语料 {len(vectors)} 条 x {dim} 维，查询 {len(queries)} 条，k={args.k}\n")
+
+    exact = build(BruteForceVectorIndex(dim=dim, initial_capacity=len(vectors)), vectors)
+    truth, latencies = run_queries(exact, queries, args.k)
+    print(f"{'config':<16}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}{'memory MB':>12}")
+    print(f"{'float32 exact':<16}{1.0:>10.4f}{np.percentile(latencies, 50):>10.3f}"
+          f"{np.percentile(latencies, 95):>10.3f}{exact._matrix.nbytes / 2 ** 20:>12.1f}")
+
+    for compression, oversample in DEFAULT_CONFIGS:
+        index = build(QuantizedVectorIndex(dim=dim, initial_capacity=len(vectors), compression=compression,
+                                           oversample=oversample, pca_dim=args.pca_dim), vectors)
+        results, latencies = run_queries(index, queries, args.k)
+        recall = np.mean([len(set(r) & set(t)) / len(t) for r, t in zip(results, truth)])
+        # 全精度向量放在 memmap 中时不占用内存，这里只统计压缩向量部分
+        memory = (index.memory_bytes() - index._matrix.nbytes) / 2 ** 20
+        print(f"{compression + ' x' + str(oversample):<16}{recall:>10.4f}{np.percentile(latencies, 50):>10.3f}"
+              f"{np.percentile(latencies, 95):>10.3f}{memory:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,390 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def embedding_cache_key(model: str, text: str) -> str:
+    """
+    计算向量缓存的键：模型名称 + 文本内容的 sha256
+
+    Args:
+        model (str): embedding 模型名称
+        text (str): 待向量化的文本
+
+    Returns:
+        str: 缓存键
+    """
+    return hashlib.sha256(f"{model}\n{text}".encode("utf-8")).hexdigest()
+
+
+# 向量缓存基类，子类实现 _get_many / _set_many，基类负责命中统计
+class EmbeddingCache:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+
+    def get_many(self, keys: list) -> dict:
+        """
+        批量读取缓存
+
+        Args:
+            keys (list): 缓存键列表
+
+        Returns:
+            dict: {缓存键: 向量}，只包含命中的键
+        """
+        found = self._get_many(keys)
+        with self._stats_lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items: dict):
+        """
+        批量写入缓存
+
+        Args:
+            items (dict): {缓存键: 向量}
+        """
+        if items:
+            self._set_many(items)
+
+    def stats(self) -> dict:
+        """返回命中/未命中计数"""
+        with self._stats_lock:
+            total = self.hits + self.misses
+            return {
+                "backend": self.__class__.__name__,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "size": self.size()
+            }
+
+    def size(self) -> int:
+        raise NotImplementedError
+
+    def _get_many(self, keys: list) -> dict:
+        raise NotImplementedError
+
+    def _set_many(self, items: dict):
+        raise NotImplementedError
+
+
+# 向量按 float32 保存：embedding 的精度本来就在 float32 以内，内存和磁盘占用是 float64 / Python float 列表的一半以下
+def pack_vector(vector) -> array:
+    return array("f", vector)
+
+
+# 进程内 LRU 缓存，按条目数和向量占用的字节数淘汰最久未使用的条目
+class LruEmbeddingCache(EmbeddingCache):
+    def __init__(self, max_size: int = None, max_bytes: int = 64 * 1024 * 1024):
+        """
+        初始化 LruEmbeddingCache 实例
+
+        Args:
+            max_size (int, optional): 最大条目数，为 None 时只按字节数限制
+            max_bytes (int, optional): 向量（float32）占用的最大字节数，默认 64MB，1536 维时约 1 万条
+        """
+        super().__init__()
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def _get_many(self, keys: list) -> dict:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    found[key] = self._data[key].tolist()
+        return found
+
+    def _set_many(self, items: dict):
+        with self._lock:
+            for key, vector in items.items():
+                packed = pack_vector(vector)
+                previous = self._data.pop(key, None)
+                if previous is not None:
+                    self._bytes -= previous.itemsize * len(previous)
+                self._data[key] = packed
+                self._bytes += packed.itemsize * len(packed)
+            while self._data and ((self.max_size and len(self._data) > self.max_size)
+                                  or (self.max_bytes and self._bytes > self.max_bytes)):
+                _, evicted = self._data.popitem(last=False)
+                self._bytes -= evicted.itemsize * len(evicted)
+
+    def stats(self) -> dict:
+        result = super().stats()
+        with self._lock:
+            result["bytes"] = self._bytes
+        return result
+
+
+# 本地磁盘上的 SQLite 缓存，进程重启后仍然有效
+# 向量按 float32 保存，最多 max_rows 行，超过时删除最久未访问的行（删除后的页会被复用，文件不再增长）。
+# 注意：Cloud Run 上 /tmp 为内存文件系统，文件大小计入实例内存
+class SqliteEmbeddingCache(EmbeddingCache):
+    def __init__(self, path: str, max_rows: int = 20000):
+        """
+        初始化 SqliteEmbeddingCache 实例
+
+        Args:
+            path (str): SQLite 文件路径
+            max_rows (int, optional): 最多保存的向量数，1536 维时每行约 6KB，默认约 120MB
+        """
+        super().__init__()
+        self.path = path
+        self.max_rows = max_rows
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # 旧版本按 float64 保存、没有访问时间的表
+            self._conn.execute("DROP TABLE IF EXISTS embedding_cache")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_vector ("
+                "cache_key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_embedding_vector_accessed_at ON embedding_vector (accessed_at)"
+            )
+            self._conn.commit()
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM embedding_vector").fetchone()[0]
+
+    def size(self) -> int:
+        with self._lock:
+            return self._rows
+
+    def _get_many(self, keys: list) -> dict:
+        found = {}
+        # SQLite 对单条语句的参数个数有限制，分批查询
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT cache_key, vector FROM embedding_vector WHERE cache_key IN ({placeholders})",
+                    chunk
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = array("f", blob).tolist()
+            # 记录访问时间，淘汰时保留最近用到的向量
+            if found:
+                hit_keys = list(found)
+                now = time.time()
+                for start in range(0, len(hit_keys), 500):
+                    chunk = hit_keys[start:start + 500]
+                    placeholders = ",".join("?" * len(chunk))
+                    self._conn.execute(
+                        f"UPDATE embedding_vector SET accessed_at = ? WHERE cache_key IN ({placeholders})",
+                        [now] + chunk
+                    )
+                self._conn.commit()
+        return found
+
+    def _set_many(self, items: dict):
+        now = time.time()
+        rows = [(key, pack_vector(vector).tobytes(), now) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_vector (cache_key, vector, accessed_at) VALUES (?, ?, ?)",
+                rows
+            )
+            self._rows = self._conn.execute("SELECT COUNT(*) FROM embedding_vector").fetchone()[0]
+            if self.max_rows and self._rows > self.max_rows:
+                # 一次删到上限的 90%，避免每次写入都触发淘汰
+                evict = self._rows - int(self.max_rows * 0.9)
+                self._conn.execute(
+                    "DELETE FROM embedding_vector WHERE cache_key IN "
+                    "(SELECT cache_key FROM embedding_vector ORDER BY accessed_at LIMIT ?)",
+                    (evict,)
+                )
+                self._rows -= evict
+            self._conn.commit()
+
+
+# 两级缓存：先查内存 LRU，未命中再查磁盘，磁盘命中的结果回填到内存
+class TieredEmbeddingCache(EmbeddingCache):
+    def __init__(self, memory: EmbeddingCache, disk: EmbeddingCache):
+        super().__init__()
+        self.memory = memory
+        self.disk = disk
+
+    def size(self) -> int:
+        return self.disk.size()
+
+    def _get_many(self, keys: list) -> dict:
+        found = self.memory.get_many(keys)
+        missing = [key for key in keys if key not in found]
+        if missing:
+            from_disk = self.disk.get_many(missing)
+            self.memory.set_many(from_disk)
+            found.update(from_disk)
+        return found
+
+    def _set_many(self, items: dict):
+        self.memory.set_many(items)
+        self.disk.set_many(items)
+
+    def stats(self) -> dict:
+        result = super().stats()
+        result["memory"] = self.memory.stats()
+        result["disk"] = self.disk.stats()
+        return result
+
+
+_default_embedding_cache = None
+_default_embedding_cache_lock = threading.Lock()
+
+
+def get_default_embedding_cache() -> EmbeddingCache:
+    """
+    获取进程内共享的向量缓存实例
+
+    环境变量:
+        EMBEDDING_CACHE_MEMORY_MB: 内存 LRU 中向量占用的上限（MB），默认 64（1536 维时约 1 万条）
+        EMBEDDING_CACHE_SIZE: 内存 LRU 的最大条目数，默认只按 EMBEDDING_CACHE_MEMORY_MB 限制
+        EMBEDDING_CACHE_PATH: SQLite 缓存文件路径，默认 /tmp/embedding_cache.sqlite3，设置为空则只使用内存缓存
+            （Cloud Run 上 /tmp 占用实例内存）
+        EMBEDDING_CACHE_MAX_ROWS: SQLite 缓存最多保存的向量数，默认 20000（1536 维时约 120MB）
+
+    Returns:
+        EmbeddingCache: 缓存实例
+    """
+    global _default_embedding_cache
+    with _default_embedding_cache_lock:
+        if _default_embedding_cache is None:
+            max_size = os.environ.get("EMBEDDING_CACHE_SIZE")
+            memory = LruEmbeddingCache(
+                int(max_size) if max_size else None,
+                int(float(os.environ.get("EMBEDDING_CACHE_MEMORY_MB", 64)) * 1024 * 1024)
+            )
+            path = os.environ.get("EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3")
+            if path:
+                disk = SqliteEmbeddingCache(path, int(os.environ.get("EMBEDDING_CACHE_MAX_ROWS", 20000)))
+                _default_embedding_cache = TieredEmbeddingCache(memory, disk)
+            else:
+                _default_embedding_cache = memory
+        return _default_embedding_cache
+
+
+def search_cache_key(query_str: str, match_threshold: float, match_count: int, **options) -> tuple:
+    """计算语义搜索结果缓存的键，options 为影响结果的其它检索参数（如 ef_search），值为 None 的参数忽略"""
+    extra = tuple(sorted((name, json.dumps(value, sort_keys=True, ensure_ascii=False))
+                         for name, value in options.items() if value is not None))
+    return (query_str, float(match_threshold), int(match_count)) + extra
+
+
+# 语义搜索结果缓存，TTL + LRU 淘汰
+# 查询向量由向量缓存负责，这里只缓存 (threshold, count) 对应的结果集
+# 分镜信息变化时调用 invalidate() 使所有结果失效；其它实例上的分镜变化只能依赖 TTL 过期
+class SearchResultCache:
+    def __init__(self, max_size: int = 1000, ttl_seconds: float = 300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # 分镜版本号，每次失效加一，用于丢弃失效前开始、失效后才写入的搜索结果
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        读取缓存的搜索结果
+
+        Args:
+            key (tuple): search_cache_key 计算的键
+
+        Returns:
+            list: 搜索结果，未命中或已过期时返回 None
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, results, version: int):
+        """
+        写入搜索结果
+
+        Args:
+            key (tuple): search_cache_key 计算的键
+            results (list): 搜索结果
+            version (int): 开始搜索时读取到的 version，与当前版本不一致时不写入
+        """
+        with self._lock:
+            if version != self.version:
+                return
+            self._data[key] = (time.monotonic() + self.ttl_seconds, results)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self):
+        """分镜信息发生变化，清空所有搜索结果"""
+        with self._lock:
+            self.version += 1
+            self.invalidations += 1
+            self._data.clear()
+
+    def stats(self) -> dict:
+        """返回命中/未命中/失效计数"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "invalidations": self.invalidations,
+                "version": self.version,
+                "size": len(self._data)
+            }
+
+
+_default_search_cache = None
+_default_search_cache_lock = threading.Lock()
+
+
+def get_default_search_cache() -> SearchResultCache:
+    """
+    获取进程内共享的语义搜索结果缓存实例
+
+    环境变量:
+        SEARCH_CACHE_SIZE: 最大缓存的查询条数，默认 1000
+        SEARCH_CACHE_TTL: 结果的有效期（秒），默认 300
+
+    Returns:
+        SearchResultCache: 缓存实例
+    """
+    global _default_search_cache
+    with _default_search_cache_lock:
+        if _default_search_cache is None:
+            _default_search_cache = SearchResultCache(
+                max_size=int(os.environ.get("SEARCH_CACHE_SIZE", 1000)),
+                ttl_seconds=float(os.environ.get("SEARCH_CACHE_TTL", 300))
+            )
+        return _default_search_cache
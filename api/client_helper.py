@@ -0,0 +1,197 @@
+import threading
+import time
+from resilience_helper import is_transient_error
+
+# 鉴权失败的 HTTP 状态码，凭证过期等情况重建客户端后可以恢复
+AUTH_ERROR_STATUS_CODES = (401, 403)
+
+
+def is_client_failure(e: Exception) -> bool:
+    """判断异常是否说明客户端本身不可用（连接、超时等临时性错误或鉴权失败），参数错误、业务错误不算"""
+    if is_transient_error(e):
+        return True
+    # google-auth 的凭证刷新失败（RefreshError 等），按模块名判断，不为此导入 google.auth
+    if type(e).__module__.startswith("google.auth"):
+        return True
+    for value in (getattr(e, "code", None), getattr(e, "status_code", None)):
+        try:
+            if int(value) in AUTH_ERROR_STATUS_CODES:
+                return True
+        except (TypeError, ValueError):
+            continue
+    return False
+
+
+# 进程内共享的长连接客户端注册表：
+# - 首次使用时才创建客户端（懒加载），之后所有请求共享同一个实例
+# - 按固定间隔在后台线程中做健康检查，检查失败则重建
+# - 调用方上报成功和失败，连续失败达到阈值后重建；只有 is_failure 判定为客户端不可用的异常才计数
+class ClientRegistry:
+    def __init__(self, health_check_interval: float = 60, max_failures: int = 3, is_failure=None):
+        """
+        初始化 ClientRegistry 实例
+
+        Args:
+            health_check_interval (float, optional): 健康检查的间隔（秒）
+            max_failures (int, optional): 连续失败多少次后重建客户端
+            is_failure (callable, optional): 判断异常是否计入失败次数，默认 is_client_failure
+        """
+        self.health_check_interval = health_check_interval
+        self.max_failures = max_failures
+        self.is_failure = is_failure or is_client_failure
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def register(self, name: str, factory, health_check=None):
+        """
+        注册客户端工厂
+
+        Args:
+            name (str): 客户端名称
+            factory (callable): 无参数的工厂函数，返回客户端实例
+            health_check (callable, optional): 接收客户端实例的健康检查函数，抛出异常或返回 False 表示不健康
+        """
+        with self._lock:
+            self._entries[name] = self._new_entry(factory, health_check)
+
+    @staticmethod
+    def _new_entry(factory, health_check) -> dict:
+        return {
+            "factory": factory,
+            "health_check": health_check,
+            "client": None,
+            "lock": threading.Lock(),
+            "failures": 0,
+            "rebuilds": 0,
+            "created_at": None,
+            "last_checked_at": None,
+            "checking": False,
+            "healthy": None,
+            "last_error": None
+        }
+
+    def get(self, name: str):
+        """
+        获取客户端实例，不存在时创建
+
+        Args:
+            name (str): 客户端名称
+
+        Returns:
+            object: 客户端实例
+        """
+        entry = self._entries[name]
+        client = entry["client"]
+        if client is None:
+            with entry["lock"]:
+                if entry["client"] is None:
+                    entry["client"] = entry["factory"]()
+                    entry["created_at"] = time.time()
+                    entry["last_checked_at"] = time.monotonic()
+                    entry["healthy"] = True
+                client = entry["client"]
+        self._maybe_check(name, entry)
+        return client
+
+    def get_or_create(self, name: str, factory, health_check=None):
+        """
+        获取客户端实例，名称未注册时先用 factory 注册，适用于按参数区分的客户端（如不同队列的 TaskService）
+
+        Args:
+            name (str): 客户端名称
+            factory (callable): 无参数的工厂函数
+            health_check (callable, optional): 健康检查函数
+
+        Returns:
+            object: 客户端实例
+        """
+        if name not in self._entries:
+            with self._lock:
+                if name not in self._entries:
+                    self._entries[name] = self._new_entry(factory, health_check)
+        return self.get(name)
+
+    def report_failure(self, name: str, error: Exception = None):
+        """
+        上报一次调用失败，连续失败达到 max_failures 次后丢弃客户端，下次使用时重建；
+        is_failure 判定为非客户端问题的异常（如参数错误）不计数
+
+        Args:
+            name (str): 客户端名称
+            error (Exception, optional): 失败原因
+        """
+        entry = self._entries.get(name)
+        if entry is None or (error is not None and not self.is_failure(error)):
+            return
+        with entry["lock"]:
+            entry["failures"] += 1
+            entry["last_error"] = str(error) if error else None
+            if entry["failures"] >= self.max_failures:
+                self._reset(name, entry)
+
+    def report_success(self, name: str):
+        """上报一次调用成功，清零连续失败次数"""
+        entry = self._entries.get(name)
+        if entry is None or not entry["failures"]:
+            return
+        with entry["lock"]:
+            entry["failures"] = 0
+
+    def invalidate(self, name: str):
+        """丢弃客户端，下次使用时重建"""
+        entry = self._entries.get(name)
+        if entry is None:
+            return
+        with entry["lock"]:
+            self._reset(name, entry)
+
+    def health(self) -> dict:
+        """返回所有客户端的状态"""
+        return {
+            name: {
+                "initialized": entry["client"] is not None,
+                "healthy": entry["healthy"],
+                "failures": entry["failures"],
+                "rebuilds": entry["rebuilds"],
+                "created_at": entry["created_at"],
+                "last_error": entry["last_error"]
+            }
+            for name, entry in list(self._entries.items())
+        }
+
+    def _reset(self, name: str, entry: dict):
+        if entry["client"] is not None:
+            entry["rebuilds"] += 1
+            print(f"客户端 {name} 将被重建，原因：{entry['last_error']}")
+        entry["client"] = None
+        entry["failures"] = 0
+        entry["healthy"] = None
+
+    def _maybe_check(self, name: str, entry: dict):
+        """健康检查到期时在后台线程中执行，不占用请求的处理时间"""
+        if entry["health_check"] is None:
+            return
+        with entry["lock"]:
+            client = entry["client"]
+            if client is None or entry["checking"] or time.monotonic() - entry["last_checked_at"] < self.health_check_interval:
+                return
+            entry["checking"] = True
+        threading.Thread(target=self._check, args=(name, entry, client), daemon=True).start()
+
+    def _check(self, name: str, entry: dict, client):
+        try:
+            healthy = entry["health_check"](client) is not False
+            error = None if healthy else "health check returned False"
+        except Exception as e:
+            healthy = False
+            error = str(e)
+        with entry["lock"]:
+            entry["checking"] = False
+            entry["last_checked_at"] = time.monotonic()
+            # 检查期间客户端可能已被重建，只处理被检查的那个实例
+            if entry["client"] is not client:
+                return
+            entry["healthy"] = healthy
+            if not healthy:
+                entry["last_error"] = error
+                self._reset(name, entry)
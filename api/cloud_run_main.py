@@ -1,9 +1,79 @@
 import functions_framework
-from flask import request, jsonify
-from genai_helper import VideoAiProcessor
-from task_helper import TaskService
-from report_helper import BigqueryReportService
+from flask import Response, request, jsonify
+from cache_helper import get_default_embedding_cache, get_default_search_cache
+from embedding_helper import get_default_query_batcher
+from prompt_cache_helper import get_default_prompt_cache
+from rate_limit_helper import get_default_rate_limiter
+from resilience_helper import deadline, get_dependency_stats
+from client_helper import ClientRegistry
+import json
 import os
+import threading
+
+# google.genai / supabase / bigquery / tasks_v2 导入很慢，只在对应路由第一次使用时才导入，
+# 冷启动时不再为用不到的依赖付出导入时间
+
+
+def create_video_processor():
+    from genai_helper import VideoAiProcessor
+    return VideoAiProcessor()
+
+
+def create_report_service():
+    from report_helper import BigqueryReportService
+    return BigqueryReportService()
+
+
+def create_task_service(queue_name=None):
+    from task_helper import TaskService
+    return TaskService(queue_name=queue_name, location="asia-southeast1")
+
+
+# 进程内共享的长连接客户端，首次使用时创建，所有请求复用
+clients = ClientRegistry(
+    health_check_interval=float(os.getenv('CLIENT_HEALTH_CHECK_INTERVAL', 60)),
+    max_failures=int(os.getenv('CLIENT_MAX_FAILURES', 3))
+)
+clients.register('video_processor', create_video_processor, health_check=lambda processor: processor.health_check())
+clients.register('report_service', create_report_service)
+
+# 开启进程内向量索引时，启动后在后台创建视频处理器，开始加载索引，第一个搜索请求不用等待；加载完成前语义搜索使用数据库
+if os.getenv('VECTOR_INDEX_ENABLED', 'false').lower() == 'true':
+    threading.Thread(target=clients.get, args=('video_processor',), name='video-processor-warm-up', daemon=True).start()
+
+
+# 允许使用的任务队列（逗号分隔），未设置时不限制队列名称，但最多为 TASK_QUEUE_MAX 个队列创建客户端
+ALLOWED_TASK_QUEUES = {name.strip() for name in os.getenv('TASK_QUEUE_NAMES', '').split(',') if name.strip()}
+MAX_TASK_QUEUES = int(os.getenv('TASK_QUEUE_MAX', 16))
+_task_queues = set()
+_task_queues_lock = threading.Lock()
+
+
+def get_task_service(queue_name=None):
+    """
+    获取指定队列的 TaskService，每个队列共享一个实例
+
+    Args:
+        queue_name (str, optional): 队列名称，为空时使用默认队列
+
+    Returns:
+        TaskService: 任务服务
+
+    Raises:
+        ValueError: 队列不在 TASK_QUEUE_NAMES 中，或队列数已达到 TASK_QUEUE_MAX
+    """
+    if queue_name is not None and not isinstance(queue_name, str):
+        raise ValueError('queue_name must be a string')
+    name = f'task_service:{queue_name}'
+    if queue_name:
+        if ALLOWED_TASK_QUEUES and queue_name not in ALLOWED_TASK_QUEUES:
+            raise ValueError(f'queue_name {queue_name} is not allowed')
+        with _task_queues_lock:
+            if queue_name not in _task_queues:
+                if len(_task_queues) >= MAX_TASK_QUEUES:
+                    raise ValueError(f'too many task queues, at most {MAX_TASK_QUEUES}')
+                _task_queues.add(queue_name)
+    return clients.get_or_create(name, lambda: create_task_service(queue_name))
 
 @functions_framework.http
 def hello_http(request):
@@ -12,13 +82,16 @@ def hello_http(request):
     
     支持的路由:
     - GET /semantic_search: 对素材进行语义搜索 API
+    - POST /semantic_search_batch: 批量语义搜索 API
     - POST /process_video: 视频处理 API
+    - POST /process_videos: 批量视频处理 API
     - POST /create_task: 创建任务 API
     - GET /query_task: 查询任务状态 API
     - POST /report/query_material: 查询单个素材指标
     - POST /report/query_materials: 查询多个素材指标
     - POST /report/query_materials_by_metrics: 按条件搜索素材列表
     - GET /report/query_advertisers_by_post: 查询Post相关的所有广告主
+    - GET /stats: 查询进程内缓存等运行统计
     
     Args:
         request (flask.Request): Flask 请求对象
@@ -26,15 +99,25 @@ def hello_http(request):
     Returns:
         tuple: (JSON 响应, HTTP 状态码)
     """
-    # 初始化处理器
-    processor = VideoAiProcessor()
+    # 本次请求的截止时间（REQUEST_DEADLINE_SECONDS，未设置时不限制），外部调用的重试不会超过该时间
+    with deadline(float(os.getenv('REQUEST_DEADLINE_SECONDS', 0))):
+        return dispatch_request(request)
 
-    # 路由分发
+
+def dispatch_request(request):
+    """按请求路径和方法分发到对应的处理函数，路由见 hello_http"""
+    # 路由分发，处理器只在需要的路由上获取
     if request.path == '/semantic_search' and request.method == 'GET':
-        return handle_semantic_search(request, processor)
+        return handle_semantic_search(request, clients.get('video_processor'))
+    
+    elif request.path == '/semantic_search_batch' and request.method == 'POST':
+        return handle_semantic_search_batch(request, clients.get('video_processor'))
     
     elif request.path == '/process_video' and request.method == 'POST':
-        return handle_process_video(request, processor)
+        return handle_process_video(request, clients.get('video_processor'))
+    
+    elif request.path == '/process_videos' and request.method == 'POST':
+        return handle_process_videos(request, clients.get('video_processor'))
     
     elif request.path == '/create_task' and request.method == 'POST':
         return handle_task_create(request)
@@ -54,10 +137,126 @@ def hello_http(request):
     elif request.path == '/report/query_advertisers_by_post' and request.method == 'GET':
         return handle_query_advertisers_by_post(request)
     
+    elif request.path == '/stats' and request.method == 'GET':
+        return handle_stats(request)
+    
     else:
         return jsonify({'error': 'Not Found', 'message': 'Invalid path or method'}), 404
 
 
+def parse_search_params(args):
+    """
+    解析并校验语义搜索参数，cloud_run_main 和 asgi_main 的语义搜索共用
+
+    Args:
+        args (Mapping): 查询参数，flask.Request.args 或 starlette 的 query_params
+
+    Returns:
+        tuple: (参数字典, 错误信息)，校验失败时参数字典为 None
+    """
+    query_str = args.get('query_str')
+    try:
+        match_threshold = float(args.get('match_threshold', 0.7))
+        match_count = int(args.get('match_count', 10))
+        ef_search = int(args['ef_search']) if args.get('ef_search') else None
+        probes = int(args['probes']) if args.get('probes') else None
+    except ValueError:
+        return None, {'error': 'Invalid parameter type',
+                      'message': 'match_threshold must be float, match_count, ef_search and probes must be int'}
+
+    try:
+        filters = json.loads(args['filters']) if args.get('filters') else None
+    except ValueError:
+        return None, {'error': 'Invalid parameter type', 'message': 'filters must be a JSON object'}
+
+    group_by = args.get('group_by', 'shot')
+    if group_by not in ('shot', 'material'):
+        return None, {'error': 'Invalid parameter', 'message': 'group_by must be shot or material'}
+
+    # vector 为向量检索，hybrid 为关键词 + 向量的混合检索
+    mode = args.get('mode', 'vector')
+    if mode not in ('vector', 'hybrid'):
+        return None, {'error': 'Invalid parameter', 'message': 'mode must be vector or hybrid'}
+    if mode == 'hybrid' and group_by != 'shot':
+        return None, {'error': 'Invalid parameter', 'message': 'hybrid mode is only supported when group_by is shot'}
+
+    # 传了 page_size / cursor / stream 时分页返回
+    stream = args.get('stream', '').lower() in ('1', 'true')
+    paginated = stream or bool(args.get('page_size')) or bool(args.get('cursor'))
+    if paginated and (group_by != 'shot' or mode != 'vector'):
+        return None, {'error': 'Invalid parameter',
+                      'message': 'pagination is only supported for vector mode with group_by shot'}
+
+    # 参数验证
+    if not query_str:
+        return None, {'error': 'Missing parameter', 'message': 'query_str is required'}
+
+    if match_threshold < 0 or match_threshold > 1:
+        return None, {'error': 'Invalid parameter', 'message': 'match_threshold must be between 0 and 1'}
+
+    if match_count <= 0:
+        return None, {'error': 'Invalid parameter', 'message': 'match_count must be positive'}
+
+    # pgvector 限制 hnsw.ef_search 在 1 ~ 1000 之间
+    if ef_search is not None and not 1 <= ef_search <= 1000:
+        return None, {'error': 'Invalid parameter', 'message': 'ef_search must be between 1 and 1000'}
+
+    if probes is not None and probes <= 0:
+        return None, {'error': 'Invalid parameter', 'message': 'probes must be positive'}
+
+    params = {
+        'query_str': query_str,
+        'match_threshold': match_threshold,
+        'match_count': match_count,
+        'ef_search': ef_search,
+        'probes': probes,
+        'filters': filters,
+        'group_by': group_by,
+        'mode': mode
+    }
+
+    # 混合检索的候选数和 RRF 参数
+    if mode == 'hybrid':
+        try:
+            params['candidate_count'] = int(args.get('candidate_count', 100))
+            params['rrf_k'] = int(args.get('rrf_k', 60))
+        except ValueError:
+            return None, {'error': 'Invalid parameter type', 'message': 'candidate_count and rrf_k must be int'}
+        if not 1 <= params['candidate_count'] <= 1000 or params['rrf_k'] < 0:
+            return None, {'error': 'Invalid parameter',
+                          'message': 'candidate_count must be between 1 and 1000, rrf_k must not be negative'}
+
+    if paginated:
+        try:
+            page_size = int(args.get('page_size', 50 if stream else 20))
+            max_results = int(args.get('max_results', 1000))
+        except ValueError:
+            return None, {'error': 'Invalid parameter type', 'message': 'page_size and max_results must be int'}
+        if not 1 <= page_size <= 200:
+            return None, {'error': 'Invalid parameter', 'message': 'page_size must be between 1 and 200'}
+        del params['match_count']
+        params['page_size'] = page_size
+        params['cursor'] = args.get('cursor') or None
+        if stream:
+            if not 1 <= max_results <= 10000:
+                return None, {'error': 'Invalid parameter', 'message': 'max_results must be between 1 and 10000'}
+            params['stream'] = True
+            params['max_results'] = max_results
+
+    # 按素材聚合时的打分参数
+    if group_by == 'material':
+        try:
+            params['aggregate_mode'] = args.get('aggregate_mode', 'max')
+            params['top_n'] = int(args.get('top_n', 3))
+            params['shots_per_material'] = int(args.get('shots_per_material', 3))
+        except ValueError:
+            return None, {'error': 'Invalid parameter type', 'message': 'top_n and shots_per_material must be int'}
+        if params['top_n'] <= 0 or params['shots_per_material'] <= 0:
+            return None, {'error': 'Invalid parameter', 'message': 'top_n and shots_per_material must be positive'}
+
+    return params, None
+
+
 def handle_semantic_search(request, processor):
     """
     处理语义搜索请求。
@@ -66,53 +265,192 @@ def handle_semantic_search(request, processor):
         query_str (str): 搜索查询字符串 (必需)
         match_threshold (float): 匹配阈值 (可选，默认 0.7)
         match_count (int): 返回结果数量 (可选，默认 10)
+        ef_search (int): HNSW 检索的候选集大小，越大召回率越高、速度越慢 (可选，1 ~ 1000，默认使用数据库配置)
+        probes (int): IVFFlat 检索的聚类数量 (可选，默认使用数据库配置)
+        filters (str): 素材过滤条件的 JSON (可选)，支持 material_type、target_country、labels、tags、include_deleted，
+            例如 {"material_type": "video", "target_country": ["美国", "日本"], "labels": ["口红"]}
+        group_by (str): shot 返回分镜列表，material 返回按素材聚合的结果 (可选，默认 shot)
+        aggregate_mode (str): 按素材聚合时的打分方式，max 或 mean_top_n (可选，默认 max)
+        top_n (int): mean_top_n 打分时取的分镜数 (可选，默认 3)
+        shots_per_material (int): 每个素材附带的分镜数 (可选，默认 3)
+        mode (str): vector 为向量检索，hybrid 为关键词 + 向量的混合检索 (可选，默认 vector)
+        candidate_count (int): 混合检索时每一路的候选数 (可选，1 ~ 1000，默认 100)
+        rrf_k (int): 混合检索时倒数排名融合的平滑参数 (可选，默认 60)
+        page_size (int): 分页返回时每页的分镜数 (可选，1 ~ 200)，传了 page_size 或 cursor 时分页返回，
+            响应中的 next_cursor 用于获取下一页，为 null 时没有下一页
+        cursor (str): 上一页返回的 next_cursor (可选)
+        stream (bool): 为 true 时以 NDJSON 流式返回，逐页查询并逐行输出，最多 max_results 条 (可选)
+        max_results (int): 流式返回的最大分镜数 (可选，默认 1000，最多 10000)
         
     Returns:
-        tuple: (JSON 响应, HTTP 状态码)
+        tuple: (JSON 响应, HTTP 状态码)，流式返回时为 flask.Response
     """
-    # 获取查询参数
-    query_str = request.args.get('query_str')
-    try:
-        match_threshold = float(request.args.get('match_threshold', 0.7))
-        match_count = int(request.args.get('match_count', 10))
-    except ValueError:
-        return jsonify({'error': 'Invalid parameter type', 
-                       'message': 'match_threshold must be float, match_count must be int'}), 400
-
-    # 参数验证
-    if not query_str:
-        return jsonify({'error': 'Missing parameter', 'message': 'query_str is required'}), 400
-    
-    if match_threshold < 0 or match_threshold > 1:
-        return jsonify({'error': 'Invalid parameter', 
-                       'message': 'match_threshold must be between 0 and 1'}), 400
-    
-    if match_count <= 0:
-        return jsonify({'error': 'Invalid parameter', 
-                       'message': 'match_count must be positive'}), 400
+    params, error = parse_search_params(request.args)
+    if error:
+        return jsonify(error), 400
 
     try:
         # 执行语义搜索，与 VideoAiProcessor 方法签名对齐
-        results = processor.semantic_search(
-            query_str=query_str,
-            match_threshold=match_threshold,
-            match_count=match_count
-        )
+        search_params = dict(params)
+        group_by = search_params.pop('group_by')
+        mode = search_params.pop('mode')
+        if search_params.pop('stream', False):
+            # 先同步取第一页，参数错误等仍然返回对应的状态码
+            pages = processor.iter_semantic_search_pages(**search_params)
+            first_page = next(pages)
+            return Response(stream_search_pages(first_page, pages), mimetype='application/x-ndjson')
+
+        if 'page_size' in search_params:
+            page = processor.semantic_search_page(**search_params)
+            clients.report_success('video_processor')
+            return jsonify({
+                'status': 'success',
+                'results': page['results'],
+                'count': len(page['results']),
+                'next_cursor': page['next_cursor'],
+                'query': params
+            }), 200
+
+        if group_by == 'material':
+            results = processor.semantic_search_materials(**search_params)
+        elif mode == 'hybrid':
+            results = processor.semantic_search_hybrid(**search_params)
+        else:
+            results = processor.semantic_search(**search_params)
         
+        clients.report_success('video_processor')
         return jsonify({
             'status': 'success',
             'results': results,
             'count': len(results),
-            'query': {
-                'query_str': query_str,
-                'match_threshold': match_threshold,
-                'match_count': match_count
-            }
+            'query': params
         }), 200
+
+    except ValueError as e:
+        # 过滤条件不合法
+        return jsonify({'error': 'Invalid parameter', 'message': str(e)}), 400
         
     except Exception as e:
+        clients.report_failure('video_processor', e)
+        return jsonify({'error': 'Server error', 'message': str(e)}), 500
+
+def handle_semantic_search_batch(request, processor):
+    """
+    处理批量语义搜索请求，多个查询共用一次 embedding 调用和一次数据库调用。
+
+    参数 (JSON):
+        query_strs (list): 搜索查询字符串列表 (必需，最多 SEMANTIC_SEARCH_BATCH_MAX_QUERIES 个，默认 20)
+        match_threshold (float): 匹配阈值 (可选，默认 0.7)
+        match_count (int): 每个查询返回的结果数量 (可选，默认 10)
+        ef_search (int): HNSW 检索的候选集大小 (可选)
+        probes (int): IVFFlat 检索的聚类数量 (可选)
+        filters (dict): 素材过滤条件 (可选)，与 /semantic_search 一致
+        fusion (str): 为 rrf 时额外返回按倒数排名融合的结果 fused (可选)
+        rrf_k (int): 倒数排名融合的平滑参数 (可选，默认 60)
+
+    Returns:
+        tuple: (JSON 响应, HTTP 状态码)
+    """
+    request_json = request.get_json(silent=True)
+    if not request_json:
+        return jsonify({'error': 'Invalid payload', 'message': 'JSON required'}), 400
+
+    query_strs = request_json.get('query_strs')
+    max_queries = int(os.getenv('SEMANTIC_SEARCH_BATCH_MAX_QUERIES', 20))
+    if not isinstance(query_strs, list) or not query_strs:
+        return jsonify({'error': 'Missing parameter', 'message': 'query_strs must be a non-empty list'}), 400
+    if len(query_strs) > max_queries:
+        return jsonify({'error': 'Invalid parameter', 'message': f'at most {max_queries} query_strs are allowed'}), 400
+    if not all(isinstance(query_str, str) and query_str for query_str in query_strs):
+        return jsonify({'error': 'Invalid parameter', 'message': 'each query_str must be a non-empty string'}), 400
+
+    try:
+        match_threshold = float(request_json.get('match_threshold', 0.7))
+        match_count = int(request_json.get('match_count', 10))
+        ef_search = int(request_json['ef_search']) if request_json.get('ef_search') else None
+        probes = int(request_json['probes']) if request_json.get('probes') else None
+        rrf_k = int(request_json.get('rrf_k', 60))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid parameter type',
+                        'message': 'match_threshold must be float, match_count, ef_search, probes and rrf_k must be int'}), 400
+
+    if match_threshold < 0 or match_threshold > 1:
+        return jsonify({'error': 'Invalid parameter', 'message': 'match_threshold must be between 0 and 1'}), 400
+    if match_count <= 0:
+        return jsonify({'error': 'Invalid parameter', 'message': 'match_count must be positive'}), 400
+    if ef_search is not None and not 1 <= ef_search <= 1000:
+        return jsonify({'error': 'Invalid parameter', 'message': 'ef_search must be between 1 and 1000'}), 400
+    if probes is not None and probes <= 0:
+        return jsonify({'error': 'Invalid parameter', 'message': 'probes must be positive'}), 400
+
+    fusion = request_json.get('fusion')
+    if fusion not in (None, 'rrf'):
+        return jsonify({'error': 'Invalid parameter', 'message': 'fusion must be rrf'}), 400
+
+    try:
+        results = processor.semantic_search_batch(
+            query_strs=query_strs,
+            match_threshold=match_threshold,
+            match_count=match_count,
+            ef_search=ef_search,
+            probes=probes,
+            filters=request_json.get('filters')
+        )
+
+        clients.report_success('video_processor')
+        response = {
+            'status': 'success',
+            'results': [
+                {'query_str': query_str, 'results': query_results, 'count': len(query_results)}
+                for query_str, query_results in zip(query_strs, results)
+            ]
+        }
+        if fusion == 'rrf':
+            from genai_helper import reciprocal_rank_fusion
+            response['fused'] = reciprocal_rank_fusion(results, k=rrf_k, limit=match_count)
+        return jsonify(response), 200
+
+    except ValueError as e:
+        # 过滤条件不合法
+        return jsonify({'error': 'Invalid parameter', 'message': str(e)}), 400
+
+    except Exception as e:
+        clients.report_failure('video_processor', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
+
+def ndjson_line(data: dict) -> str:
+    """序列化为一行 NDJSON"""
+    return json.dumps(data, ensure_ascii=False, default=str) + '\n'
+
+
+def stream_search_pages(first_page, pages):
+    """
+    逐行输出分页搜索结果：每个分镜一行 {"type": "result", "data": {...}}，
+    最后一行 {"type": "end", "count": 总数, "next_cursor": 继续翻页的游标}；
+    中途出错时最后一行为 {"type": "error", ...}，其中的 next_cursor 可用于从已输出的位置继续
+
+    Args:
+        first_page (dict): 已经取到的第一页
+        pages (generator): 后续页的生成器
+    """
+    count = 0
+    next_cursor = None
+    page = first_page
+    try:
+        while page is not None:
+            for row in page['results']:
+                yield ndjson_line({'type': 'result', 'data': row})
+            count += len(page['results'])
+            next_cursor = page['next_cursor']
+            page = next(pages, None)
+        clients.report_success('video_processor')
+        yield ndjson_line({'type': 'end', 'count': count, 'next_cursor': next_cursor})
+    except Exception as e:
+        clients.report_failure('video_processor', e)
+        yield ndjson_line({'type': 'error', 'count': count, 'next_cursor': next_cursor, 'message': str(e)})
+
+
 def handle_process_video(request, processor):
     """
     处理视频处理请求。
@@ -120,6 +458,7 @@ def handle_process_video(request, processor):
     参数 (JSON):
         material_id (int): 素材 ID (必需)
         video_path (str): 视频文件路径 (必需)
+        force (bool): 为 true 时即使视频没有变化也重新分析 (可选，默认 false)
         
     Returns:
         tuple: (JSON 响应, HTTP 状态码)
@@ -132,6 +471,7 @@ def handle_process_video(request, processor):
 
     material_id = request_json.get('material_id')
     video_path = request_json.get('video_path')
+    force = request_json.get('force', False)
 
     # 参数验证
     if material_id is None:
@@ -144,13 +484,18 @@ def handle_process_video(request, processor):
     if not video_path:
         return jsonify({'error': 'Missing parameter', 'message': 'video_path is required'}), 400
 
+    if not isinstance(force, bool):
+        return jsonify({'error': 'Invalid parameter', 'message': 'force must be a boolean'}), 400
+
     try:
         # 执行视频处理，与 VideoAiProcessor 方法签名对齐
         processed_shots = processor.run(
             material_id=material_id,
-            video_path=video_path
+            video_path=video_path,
+            force=force
         )
         
+        clients.report_success('video_processor')
         return jsonify({
             'status': 'success',
             'message': f'Processed and saved {processed_shots} shots',
@@ -160,6 +505,104 @@ def handle_process_video(request, processor):
         }), 200
         
     except Exception as e:
+        clients.report_failure('video_processor', e)
+        return jsonify({'error': 'Server error', 'message': str(e)}), 500
+
+# 一次批量处理最多的素材数：整批在一个请求内同步处理，受 REQUEST_DEADLINE_SECONDS 限制，更多的素材应通过 /create_task 分批提交
+MAX_BATCH_MATERIALS = int(os.getenv('PROCESS_VIDEOS_MAX_MATERIALS', 20))
+
+
+def parse_process_videos_params(request_json):
+    """
+    解析并校验批量视频处理参数，cloud_run_main 和 asgi_main 的批量处理共用
+    同一 material_id 出现多次时只保留第一次出现的素材（任一次要求 force 时强制重新分析），避免同一视频被并发分析两次
+
+    Args:
+        request_json (dict): 请求的 JSON
+
+    Returns:
+        tuple: ({"materials": 去重后的素材列表, "max_workers": int, "duplicates": 去掉的重复素材数}, 错误信息)，
+            校验失败时参数字典为 None
+    """
+    materials = request_json.get('materials')
+    force = request_json.get('force', False)
+    max_workers = request_json.get('max_workers', int(os.getenv('PROCESS_VIDEOS_MAX_WORKERS', 4)))
+
+    if not materials or not isinstance(materials, list):
+        return None, {'error': 'Missing parameter', 'message': 'materials must be a non-empty list'}
+
+    if len(materials) > MAX_BATCH_MATERIALS:
+        return None, {'error': 'Invalid parameter',
+                      'message': f'at most {MAX_BATCH_MATERIALS} materials per request, '
+                                 f'submit larger batches through /create_task'}
+
+    for item in materials:
+        if not isinstance(item, dict) or not isinstance(item.get('material_id'), int) or not item.get('video_path'):
+            return None, {'error': 'Invalid parameter',
+                          'message': 'each material requires an integer material_id and a video_path'}
+
+    if not isinstance(max_workers, int) or max_workers <= 0 or max_workers > 16:
+        return None, {'error': 'Invalid parameter', 'message': 'max_workers must be an integer between 1 and 16'}
+
+    if not isinstance(force, bool) or not all(isinstance(item.get('force', force), bool) for item in materials):
+        return None, {'error': 'Invalid parameter', 'message': 'force must be a boolean'}
+
+    unique = {}
+    for item in materials:
+        item_force = item.get('force', force)
+        if item['material_id'] in unique:
+            unique[item['material_id']]['force'] = unique[item['material_id']]['force'] or item_force
+        else:
+            unique[item['material_id']] = {'material_id': item['material_id'], 'video_path': item['video_path'],
+                                           'force': item_force}
+
+    return {
+        'materials': list(unique.values()),
+        'max_workers': max_workers,
+        'duplicates': len(materials) - len(unique)
+    }, None
+
+
+def handle_process_videos(request, processor):
+    """
+    处理批量视频处理请求，多个素材在有界线程池中并发处理。
+    
+    参数 (JSON):
+        materials (list): 素材列表，每项为 {"material_id": int, "video_path": str, "force": bool (可选)} (必需)
+        force (bool): 未单独指定 force 的素材是否强制重新分析 (可选，默认 false)
+        max_workers (int): 并发处理的素材数 (可选，默认使用环境变量 PROCESS_VIDEOS_MAX_WORKERS 或 4，最大 16)
+    参数校验见 parse_process_videos_params：素材数超过 PROCESS_VIDEOS_MAX_MATERIALS 时返回 400，重复的 material_id 只处理一次
+        
+    Returns:
+        tuple: (JSON 响应, HTTP 状态码)
+    """
+    # 获取 JSON 数据
+    request_json = request.get_json(silent=True)
+    
+    if not request_json:
+        return jsonify({'error': 'Invalid payload', 'message': 'JSON required'}), 400
+
+    params, error = parse_process_videos_params(request_json)
+    if error:
+        return jsonify(error), 400
+
+    try:
+        # 批量执行视频处理
+        results = processor.run_batch(materials=params['materials'], max_workers=params['max_workers'])
+        succeeded = sum(1 for result in results if result['status'] == 'success')
+        
+        clients.report_success('video_processor')
+        return jsonify({
+            'status': 'success',
+            'message': f'Processed {succeeded}/{len(results)} materials',
+            'succeeded': succeeded,
+            'failed': len(results) - succeeded,
+            'duplicates': params['duplicates'],
+            'results': results
+        }), 200
+        
+    except Exception as e:
+        clients.report_failure('video_processor', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_task_create(request):
@@ -194,8 +637,8 @@ def handle_task_create(request):
         return jsonify({'error': 'Invalid parameter', 'message': 'http_method must be GET or POST'}), 400
 
     try:
-        # 创建任务服务
-        task_service = TaskService(queue_name=queue_name, location="asia-southeast1")
+        # 获取共享的任务服务
+        task_service = get_task_service(queue_name)
         
         # 创建任务
         task = task_service.create_task(
@@ -204,13 +647,19 @@ def handle_task_create(request):
             http_method=http_method
         )
         
+        clients.report_success(f'task_service:{queue_name}')
         return jsonify({
             'status': 'success',
             'message': '任务创建成功',
             'task': task
         }), 200
         
+    except ValueError as e:
+        # 队列名称不合法
+        return jsonify({'error': 'Invalid parameter', 'message': str(e)}), 400
+
     except Exception as e:
+        clients.report_failure(f'task_service:{queue_name}', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_task_query(request):
@@ -233,18 +682,24 @@ def handle_task_query(request):
         return jsonify({'error': 'Missing parameter', 'message': 'task_id is required'}), 400
 
     try:
-        # 创建任务服务
-        task_service = TaskService(queue_name=queue_name, location="asia-southeast1")
+        # 获取共享的任务服务
+        task_service = get_task_service(queue_name)
         
         # 查询任务
         task = task_service.query_task(task_id)
         
+        clients.report_success(f'task_service:{queue_name}')
         return jsonify({
             'status': 'success',
             'task': task
         }), 200
         
+    except ValueError as e:
+        # 队列名称不合法
+        return jsonify({'error': 'Invalid parameter', 'message': str(e)}), 400
+
     except Exception as e:
+        clients.report_failure(f'task_service:{queue_name}', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_query_material(request):
@@ -281,8 +736,8 @@ def handle_query_material(request):
                        'message': 'Either material_id or post_id is required'}), 400
 
     try:
-        # 初始化 BigQuery 服务，使用环境变量
-        service = BigqueryReportService()
+        # 获取共享的 BigQuery 服务
+        service = clients.get('report_service')
         
         # 执行查询
         result = service.get_material_metrics(
@@ -292,12 +747,14 @@ def handle_query_material(request):
             end_date=end_date
         )
         
+        clients.report_success('report_service')
         return jsonify({
             'status': 'success',
             'data': result
         }), 200
         
     except Exception as e:
+        clients.report_failure('report_service', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_query_materials(request):
@@ -342,8 +799,8 @@ def handle_query_materials(request):
                        'message': 'post_ids must be a list'}), 400
 
     try:
-        # 初始化 BigQuery 服务，使用环境变量
-        service = BigqueryReportService()
+        # 获取共享的 BigQuery 服务
+        service = clients.get('report_service')
         
         # 执行查询
         results = service.get_materials_metrics(
@@ -353,12 +810,14 @@ def handle_query_materials(request):
             end_date=end_date
         )
         
+        clients.report_success('report_service')
         return jsonify({
             'status': 'success',
             'data': results
         }), 200
         
     except Exception as e:
+        clients.report_failure('report_service', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_query_materials_by_metrics(request):
@@ -398,8 +857,8 @@ def handle_query_materials_by_metrics(request):
                        'message': 'start_date and end_date are required'}), 400
 
     try:
-        # 初始化 BigQuery 服务，使用环境变量
-        service = BigqueryReportService()
+        # 获取共享的 BigQuery 服务
+        service = clients.get('report_service')
         
         # 执行查询
         results = service.search_materials(
@@ -412,12 +871,14 @@ def handle_query_materials_by_metrics(request):
             limit=limit
         )
         
+        clients.report_success('report_service')
         return jsonify({
             'status': 'success',
             'data': results
         }), 200
         
     except Exception as e:
+        clients.report_failure('report_service', e)
         return jsonify({'error': 'Server error', 'message': str(e)}), 500
 
 def handle_query_advertisers_by_post(request):
@@ -446,8 +907,8 @@ def handle_query_advertisers_by_post(request):
         return jsonify({'error': 'Missing parameter', 'message': 'Both start_date and end_date must be provided together'}), 400
 
     try:
-        # 初始化 BigQuery 服务，使用环境变量
-        service = BigqueryReportService()
+        # 获取共享的 BigQuery 服务
+        service = clients.get('report_service')
         
         # 执行查询
         advertisers = service.get_post_advertisers(
@@ -456,6 +917,7 @@ def handle_query_advertisers_by_post(request):
             end_date=end_date
         )
         
+        clients.report_success('report_service')
         return jsonify({
             'status': 'success',
             'data': {
@@ -470,4 +932,32 @@ def handle_query_advertisers_by_post(request):
         }), 200
         
     except Exception as e:
-        return jsonify({'error': 'Server error', 'message': str(e)}), 500
\ No newline at end of file
+        clients.report_failure('report_service', e)
+        return jsonify({'error': 'Server error', 'message': str(e)}), 500
+
+def handle_stats(request):
+    """
+    处理运行统计查询请求，返回当前实例的缓存命中情况、查询向量微批处理情况、提示词缓存节省的 token、限流情况、外部依赖的重试和熔断情况、进程内向量索引（PCA 保留的方差）以及共享客户端的状态。
+        
+    Returns:
+        tuple: (JSON 响应, HTTP 状态码)
+    """
+    query_batcher = get_default_query_batcher()
+    prompt_cache = get_default_prompt_cache()
+    rate_limiter = get_default_rate_limiter()
+    # 延迟导入，未开启进程内向量索引时不加载 numpy
+    from vector_index_helper import get_default_vector_index
+    vector_index = get_default_vector_index()
+    return jsonify({
+        'status': 'success',
+        'data': {
+            'embedding_cache': get_default_embedding_cache().stats(),
+            'search_cache': get_default_search_cache().stats(),
+            'query_batcher': query_batcher.stats() if query_batcher else None,
+            'prompt_cache': prompt_cache.stats() if prompt_cache else None,
+            'rate_limiter': rate_limiter.stats() if rate_limiter else None,
+            'dependencies': get_dependency_stats(),
+            'vector_index': vector_index.stats() if vector_index is not None else None,
+            'clients': clients.health()
+        }
+    }), 200
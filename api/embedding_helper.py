@@ -0,0 +1,273 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from dotenv import load_dotenv
+from resilience_helper import bind_context, get_dependency
+
+load_dotenv()
+
+# 对大量文本做 embedding：
+# 1. 按条数和估算的 token 数切分成多个分片
+# 2. 在有界线程池中并发请求各分片
+# 3. 每个分片经过 embedding 依赖的重试和熔断（见 resilience_helper），失败的分片单独重试
+# 4. 按原始顺序拼回向量
+class EmbeddingBatcher:
+    def __init__(self, genai_client, model: str, max_batch_size: int = None, max_batch_tokens: int = None,
+                 max_workers: int = None, dependency=None):
+        """
+        初始化 EmbeddingBatcher 实例
+
+        Args:
+            genai_client (genai.Client): genai 客户端
+            model (str): embedding 模型名称
+            max_batch_size (int, optional): 每个分片最多的文本条数，默认从环境变量 EMBEDDING_BATCH_SIZE 获取，否则为 100
+            max_batch_tokens (int, optional): 每个分片估算的最大 token 数，默认从环境变量 EMBEDDING_BATCH_TOKENS 获取，否则为 15000
+            max_workers (int, optional): 并发请求的分片数，默认从环境变量 EMBEDDING_MAX_WORKERS 获取，否则为 4
+            dependency (Dependency, optional): 分片请求的重试策略和熔断器，默认使用进程内共享的 embedding 依赖
+        """
+        self.genai_client = genai_client
+        self.model = model
+        self.max_batch_size = max_batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", 100))
+        self.max_batch_tokens = max_batch_tokens or int(os.getenv("EMBEDDING_BATCH_TOKENS", 15000))
+        self.max_workers = max_workers or int(os.getenv("EMBEDDING_MAX_WORKERS", 4))
+        self.dependency = dependency or get_dependency("embedding")
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        """估算文本的 token 数，中日韩文字大约一个字一个 token，按字符数估算偏保守"""
+        return max(1, len(text))
+
+    def split(self, texts: list) -> list:
+        """
+        将文本切分成条数和 token 数都不超过上限的连续分片
+
+        Args:
+            texts (list): 文本列表
+
+        Returns:
+            list: 分片列表，每个分片为 (起始下标, 文本列表)
+        """
+        chunks = []
+        start = 0
+        current = []
+        current_tokens = 0
+        for i, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if current and (len(current) >= self.max_batch_size or current_tokens + tokens > self.max_batch_tokens):
+                chunks.append((start, current))
+                start = i
+                current = []
+                current_tokens = 0
+            current.append(text)
+            current_tokens += tokens
+        if current:
+            chunks.append((start, current))
+        return chunks
+
+    def embed(self, texts: list) -> list:
+        """
+        获取文本的向量
+
+        Args:
+            texts (list): 文本列表
+
+        Returns:
+            list: 与 texts 一一对应的向量列表
+        """
+        if not texts:
+            return []
+
+        chunks = self.split(texts)
+        if len(chunks) == 1:
+            return self._embed_chunk(chunks[0][1])
+
+        vectors = [None] * len(texts)
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(chunks))) as executor:
+            # 工作线程中使用调用方的上下文（请求的截止时间）
+            embed_chunk = bind_context(self._embed_chunk)
+            futures = [(start, executor.submit(embed_chunk, chunk)) for start, chunk in chunks]
+            for start, future in futures:
+                for offset, vector in enumerate(future.result()):
+                    vectors[start + offset] = vector
+        print(f"embedding {len(texts)} 条文本，拆分为 {len(chunks)} 个分片")
+        return vectors
+
+    async def aembed(self, texts: list) -> list:
+        """
+        embed 的异步版本，使用 genai 的异步客户端，最多 max_workers 个分片同时请求
+
+        Args:
+            texts (list): 文本列表
+
+        Returns:
+            list: 与 texts 一一对应的向量列表
+        """
+        if not texts:
+            return []
+
+        chunks = self.split(texts)
+        semaphore = asyncio.Semaphore(self.max_workers)
+
+        async def embed_chunk(chunk):
+            async with semaphore:
+                return await self._aembed_chunk(chunk)
+
+        results = await asyncio.gather(*(embed_chunk(chunk) for _, chunk in chunks))
+        return [vector for chunk_vectors in results for vector in chunk_vectors]
+
+    def _embed_chunk(self, texts: list) -> list:
+        """请求单个分片，临时性错误按 embedding 依赖的策略重试"""
+        def request():
+            response = self.genai_client.models.embed_content(
+                model=self.model,
+                contents=texts
+            )
+            return [list(embedding.values) for embedding in response.embeddings]
+
+        return self.dependency.call(request)
+
+    async def _aembed_chunk(self, texts: list) -> list:
+        """_embed_chunk 的异步版本"""
+        async def request():
+            response = await self.genai_client.aio.models.embed_content(
+                model=self.model,
+                contents=texts
+            )
+            return [list(embedding.values) for embedding in response.embeddings]
+
+        return await self.dependency.acall(request)
+
+
+# 跨请求的查询向量微批处理：
+# 在很短的时间窗口内（或凑满最大批次前）到达的查询字符串合并成一次 embedding 调用，
+# 再把各自的向量交还给等待中的调用方
+class QueryEmbeddingBatcher:
+    def __init__(self, embed_fn, max_wait_ms: float = None, max_batch_size: int = None, max_concurrent_batches: int = 4):
+        """
+        初始化 QueryEmbeddingBatcher 实例
+
+        Args:
+            embed_fn (callable): 批量获取向量的函数，接收文本列表，返回一一对应的向量列表
+            max_wait_ms (float, optional): 凑批的最长等待时间（毫秒），默认从环境变量 QUERY_BATCH_WAIT_MS 获取，否则为 10
+            max_batch_size (int, optional): 每批最多的查询条数，默认从环境变量 QUERY_BATCH_MAX_SIZE 获取，否则为 32
+            max_concurrent_batches (int, optional): 同时进行中的 embedding 调用数
+        """
+        self.embed_fn = embed_fn
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.getenv("QUERY_BATCH_WAIT_MS", 10))) / 1000
+        self.max_batch_size = max_batch_size or int(os.getenv("QUERY_BATCH_MAX_SIZE", 32))
+        self._queue = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_batches)
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        # 统计信息
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.total_queries = 0
+        self.total_queue_delay = 0.0
+        self.max_queue_delay = 0.0
+
+    def embed(self, text: str, timeout: float = None) -> list:
+        """
+        获取单条查询文本的向量，阻塞直到所在批次返回
+
+        Args:
+            text (str): 查询文本
+            timeout (float, optional): 最长等待时间（秒）
+
+        Returns:
+            list: 向量
+        """
+        future = Future()
+        self._queue.put((text, time.monotonic(), future))
+        self._ensure_worker()
+        return future.result(timeout)
+
+    def stats(self) -> dict:
+        """返回批大小分布和排队延迟"""
+        with self._stats_lock:
+            total_batches = sum(self.batch_sizes.values())
+            return {
+                "total_queries": self.total_queries,
+                "total_batches": total_batches,
+                "avg_batch_size": self.total_queries / total_batches if total_batches else 0.0,
+                "batch_size_distribution": dict(sorted(self.batch_sizes.items())),
+                "avg_queue_delay_ms": self.total_queue_delay / self.total_queries * 1000 if self.total_queries else 0.0,
+                "max_queue_delay_ms": self.max_queue_delay * 1000,
+                "pending": self._queue.qsize()
+            }
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._collect, name="query-embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        """后台线程：收集一个批次后交给线程池执行，继续收集下一批"""
+        while True:
+            first = self._queue.get()
+            batch = [first]
+            deadline = first[1] + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._executor.submit(self._dispatch, batch)
+
+    def _dispatch(self, batch: list):
+        dispatched_at = time.monotonic()
+        delays = [dispatched_at - enqueued_at for _, enqueued_at, _ in batch]
+        with self._stats_lock:
+            self.batch_sizes[len(batch)] += 1
+            self.total_queries += len(batch)
+            self.total_queue_delay += sum(delays)
+            self.max_queue_delay = max(self.max_queue_delay, max(delays))
+
+        # 同一批次中相同的查询只请求一次
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        # 每批发出时读取 embed_fn，客户端重建后使用新的函数
+        embed_fn = self.embed_fn
+        try:
+            vectors = dict(zip(texts, embed_fn(texts)))
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        for text, _, future in batch:
+            future.set_result(vectors[text])
+
+
+_default_query_batcher = None
+_default_query_batcher_lock = threading.Lock()
+
+
+def get_default_query_batcher(embed_fn=None):
+    """
+    获取进程内共享的查询向量微批处理实例
+    客户端被重建（ClientRegistry 重建处理器）时，新处理器传入的 embed_fn 替换原来的，之后的批次使用新客户端，
+    排队中的查询和统计信息保留
+
+    Args:
+        embed_fn (callable, optional): 批量 embedding 函数，首次调用时用于创建，之后与当前的不同时替换；
+            不提供且尚未创建时返回 None
+
+    Returns:
+        QueryEmbeddingBatcher: 微批处理实例
+    """
+    global _default_query_batcher
+    with _default_query_batcher_lock:
+        if _default_query_batcher is None:
+            if embed_fn is not None:
+                _default_query_batcher = QueryEmbeddingBatcher(embed_fn)
+        elif embed_fn is not None and embed_fn != _default_query_batcher.embed_fn:
+            _default_query_batcher.embed_fn = embed_fn
+        return _default_query_batcher
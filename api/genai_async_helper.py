@@ -0,0 +1,571 @@
+import asyncio
+import json
+import os
+import time
+from dotenv import load_dotenv
+from google import genai
+from google.genai.types import HttpOptions
+from supabase import acreate_client, create_client
+from cache_helper import (
+    get_default_embedding_cache,
+    get_default_search_cache,
+    search_cache_key,
+)
+from embedding_helper import EmbeddingBatcher
+from model_router_helper import ModelRouter
+from prompt_cache_helper import get_default_prompt_cache, is_invalid_cache_error
+from rate_limit_helper import wrap_genai_client
+from resilience_helper import get_dependency, with_deadline_timeout
+from shot_stream_helper import AsyncStreamingStoryboardPipeline
+from genai_helper import (
+    MATERIAL_AGGREGATE_MODES,
+    MATERIAL_PROCESS_COLUMNS,
+    MAX_SEARCH_PAGE_SIZE,
+    VIDEO_PROCESS_SCHEMA,
+    build_analysis_contents,
+    build_analysis_record,
+    build_batch_item_result,
+    build_index_rows,
+    build_match_params,
+    build_search_page,
+    build_shot_data,
+    build_shot_text,
+    build_status_update,
+    build_video_fingerprint,
+    build_video_part,
+    decode_search_cursor,
+    get_prompt_version,
+    is_unchanged_material,
+    lookup_embeddings,
+    match_storyboard_rows,
+    merge_segment_results,
+    normalize_search_filters,
+    plan_video_segments,
+    validate_video_analysis,
+    search_cursor_digest,
+    storyboard_shot_ids,
+    with_deadline_http_options,
+)
+from vector_index_helper import get_default_vector_index, select_search_index
+
+load_dotenv()
+
+
+# VideoAiProcessor 的异步版本，使用 genai 异步客户端和 Supabase 异步客户端，
+# 视频分析、embedding、数据库读写期间不占用线程，一个实例可以同时处理大量请求。
+# 向量缓存、搜索结果缓存和进程内向量索引与同步版本共享，它们的读写（SQLite、索引检索）在线程中执行，不阻塞事件循环。
+# 请求的构造和结果的组装使用 genai_helper 中与同步版本共用的函数。
+class AsyncVideoAiProcessor:
+    def __init__(self, genai_client, supabase_client, embedding_cache=None, search_cache=None, storage_client=None,
+                 prompt_cache=None, vector_index=None):
+        """
+        初始化 AsyncVideoAiProcessor 实例，一般通过 AsyncVideoAiProcessor.create() 创建
+
+        Args:
+            genai_client (genai.Client): genai 客户端，通过 genai_client.aio 发起异步调用
+            supabase_client (supabase.AsyncClient): Supabase 异步客户端
+            embedding_cache (EmbeddingCache, optional): 向量缓存，默认使用进程内共享实例
+            search_cache (SearchResultCache, optional): 搜索结果缓存，默认使用进程内共享实例
+            storage_client (storage.Client, optional): GCS 客户端，用于计算视频内容指纹，默认首次使用时创建
+            prompt_cache (PromptCacheManager, optional): 提示词上下文缓存，默认使用进程内共享实例（未开启时为 None）
+            vector_index (StoryboardVectorIndex, optional): 进程内向量索引，默认使用进程内共享实例（未开启时为 None）
+        """
+        self.genai_client = wrap_genai_client(genai_client)
+        self.supabase_client = supabase_client
+        # Supabase 和 Gemini 调用的重试策略和熔断器，与同步版本共享
+        self.supabase_dependency = get_dependency("supabase")
+        self.genai_dependency = get_dependency("genai")
+        self._storage_client = storage_client
+        self.analysis_model = "gemini-2.0-flash-001"
+        self.embedding_model = "text-multilingual-embedding-002"
+        self.embedding_batcher = EmbeddingBatcher(self.genai_client, self.embedding_model)
+        self.embedding_cache = embedding_cache or get_default_embedding_cache()
+        self.search_cache = search_cache or get_default_search_cache()
+        self.vector_index = vector_index
+        self.video_process_schema = VIDEO_PROCESS_SCHEMA
+        self.model_router = ModelRouter(self.analysis_model)
+        self.prompt_cache = prompt_cache or get_default_prompt_cache(self.genai_client)
+        # 长视频分段分析的配置，与 VideoAiProcessor 一致
+        self.segment_min_duration = int(os.getenv("VIDEO_SEGMENT_MIN_DURATION", 600))
+        self.segment_window = int(os.getenv("VIDEO_SEGMENT_WINDOW", 300))
+        self.segment_overlap = int(os.getenv("VIDEO_SEGMENT_OVERLAP", 10))
+        self.segment_max_workers = int(os.getenv("VIDEO_SEGMENT_MAX_WORKERS", 4))
+        self.streaming_enabled = os.getenv("VIDEO_STREAMING_ENABLED", "false").lower() == "true"
+        self.streaming_batch_size = int(os.getenv("VIDEO_STREAMING_BATCH_SIZE", 8))
+
+    @classmethod
+    async def create(cls, **kwargs):
+        """
+        创建 genai 客户端和 Supabase 异步客户端，返回处理器实例
+        开启进程内向量索引时，把同步的 Supabase 客户端交给共享索引，索引在后台线程中加载（索引的加载和后台刷新使用同步接口）
+        """
+        genai_client = genai.Client(http_options=HttpOptions(api_version="v1"))
+        supabase_client = await acreate_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+        if os.environ.get("VECTOR_INDEX_ENABLED", "false").lower() == "true":
+            sync_client = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+            get_default_vector_index(sync_client)
+        return cls(genai_client, supabase_client, **kwargs)
+
+    # 获取进程内向量索引，未开启时返回 None；共享索引会被后台重建替换，每次使用时重新获取
+    def get_vector_index(self):
+        return self.vector_index if self.vector_index is not None else get_default_vector_index()
+
+    # 返回与 texts 一一对应的向量列表，已缓存的文本不再调用 API；缓存可能读写 SQLite，在线程中执行
+    async def get_embedding(self, texts: list):
+        keys, vectors, missing = await asyncio.to_thread(
+            lookup_embeddings, self.embedding_cache, self.embedding_model, texts
+        )
+        if missing:
+            new_vectors = dict(zip(missing.keys(), await self.embedding_batcher.aembed(list(missing.values()))))
+            await asyncio.to_thread(self.embedding_cache.set_many, new_vectors)
+            vectors.update(new_vectors)
+
+        return [vectors[key] for key in keys]
+
+    # 分析视频，生成分镜信息，start_offset / end_offset 为分析的时间范围（秒）
+    async def analyze_video(self, video_path: str, start_offset: float = None, end_offset: float = None,
+                            model: str = None):
+        model = model or self.analysis_model
+        uri = f"gs://{video_path}"
+        video_part = build_video_part(uri, start_offset, end_offset)
+
+        async def generate(contents, config):
+            return await self.genai_client.aio.models.generate_content(
+                model=model,
+                contents=contents,
+                config=with_deadline_http_options(config),
+            )
+
+        contents, config, cache_name = await self.build_analysis_request(video_part, model)
+        try:
+            response = await self.genai_dependency.acall(generate, contents, config)
+        except Exception as e:
+            if cache_name is None or not is_invalid_cache_error(e):
+                raise
+            self.prompt_cache.invalidate(model, cache_name)
+            contents, config, cache_name = await self.build_analysis_request(video_part, model, use_cache=False)
+            response = await self.genai_dependency.acall(generate, contents, config)
+        if self.prompt_cache is not None:
+            self.prompt_cache.record_usage(response.usage_metadata, cached=cache_name is not None)
+        print(f"video {video_path} processed by {model}: {response.text}")
+        return json.loads(response.text)
+
+    # 用路由选择的模型分析视频，结果无效时换成更大的模型重试，返回 (分析结果, 实际使用的模型)
+    async def analyze_video_routed(self, video_path: str, model: str, start_offset: float = None,
+                                   end_offset: float = None):
+        while True:
+            try:
+                result = await self.analyze_video(video_path, start_offset, end_offset, model=model)
+                validate_video_analysis(result)
+                return result, model
+            except ValueError as e:
+                larger = self.model_router.escalate(model)
+                if larger is None:
+                    raise
+                print(f"video {video_path} 使用 {model} 的分析结果无效，换成 {larger} 重试: {e}")
+                model = larger
+
+    # 构造视频分析请求，与 VideoAiProcessor.build_analysis_request 一致，创建或延长缓存在线程中执行
+    async def build_analysis_request(self, video_part, model: str, use_cache: bool = True):
+        cache_name = None
+        if use_cache and self.prompt_cache is not None:
+            cache_name = await asyncio.to_thread(self.prompt_cache.get, model)
+        contents, config = build_analysis_contents(video_part, self.video_process_schema, cache_name)
+        return contents, config, cache_name
+
+    # 流式分析视频，逐段返回生成的 JSON 文本
+    async def analyze_video_stream(self, video_path: str, model: str = None):
+        model = model or self.analysis_model
+        uri = f"gs://{video_path}"
+        video_part = build_video_part(uri)
+
+        async def open_stream(contents, config):
+            stream = await self.genai_client.aio.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=with_deadline_http_options(config),
+            )
+            return stream, await anext(stream, None)
+
+        contents, config, cache_name = await self.build_analysis_request(video_part, model)
+        try:
+            stream, chunk = await self.genai_dependency.acall(open_stream, contents, config)
+        except Exception as e:
+            if cache_name is None or not is_invalid_cache_error(e):
+                raise
+            self.prompt_cache.invalidate(model, cache_name)
+            contents, config, cache_name = await self.build_analysis_request(video_part, model, use_cache=False)
+            stream, chunk = await self.genai_dependency.acall(open_stream, contents, config)
+
+        usage_metadata = None
+        while chunk is not None:
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            if chunk.text:
+                yield chunk.text
+            chunk = await anext(stream, None)
+        if self.prompt_cache is not None:
+            self.prompt_cache.record_usage(usage_metadata, cached=cache_name is not None)
+
+    # 流式分析视频并保存分镜，流程与 VideoAiProcessor.analyze_and_store_streaming 一致
+    async def analyze_and_store_streaming(self, material_id: int, video_path: str, model: str = None):
+        model = model or self.analysis_model
+        started = time.monotonic()
+        pipeline = AsyncStreamingStoryboardPipeline(self, batch_size=self.streaming_batch_size)
+        while True:
+            try:
+                result = await pipeline.run(material_id, self.analyze_video_stream(video_path, model),
+                                            validate=validate_video_analysis)
+                break
+            except ValueError as e:
+                larger = self.model_router.escalate(model)
+                if larger is None:
+                    raise
+                print(f"video {video_path} 使用 {model} 的分析结果无效，换成 {larger} 重试: {e}")
+                model = larger
+        print(f"video {video_path} 流式处理完成，{len(result['shots'])} 个镜头，耗时 {time.monotonic() - started:.1f} 秒")
+        return result, model
+
+    # 是否对该时长的视频分段分析
+    def should_segment(self, duration) -> bool:
+        return bool(self.segment_min_duration and duration and duration > self.segment_min_duration)
+
+    # 分段分析长视频，最多同时分析 segment_max_workers 个窗口，流程与 VideoAiProcessor.analyze_video_segmented 一致
+    async def analyze_video_segmented(self, video_path: str, duration: float, model: str = None):
+        model = model or self.analysis_model
+        segments = plan_video_segments(duration, self.segment_window, self.segment_overlap)
+        if len(segments) == 1:
+            return await self.analyze_video_routed(video_path, model)
+
+        started = time.monotonic()
+        semaphore = asyncio.Semaphore(self.segment_max_workers)
+
+        async def analyze_one(start, end):
+            async with semaphore:
+                return await self.analyze_video_routed(video_path, model, start, end)
+
+        outputs = await asyncio.gather(*(analyze_one(start, end) for start, end in segments))
+        result = merge_segment_results(segments, [output[0] for output in outputs])
+        print(f"video {video_path} 分 {len(segments)} 段分析完成，合并后 {len(result['shots'])} 个镜头，"
+              f"耗时 {time.monotonic() - started:.1f} 秒")
+        return result, self.model_router.largest([output[1] for output in outputs])
+
+    # 获取视频的内容指纹，GCS 客户端没有异步接口，在线程中执行；失败时返回 None
+    async def get_video_fingerprint(self, video_path: str, model: str = None):
+        def fingerprint():
+            if self._storage_client is None:
+                from google.cloud import storage
+                self._storage_client = storage.Client()
+            return build_video_fingerprint(self._storage_client, video_path, model or self.analysis_model,
+                                           self.embedding_model, get_prompt_version(self.prompt_cache))
+
+        try:
+            return await asyncio.to_thread(fingerprint)
+        except Exception as e:
+            print(f"获取视频 {video_path} 的指纹失败：{e}")
+            return None
+
+    # 执行 Supabase 查询，重试和熔断与 VideoAiProcessor._execute 一致
+    async def _execute(self, query):
+        return await self.supabase_dependency.acall(with_deadline_timeout(query).execute)
+
+    # 读取指纹一致的已保存分析结果作为检查点，与 VideoAiProcessor.load_analysis 一致
+    async def load_analysis(self, material_id: int, fingerprint: str):
+        if fingerprint is None:
+            return None
+        response = await self._execute(
+            self.supabase_client.table("video_analysis")
+            .select("raw, analysis_model")
+            .eq("material_id", material_id)
+            .eq("fingerprint", fingerprint)
+            .limit(1)
+        )
+        if not response.data:
+            return None
+        return response.data[0]["raw"], response.data[0]["analysis_model"]
+
+    # 保存完整的分析结果，与 VideoAiProcessor.save_analysis 一致
+    async def save_analysis(self, material_id: int, result: dict, fingerprint: str = None, model: str = None,
+                            routing: dict = None):
+        await self._execute(self.supabase_client.table("video_analysis").upsert(
+            build_analysis_record(material_id, result, fingerprint, model or self.analysis_model, routing,
+                                  get_prompt_version(self.prompt_cache))
+        ))
+
+    # 统计素材已保存的分镜数
+    async def count_storyboard(self, material_id: int) -> int:
+        response = await self._execute(
+            self.supabase_client.table("video_storyboard")
+            .select("shot_id", count="exact")
+            .eq("material_id", material_id)
+            .limit(1)
+        )
+        return response.count or 0
+
+    # 在一个事务中替换某个素材的所有分镜信息，返回新分镜的 shot_id 列表
+    async def replace_storyboard(self, material_id: int, shots: list):
+        response = await self._execute(self.supabase_client.rpc(
+            "replace_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_shots": shots
+            }
+        ))
+        pairs = match_storyboard_rows(shots, response.data)
+        self.search_cache.invalidate()
+
+        # 同步更新进程内向量索引
+        await self.update_index_for_material(material_id, pairs)
+
+        print(f"已替换素材 {material_id} 的分镜信息，共 {len(shots)} 个镜头")
+        return storyboard_shot_ids(response.data, pairs)
+
+    # 流式处理时写入一批分镜到暂存表
+    async def stage_storyboard(self, material_id: int, run_id: str, shots: list):
+        await self._execute(self.supabase_client.rpc(
+            "stage_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_run_id": run_id,
+                "p_shots": shots
+            }
+        ))
+
+    # 发布暂存的分镜，一次性替换素材的所有分镜信息，没有镜头时直接清空素材的分镜
+    async def publish_storyboard(self, material_id: int, run_id: str, shots: list):
+        if not shots:
+            return await self.replace_storyboard(material_id, [])
+        response = await self._execute(self.supabase_client.rpc(
+            "publish_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_run_id": run_id
+            }
+        ))
+        pairs = match_storyboard_rows(shots, response.data, key="seq")
+        self.search_cache.invalidate()
+
+        await self.update_index_for_material(material_id, pairs)
+
+        print(f"已发布素材 {material_id} 的分镜信息，共 {len(response.data)} 个镜头")
+        return storyboard_shot_ids(response.data, pairs)
+
+    # 更新进程内向量索引中该素材的分镜，与 VideoAiProcessor.update_index_for_material 一致
+    async def update_index_for_material(self, material_id: int, pairs):
+        vector_index = self.get_vector_index()
+        if vector_index is None:
+            return
+        if pairs is None:
+            print(f"素材 {material_id} 返回的分镜与本次写入的不一致（已被其它处理替换），跳过向量索引的更新")
+            return
+        await asyncio.to_thread(vector_index.replace_material, material_id, build_index_rows(material_id, pairs))
+
+    # 清除流式处理失败时暂存的分镜
+    async def discard_staging(self, run_id: str):
+        try:
+            await self._execute(self.supabase_client.table("video_storyboard_staging").delete().eq("run_id", run_id))
+        except Exception as e:
+            print(f"清除暂存分镜 {run_id} 失败: {e}")
+
+    # 清除某个素材的所有分镜信息
+    async def clear_storyboard(self, material_id: int):
+        await self._execute(self.supabase_client.table("video_storyboard").delete().eq("material_id", material_id))
+        self.search_cache.invalidate()
+        vector_index = self.get_vector_index()
+        if vector_index is not None:
+            await asyncio.to_thread(vector_index.remove_material, material_id)
+        print(f"已清除素材 {material_id} 的所有分镜信息")
+
+    # 根据关键词搜索视频分镜信息
+    async def semantic_search(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                              ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+        cache_key = search_cache_key(query_str, match_threshold, match_count,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = (await self.get_embedding([query_str]))[0]
+        vector_index = select_search_index(self.get_vector_index(), filters)
+        if vector_index is not None:
+            results = await asyncio.to_thread(vector_index.search, embedding_vector, match_threshold, match_count)
+        else:
+            response = await self._execute(self.supabase_client.rpc(
+                "match_videos",
+                build_match_params(embedding_vector, match_threshold, match_count,
+                                   ef_search=ef_search, probes=probes, filters=filters)
+            ))
+            results = response.data
+
+        self.search_cache.set(cache_key, results, cache_version)
+        return results
+
+    # 按素材聚合的语义搜索，参数与 VideoAiProcessor.semantic_search_materials 一致
+    async def semantic_search_materials(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                                        aggregate_mode: str = "max", top_n: int = 3, shots_per_material: int = 3,
+                                        ef_search: int = None, probes: int = None, filters: dict = None):
+        if aggregate_mode not in MATERIAL_AGGREGATE_MODES:
+            raise ValueError(f"aggregate_mode must be one of {', '.join(MATERIAL_AGGREGATE_MODES)}")
+        filters = normalize_search_filters(filters)
+
+        cache_key = search_cache_key(query_str, match_threshold, match_count, group_by="material",
+                                     aggregate_mode=aggregate_mode, top_n=top_n, shots_per_material=shots_per_material,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = (await self.get_embedding([query_str]))[0]
+        response = await self._execute(self.supabase_client.rpc(
+            "match_materials",
+            build_match_params(embedding_vector, match_threshold, match_count,
+                               aggregate_mode=aggregate_mode, top_n=top_n, shots_per_material=shots_per_material,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        self.search_cache.set(cache_key, response.data, cache_version)
+        return response.data
+
+    # 混合检索，参数与 VideoAiProcessor.semantic_search_hybrid 一致
+    async def semantic_search_hybrid(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                                     candidate_count: int = 100, rrf_k: int = 60,
+                                     ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+
+        cache_key = search_cache_key(query_str, match_threshold, match_count, mode="hybrid",
+                                     candidate_count=candidate_count, rrf_k=rrf_k,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = (await self.get_embedding([query_str]))[0]
+        response = await self._execute(self.supabase_client.rpc(
+            "match_videos_hybrid",
+            build_match_params(embedding_vector, match_threshold, match_count, query_text=query_str,
+                               candidate_count=candidate_count, rrf_k=rrf_k,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        self.search_cache.set(cache_key, response.data, cache_version)
+        return response.data
+
+    # 分页的语义搜索，参数和返回值与 VideoAiProcessor.semantic_search_page 一致
+    async def semantic_search_page(self, query_str: str, match_threshold: float = 0.7, page_size: int = 20,
+                                   cursor: str = None, ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+        page_size = min(page_size, MAX_SEARCH_PAGE_SIZE)
+        digest = search_cursor_digest(query_str, match_threshold, filters)
+        after_similarity, after_shot_id = decode_search_cursor(cursor, digest) if cursor else (None, None)
+
+        cache_key = search_cache_key(query_str, match_threshold, page_size, cursor=cursor,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = (await self.get_embedding([query_str]))[0]
+        response = await self._execute(self.supabase_client.rpc(
+            "match_videos_page",
+            build_match_params(embedding_vector, match_threshold, page_size=page_size,
+                               after_similarity=after_similarity, after_shot_id=after_shot_id,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        page = build_search_page(response.data, page_size, digest)
+        self.search_cache.set(cache_key, page, cache_version)
+        return page
+
+    # 逐页返回搜索结果，与 VideoAiProcessor.iter_semantic_search_pages 一致
+    async def iter_semantic_search_pages(self, query_str: str, match_threshold: float = 0.7, page_size: int = 50,
+                                         max_results: int = 1000, cursor: str = None, **options):
+        remaining = max_results
+        while remaining > 0:
+            page = await self.semantic_search_page(query_str, match_threshold, min(page_size, remaining), cursor, **options)
+            yield page
+            remaining -= len(page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    # 更新素材处理状态
+    async def update_material_status(self, material_id: int, status: str, msg: str = None, fingerprint: str = None):
+        update_data = build_status_update(status, msg, fingerprint)
+        await self._execute(self.supabase_client.table("material").update(update_data).eq("material_id", material_id))
+        print(f"素材 {material_id} 的状态已更新为 {status}" + (f"，消息：{msg}" if msg else ""))
+
+    # 为分析结果中的每个镜头生成向量，一次性替换素材的所有分镜信息
+    async def store_storyboard(self, material_id: int, result: dict):
+        texts_to_embed = [build_shot_text(shot) for shot in result["shots"]]
+        embeddings = await self.get_embedding(texts_to_embed)
+        shots_data = [build_shot_data(shot, embeddings[i]) for i, shot in enumerate(result["shots"])]
+
+        await self.replace_storyboard(material_id, shots_data)
+
+    # 分析视频，生成分镜信息，并保存到数据库，流程与 VideoAiProcessor.run 一致
+    async def run(self, material_id: int, video_path: str, force: bool = False):
+        try:
+            material = await self._execute(
+                self.supabase_client.table("material")
+                .select(MATERIAL_PROCESS_COLUMNS)
+                .eq("material_id", material_id)
+            )
+            if len(material.data) == 0:
+                raise ValueError(f"material_id {material_id} not found")
+            previous = material.data[0]
+
+            routing = self.model_router.route(previous)
+            print(f"素材 {material_id} 使用模型 {routing['model']}（{routing['reason']}）")
+
+            fingerprint = await self.get_video_fingerprint(video_path, routing["model"])
+            if is_unchanged_material(previous, fingerprint, force):
+                processed_shots = await self.count_storyboard(material_id)
+                print(f"素材 {material_id} 的视频没有变化，跳过分析，已有 {processed_shots} 个镜头")
+                return processed_shots
+
+            await self.update_material_status(material_id, "Processing")
+
+            checkpoint = None if force else await self.load_analysis(material_id, fingerprint)
+            if checkpoint is not None:
+                result, model = checkpoint
+                print(f"素材 {material_id} 复用已保存的分析结果（{model}），跳过视频分析")
+                await self.store_storyboard(material_id, result)
+            elif not self.should_segment(previous["duration"]) and self.streaming_enabled:
+                result, model = await self.analyze_and_store_streaming(material_id, video_path, routing["model"])
+                await self.save_analysis(material_id, result, fingerprint, model, dict(routing, used_model=model))
+            else:
+                if self.should_segment(previous["duration"]):
+                    result, model = await self.analyze_video_segmented(video_path, previous["duration"],
+                                                                       routing["model"])
+                else:
+                    result, model = await self.analyze_video_routed(video_path, routing["model"])
+                await self.save_analysis(material_id, result, fingerprint, model, dict(routing, used_model=model))
+                await self.store_storyboard(material_id, result)
+            await self.update_material_status(material_id, "Completed", fingerprint=fingerprint)
+
+            return len(result["shots"])
+
+        except Exception as e:
+            try:
+                await self.update_material_status(material_id, "Failed", str(e))
+            except Exception as status_error:
+                print(f"更新素材 {material_id} 的失败状态失败: {status_error}")
+            raise e
+
+    # 批量处理多个素材，最多 max_concurrency 个素材同时处理，返回格式与 VideoAiProcessor.run_batch 一致
+    async def run_batch(self, materials: list, max_concurrency: int = 4, force: bool = False):
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_one(item):
+            async with semaphore:
+                try:
+                    return build_batch_item_result(item, await self.run(item["material_id"], item["video_path"],
+                                                                        item.get("force", force)))
+                except Exception as e:
+                    return build_batch_item_result(item, error=e)
+
+        return await asyncio.gather(*(run_one(item) for item in materials))
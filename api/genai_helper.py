@@ -2,125 +2,994 @@ import os
 from supabase import create_client, Client
 from dotenv import load_dotenv
 from google import genai
-from google.genai.types import HttpOptions, Part
+from google.genai.types import FileData, HttpOptions, Part, VideoMetadata
+from google.cloud import storage
 import json
+import base64
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timezone
 from prompt import PROCESS_VIDEO_PROMPT
+from cache_helper import (
+    embedding_cache_key,
+    get_default_embedding_cache,
+    get_default_search_cache,
+    search_cache_key,
+)
+from embedding_helper import EmbeddingBatcher, get_default_query_batcher
+from model_router_helper import ModelRouter
+from prompt_cache_helper import build_cached_instruction, get_default_prompt_cache, is_invalid_cache_error
+from rate_limit_helper import wrap_genai_client
+from resilience_helper import DeadlineExceeded, bind_context, get_dependency, remaining_time, with_deadline_timeout
+from shot_stream_helper import StreamingStoryboardPipeline
+from vector_index_helper import get_default_vector_index, select_search_index
 
 load_dotenv()
 
-
-# 提供对视频进行AI处理的功能，包括：
-# 1. 分析视频生成分镜信息并插入数据库
-# 2. 根据关键词搜索视频分镜信息
-class VideoAiProcessor:
-    def __init__(self):
-        self.genai_client = genai.Client(http_options=HttpOptions(api_version="v1"))
-        self.supabase_client = create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
-        self.video_process_schema = {
+# 视频分析结果的 JSON schema
+VIDEO_PROCESS_SCHEMA = {
+    "type": "object",
+    "required": ["video_brief", "shots"],
+    "properties": {
+        "video_brief": {
+            "type": "string",
+            "description": "视频简介"
+        },
+        "metadata": {
             "type": "object",
-            "required": ["video_brief", "shots"],
-            "properties": {
-                "video_brief": {
-                "type": "string",
-                "description": "视频简介"
-                },
-                "metadata": {
+            "description": "视频基本信息, JSON格式"
+        },
+        "shots": {
+            "type": "array",
+            "description": "分镜信息",
+            "items": {
                 "type": "object",
-                "description": "视频基本信息, JSON格式"
-                },
-                "shots": {
-                "type": "array",
-                "description": "分镜信息",
-                "items": {
-                    "type": "object",
-                    "properties": {
-                        "start_time": {
-                            "type": "number",
-                            "description": "镜头开始时间（秒）"
-                        },
-                        "end_time": {
-                            "type": "number",
-                            "description": "镜头结束时间（秒）"
-                        },
-                        "shot_content": {
-                            "type": "string",
-                            "description": "镜头内容描述"
-                        },
-                        "subtitle": {
-                            "type": "string",
-                            "description": "字幕内容"
-                        },
-                        "narration": {
-                            "type": "string",
-                            "description": "旁白内容"
-                        },
-                        "tags": {
-                            "type": "object",
-                            "description": "标签, JSON格式"
-                        }
+                "properties": {
+                    "start_time": {
+                        "type": "number",
+                        "description": "镜头开始时间（秒）"
+                    },
+                    "end_time": {
+                        "type": "number",
+                        "description": "镜头结束时间（秒）"
+                    },
+                    "shot_content": {
+                        "type": "string",
+                        "description": "镜头内容描述"
                     },
-                    "required": ["start_time", "end_time"]
-                }
-                }
+                    "subtitle": {
+                        "type": "string",
+                        "description": "字幕内容"
+                    },
+                    "narration": {
+                        "type": "string",
+                        "description": "旁白内容"
+                    },
+                    "tags": {
+                        "type": "object",
+                        "description": "标签, JSON格式"
+                    }
+                },
+                "required": ["start_time", "end_time"]
             }
         }
+    }
+}
+
+
+# 提示词和 schema 的版本，任一变化后已分析过的视频需要重新分析
+PROMPT_VERSION = hashlib.sha256(
+    (PROCESS_VIDEO_PROMPT + json.dumps(VIDEO_PROCESS_SCHEMA, sort_keys=True, ensure_ascii=False)).encode("utf-8")
+).hexdigest()[:12]
+
+# 开启提示词缓存时模型的输入是缓存的系统指令加视频，与不使用缓存时（视频 + 提示词）不同，使用单独的提示词版本
+CACHED_PROMPT_VERSION = hashlib.sha256(
+    build_cached_instruction(PROCESS_VIDEO_PROMPT, VIDEO_PROCESS_SCHEMA).encode("utf-8")
+).hexdigest()[:12]
+
+
+# 返回写入指纹和分析结果的提示词版本，prompt_cache 为处理器使用的提示词缓存（未开启时为 None）
+def get_prompt_version(prompt_cache) -> str:
+    return PROMPT_VERSION if prompt_cache is None else CACHED_PROMPT_VERSION
+
+
+# 计算视频的内容指纹：GCS 对象的 generation + md5，加上分析模型、embedding 模型和提示词版本
+# 视频文件被覆盖时 generation 会变化；对象不存在时返回 None
+def build_video_fingerprint(storage_client, video_path: str, analysis_model: str, embedding_model: str,
+                            prompt_version: str = PROMPT_VERSION):
+    bucket_name, _, blob_name = video_path.partition("/")
+    blob = storage_client.bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        return None
+    payload = {
+        "object": video_path,
+        "generation": blob.generation,
+        # 复合对象没有 md5，使用 crc32c
+        "checksum": blob.md5_hash or blob.crc32c,
+        "analysis_model": analysis_model,
+        "embedding_model": embedding_model,
+        "prompt_version": prompt_version
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+# 构造视频输入，指定时间范围时只分析该范围内的内容
+def build_video_part(uri: str, start_offset: float = None, end_offset: float = None) -> Part:
+    if start_offset is None and end_offset is None:
+        return Part.from_uri(file_uri=uri, mime_type="video/mp4")
+    return Part(
+        file_data=FileData(file_uri=uri, mime_type="video/mp4"),
+        video_metadata=VideoMetadata(
+            start_offset=f"{start_offset}s" if start_offset is not None else None,
+            end_offset=f"{end_offset}s" if end_offset is not None else None
+        )
+    )
+
+
+# 构造视频分析请求的 (contents, config)，cache_name 为可用的提示词缓存，为 None 时在请求中发送提示词
+# VideoAiProcessor 和 AsyncVideoAiProcessor 共用，两者发送的请求保持一致
+def build_analysis_contents(video_part: Part, schema: dict, cache_name: str = None) -> tuple:
+    config = {
+        "response_mime_type": "application/json",
+        "response_schema": schema,
+    }
+    if cache_name is None:
+        return [video_part, PROCESS_VIDEO_PROMPT], config
+    config["cached_content"] = cache_name
+    return [video_part], config
+
+
+# 设置了请求截止时间时，把剩余时间作为 Gemini 调用的 HTTP 超时（毫秒），每次调用（包括重试）时重新计算
+def with_deadline_http_options(config: dict) -> dict:
+    timeout = remaining_time()
+    if timeout is None:
+        return config
+    return dict(config, http_options={"timeout": max(int(timeout * 1000), 100)})
+
+
+# 在向量缓存中查找 texts 的向量，返回 (缓存键列表, 已命中的 {缓存键: 向量}, 未命中的 {缓存键: 文本})，未命中的文本已去重
+def lookup_embeddings(embedding_cache, embedding_model: str, texts: list) -> tuple:
+    keys = [embedding_cache_key(embedding_model, text) for text in texts]
+    vectors = embedding_cache.get_many(keys)
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in vectors and key not in missing:
+            missing[key] = text
+    return keys, vectors, missing
+
+
+# 拼接单个 shot 用于 embedding 的文本
+def build_shot_text(shot: dict) -> str:
+    shot_text = ""
+    if "shot_content" in shot and shot["shot_content"]:
+        shot_text += shot["shot_content"] + "\n"
+    if "subtitle" in shot and shot["subtitle"]:
+        shot_text += shot["subtitle"] + "\n"
+    if "narration" in shot and shot["narration"]:
+        shot_text += shot["narration"]
+    return shot_text.strip()
+
+
+# 组装单个 shot 写入 video_storyboard 的数据
+def build_shot_data(shot: dict, content_vector: list) -> dict:
+    shot_data = {
+        "start_time": shot["start_time"],
+        "end_time": shot["end_time"],
+        "content_vector": content_vector
+    }
+
+    # 添加可选字段
+    if "shot_content" in shot and shot["shot_content"]:
+        shot_data["shot_content"] = shot["shot_content"]
+    if "subtitle" in shot and shot["subtitle"]:
+        shot_data["subtitle"] = shot["subtitle"]
+    if "narration" in shot and shot["narration"]:
+        shot_data["narration"] = shot["narration"]
+    if "tags" in shot and shot["tags"]:
+        shot_data["tags"] = shot["tags"]
+    return shot_data
+
+
+# 按 replace_storyboard 返回的 idx（分镜在 shots 中的位置）或 publish_storyboard 返回的 seq 对应写入的分镜和返回的行，
+# 结果按位置排序；数据库还没执行迁移 014、返回的行没有位置字段时按返回顺序对应。
+# 返回的行与 shots 对不上时返回 None：重试的发布返回的是素材当前的分镜，期间其它处理可能已经替换了它们
+def match_storyboard_rows(shots: list, rows: list, key: str = "idx"):
+    if len(rows) != len(shots):
+        return None
+    if not rows or not all(key in row for row in rows):
+        return list(zip(shots, rows))
+    if key == "seq":
+        by_position = {shot["seq"]: shot for shot in shots}
+    else:
+        by_position = dict(enumerate(shots))
+    if any(row[key] not in by_position for row in rows):
+        return None
+    return [(by_position[row[key]], row) for row in sorted(rows, key=lambda row: row[key])]
+
+
+# 写入分镜后返回的 shot_id 列表，pairs 为 match_storyboard_rows 的结果，对不上时按 shot_id 排序
+def storyboard_shot_ids(rows: list, pairs) -> list:
+    if pairs is None:
+        return sorted(row["shot_id"] for row in rows)
+    return [row["shot_id"] for _, row in pairs]
+
+
+# 合并写入的分镜和返回的 shot_id、created_at，得到向量索引的行，pairs 为 match_storyboard_rows 的结果
+# 暂存分镜中的 seq 只用于排序，不写入索引
+def build_index_rows(material_id: int, pairs: list) -> list:
+    return [
+        dict({k: v for k, v in shot.items() if k != "seq"}, material_id=material_id,
+             shot_id=row["shot_id"], created_at=row["created_at"])
+        for shot, row in pairs
+    ]
+
+
+# 处理视频时读取的素材字段
+MATERIAL_PROCESS_COLUMNS = "material_id, duration, file_size, resolution, ai_process_status, ai_process_fingerprint"
+
+
+# 视频内容指纹与上次成功处理时一致，可以跳过分析
+def is_unchanged_material(material: dict, fingerprint: str, force: bool = False) -> bool:
+    return (not force and fingerprint is not None and material["ai_process_status"] == "Completed"
+            and material["ai_process_fingerprint"] == fingerprint)
+
+
+# 更新素材处理状态时写入的字段，msg / fingerprint 为 None 时不修改
+def build_status_update(status: str, msg: str = None, fingerprint: str = None) -> dict:
+    update_data = {"ai_process_status": status}
+    if msg is not None:
+        update_data["ai_process_msg"] = msg
+    if fingerprint is not None:
+        update_data["ai_process_fingerprint"] = fingerprint
+    return update_data
+
+
+# 写入 video_analysis 的完整分析结果
+def build_analysis_record(material_id: int, result: dict, fingerprint: str, model: str, routing: dict,
+                          prompt_version: str = PROMPT_VERSION) -> dict:
+    return {
+        "material_id": material_id,
+        "fingerprint": fingerprint,
+        "analysis_model": model,
+        "routing": routing,
+        "prompt_version": prompt_version,
+        "video_brief": result.get("video_brief"),
+        "metadata": result.get("metadata"),
+        "raw": result,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+# 批量处理时单个素材的结果，error 为 None 时表示成功
+def build_batch_item_result(item: dict, processed_shots: int = 0, error: Exception = None) -> dict:
+    result = {
+        "material_id": item["material_id"],
+        "video_path": item["video_path"],
+        "status": "success" if error is None else "failed",
+        "processed_shots": processed_shots
+    }
+    if error is not None:
+        result["error"] = str(error)
+    return result
+
+
+# 校验分析结果是否符合 VIDEO_PROCESS_SCHEMA 的必需字段，不符合时抛出 ValueError
+def validate_video_analysis(result) -> None:
+    if not isinstance(result, dict):
+        raise ValueError("analysis result must be an object")
+    if not isinstance(result.get("video_brief"), str):
+        raise ValueError("analysis result is missing video_brief")
+    shots = result.get("shots")
+    if not isinstance(shots, list):
+        raise ValueError("analysis result is missing shots")
+    for i, shot in enumerate(shots):
+        if not isinstance(shot, dict):
+            raise ValueError(f"shot {i} must be an object")
+        start_time, end_time = shot.get("start_time"), shot.get("end_time")
+        if not isinstance(start_time, (int, float)) or not isinstance(end_time, (int, float)):
+            raise ValueError(f"shot {i} is missing start_time or end_time")
+        if start_time < 0 or end_time < start_time:
+            raise ValueError(f"shot {i} has an invalid time range {start_time}-{end_time}")
+
+
+# 把长视频切分成有重叠的时间窗口，返回 [(start, end), ...]（秒）
+# 相邻窗口重叠 overlap 秒，避免窗口边界处的镜头被截断；不超过 window 秒的视频只有一个窗口
+def plan_video_segments(duration: float, window: float, overlap: float) -> list:
+    if overlap >= window:
+        raise ValueError("overlap must be smaller than window")
+    segments = []
+    start = 0
+    while True:
+        end = min(start + window, duration)
+        segments.append((start, end))
+        if end >= duration:
+            return segments
+        start += window - overlap
+
+
+# 合并各窗口的分析结果：
+# 1. 窗口内的时间戳相对窗口开始时间时，加上窗口的偏移量换算成整段视频的时间
+# 2. 相邻窗口重叠部分的镜头会被分析两次，以重叠区间的中点为界，每个镜头只保留在其中点所属的窗口中
+# 3. 跨越分界点的镜头在两个窗口中可能被截成不同的长度，中点落在分界点两侧，
+#    来自不同窗口、重叠超过较短镜头一半的两个镜头视为同一个，保留较长的
+# 4. 按开始时间排序；视频简介按窗口顺序拼接，视频基本信息取第一个窗口
+def merge_segment_results(segments: list, results: list, tolerance: float = 2) -> dict:
+    candidates = []
+    for i, ((start, end), result) in enumerate(zip(segments, results)):
+        own_start = (segments[i - 1][1] + start) / 2 if i > 0 else float("-inf")
+        own_end = (end + segments[i + 1][0]) / 2 if i + 1 < len(segments) else float("inf")
+
+        # 模型可能返回相对窗口的时间，也可能直接返回整段视频的时间：
+        # 所有镜头都落在窗口长度以内时按相对时间处理
+        segment_shots = result.get("shots") or []
+        relative = all(shot["end_time"] <= end - start + tolerance for shot in segment_shots)
+        offset = start if relative else 0
+
+        for shot in segment_shots:
+            shot = dict(shot, start_time=shot["start_time"] + offset, end_time=shot["end_time"] + offset)
+            midpoint = (shot["start_time"] + shot["end_time"]) / 2
+            if own_start <= midpoint < own_end:
+                candidates.append((i, shot))
+
+    candidates.sort(key=lambda item: (item[1]["start_time"], item[1]["end_time"]))
+    shots = []
+    last_segment = None
+    for i, shot in candidates:
+        if shots and i != last_segment:
+            previous = shots[-1]
+            overlap = min(previous["end_time"], shot["end_time"]) - max(previous["start_time"], shot["start_time"])
+            shorter = min(previous["end_time"] - previous["start_time"], shot["end_time"] - shot["start_time"])
+            if overlap > 0 and overlap >= shorter / 2:
+                if shot["end_time"] - shot["start_time"] > previous["end_time"] - previous["start_time"]:
+                    shots[-1] = shot
+                    last_segment = i
+                continue
+        shots.append(shot)
+        last_segment = i
+
+    return {
+        "video_brief": "\n".join(result["video_brief"] for result in results if result.get("video_brief")),
+        "metadata": results[0].get("metadata") if results else None,
+        "shots": shots
+    }
+
+
+# match_videos 支持的素材过滤条件
+SEARCH_FILTER_LIST_FIELDS = ("material_type", "target_country", "labels")
+
+
+# 校验并规范化语义搜索的过滤条件：字符串统一转为数组，空条件返回 None，不支持的字段抛出 ValueError
+def normalize_search_filters(filters: dict):
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+
+    unknown = set(filters) - set(SEARCH_FILTER_LIST_FIELDS) - {"tags", "include_deleted"}
+    if unknown:
+        raise ValueError(f"unsupported filter fields: {', '.join(sorted(unknown))}")
+
+    normalized = {}
+    for field in SEARCH_FILTER_LIST_FIELDS:
+        value = filters.get(field)
+        if value is None or value == []:
+            continue
+        if isinstance(value, str):
+            value = [value]
+        if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+            raise ValueError(f"filter {field} must be a string or a list of strings")
+        normalized[field] = value
+
+    if filters.get("tags") is not None:
+        if not isinstance(filters["tags"], (dict, list)):
+            raise ValueError("filter tags must be an object or a list")
+        normalized["tags"] = filters["tags"]
+
+    if filters.get("include_deleted") is not None:
+        if not isinstance(filters["include_deleted"], bool):
+            raise ValueError("filter include_deleted must be a boolean")
+        normalized["include_deleted"] = filters["include_deleted"]
+
+    return normalized or None
+
+
+# match_materials 支持的素材打分方式
+MATERIAL_AGGREGATE_MODES = ("max", "mean_top_n")
+
+
+# 组装 match_videos / match_materials / match_videos_page 的调用参数，值为 None 的可选参数不传，使用数据库端的默认值
+def build_match_params(embedding_vector: list, match_threshold: float, match_count: int = None, **options) -> dict:
+    options["match_count"] = match_count
+    params = {
+        "query_embedding": embedding_vector,
+        "match_threshold": match_threshold
+    }
+    params.update({name: value for name, value in options.items() if value is not None})
+    return params
+
+
+# 倒数排名融合（Reciprocal Rank Fusion）：把多个查询的结果列表合并为一个排名
+# 每个分镜的得分为 sum(1 / (k + 排名))，排名从 1 开始；返回的分镜附带 rrf_score 和命中的查询下标 matched_queries
+def reciprocal_rank_fusion(result_lists: list, k: int = 60, limit: int = None, key: str = "shot_id") -> list:
+    fused = {}
+    for query_index, results in enumerate(result_lists):
+        for rank, row in enumerate(results, start=1):
+            item = fused.get(row[key])
+            if item is None:
+                item = fused[row[key]] = dict(row, rrf_score=0.0, matched_queries=[])
+            item["rrf_score"] += 1.0 / (k + rank)
+            item["matched_queries"].append(query_index)
+            # 保留各查询中最高的相似度
+            if "similarity" in row:
+                item["similarity"] = max(item["similarity"], row["similarity"])
+
+    ranked = sorted(fused.values(), key=lambda item: item["rrf_score"], reverse=True)
+    return ranked[:limit] if limit else ranked
+
+
+# 分页搜索每页最多返回的分镜数，与 match_videos_page 一致
+MAX_SEARCH_PAGE_SIZE = 200
+
+
+# 分页游标绑定的查询条件摘要，游标不能用在其它查询上
+def search_cursor_digest(query_str: str, match_threshold: float, filters: dict) -> str:
+    payload = json.dumps([query_str, float(match_threshold), filters], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+# 分页游标：上一页最后一条分镜的 (similarity, shot_id) 和查询条件摘要，base64 编码后对调用方不透明
+def encode_search_cursor(row: dict, digest: str) -> str:
+    payload = json.dumps({"s": row["similarity"], "id": row["shot_id"], "q": digest}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+# 解析分页游标，返回 (similarity, shot_id)，游标不合法或不属于当前查询时抛出 ValueError
+def decode_search_cursor(cursor: str, digest: str) -> tuple:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        similarity, shot_id, cursor_digest = float(payload["s"]), int(payload["id"]), payload["q"]
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("invalid cursor")
+    if cursor_digest != digest:
+        raise ValueError("cursor does not match the query")
+    return similarity, shot_id
+
+
+# 组装分页搜索的返回值，取满一页时用最后一行生成下一页的游标
+def build_search_page(results: list, page_size: int, digest: str) -> dict:
+    return {
+        "results": results,
+        "next_cursor": encode_search_cursor(results[-1], digest) if len(results) == page_size else None
+    }
+
+
+# 提供对视频进行AI处理的功能，包括：
+# 1. 分析视频生成分镜信息并插入数据库
+# 2. 根据关键词搜索视频分镜信息
+class VideoAiProcessor:
+    def __init__(self, genai_client=None, supabase_client=None, embedding_cache=None, search_cache=None, query_batcher=None,
+                 vector_index=None, storage_client=None, prompt_cache=None):
+        self.genai_client = genai_client or genai.Client(http_options=HttpOptions(api_version="v1"))
+        self.supabase_client = supabase_client or create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY"))
+        # 开启限流（RATE_LIMIT_ENABLED=true）时，Gemini 和 embedding 调用经过进程内共享的限流器
+        self.genai_client = wrap_genai_client(self.genai_client)
+        # Supabase 和 Gemini 调用的重试策略和熔断器，进程内共享
+        self.supabase_dependency = get_dependency("supabase")
+        self.genai_dependency = get_dependency("genai")
+        # GCS 客户端只用于读取视频的元数据（计算内容指纹），首次使用时创建
+        self._storage_client = storage_client
+        self.analysis_model = "gemini-2.0-flash-001"
+        self.embedding_model = "text-multilingual-embedding-002"
+        # 长视频的文本切分成多个分片并发请求，失败的分片单独重试
+        self.embedding_batcher = EmbeddingBatcher(self.genai_client, self.embedding_model)
+        # 并发的搜索请求的查询向量合并成一次 embedding 调用
+        self.query_batcher = query_batcher or get_default_query_batcher(self.embedding_batcher.embed)
+        # 向量缓存，默认使用进程内共享的 内存LRU + SQLite 两级缓存
+        self.embedding_cache = embedding_cache or get_default_embedding_cache()
+        # 语义搜索结果缓存，分镜信息变化时失效
+        self.search_cache = search_cache or get_default_search_cache()
+        # 可选的进程内向量索引（VECTOR_INDEX_ENABLED=true 时开启），首次创建时在后台加载全部分镜，
+        # 每次传入当前的 Supabase 客户端，处理器重建后索引的后台刷新使用新客户端
+        self.vector_index = vector_index
+        if self.vector_index is None:
+            get_default_vector_index(self.supabase_client)
+        self.video_process_schema = VIDEO_PROCESS_SCHEMA
+        # 按素材的时长、文件大小和分辨率选择分析模型（MODEL_ROUTING_ENABLED=true 时开启）
+        self.model_router = ModelRouter(self.analysis_model)
+        # 可选的提示词上下文缓存（PROMPT_CACHE_ENABLED=true 时开启），进程内共享
+        self.prompt_cache = prompt_cache or get_default_prompt_cache(self.genai_client)
+        # 长视频分段分析：时长（material.duration）超过 VIDEO_SEGMENT_MIN_DURATION 秒的视频，
+        # 切分成 VIDEO_SEGMENT_WINDOW 秒、相邻重叠 VIDEO_SEGMENT_OVERLAP 秒的窗口并发分析，设为 0 时关闭
+        self.segment_min_duration = int(os.getenv("VIDEO_SEGMENT_MIN_DURATION", 600))
+        self.segment_window = int(os.getenv("VIDEO_SEGMENT_WINDOW", 300))
+        self.segment_overlap = int(os.getenv("VIDEO_SEGMENT_OVERLAP", 10))
+        self.segment_max_workers = int(os.getenv("VIDEO_SEGMENT_MAX_WORKERS", 4))
+        # 流式处理（VIDEO_STREAMING_ENABLED=true）：边生成边 embedding、边写入，分段分析的长视频不使用
+        self.streaming_enabled = os.getenv("VIDEO_STREAMING_ENABLED", "false").lower() == "true"
+        self.streaming_batch_size = int(os.getenv("VIDEO_STREAMING_BATCH_SIZE", 8))
     
     # text-embedding-005是英文模型，输出768维，EmbedContentResponse：response.embeddings[0].values
     # text-multilingual-embedding-002为多语言模型，输出1536维
+    # 返回与 texts 一一对应的向量列表，已缓存的文本不再调用 API
     def get_embedding(self, texts: list):
-        return self.genai_client.models.embed_content(
-            model="text-multilingual-embedding-002",
-            contents=texts
-        )
+        # 只把未命中的文本（去重后）发送给 API
+        keys, vectors, missing = lookup_embeddings(self.embedding_cache, self.embedding_model, texts)
+        if missing:
+            new_vectors = dict(zip(missing.keys(), self.embedding_batcher.embed(list(missing.values()))))
+            self.embedding_cache.set_many(new_vectors)
+            vectors.update(new_vectors)
+
+        print(f"embedding 缓存命中 {len(texts) - len(missing)}/{len(texts)}，调用 API {len(missing)} 条")
+        return [vectors[key] for key in keys]
+
+    # 获取单条查询字符串的向量，未命中缓存时与其它并发查询合并请求
+    def get_query_embedding(self, query_str: str):
+        key = embedding_cache_key(self.embedding_model, query_str)
+        cached = self.embedding_cache.get_many([key])
+        if key in cached:
+            return cached[key]
+
+        # 批次在微批处理的线程中执行，看不到本请求的截止时间，等待时间不超过剩余时间
+        try:
+            vector = self.query_batcher.embed(query_str, timeout=remaining_time())
+        except FutureTimeoutError:
+            raise DeadlineExceeded("等待查询向量超过请求的截止时间")
+        self.embedding_cache.set_many({key: vector})
+        return vector
     
     # 分析视频，生成分镜信息
-    def analyze_video(self, video_path: str):
+    # start_offset / end_offset 为分析的时间范围（秒），不传时分析整段视频
+    # model 为使用的模型，默认为 analysis_model
+    def analyze_video(self, video_path: str, start_offset: float = None, end_offset: float = None, model: str = None):
+        model = model or self.analysis_model
         uri = f"gs://{video_path}"
-        contents = [Part.from_uri(file_uri=uri, mime_type="video/mp4"), PROCESS_VIDEO_PROMPT]
-
-        response = self.genai_client.models.generate_content(
-            model="gemini-2.0-flash-001",
-            contents=contents,
-            config={
-                "response_mime_type": "application/json",
-                "response_schema": self.video_process_schema,
-            },
-        )
-        print(f"video {video_path} processed: {response.text}")
+        video_part = build_video_part(uri, start_offset, end_offset)
+
+        # 经过 genai 依赖的熔断和重试，超时不超过请求的剩余时间
+        def generate(contents, config):
+            return self.genai_client.models.generate_content(
+                model=model,
+                contents=contents,
+                config=with_deadline_http_options(config),
+            )
+
+        contents, config, cache_name = self.build_analysis_request(video_part, model)
+        try:
+            response = self.genai_dependency.call(generate, contents, config)
+        except Exception as e:
+            # 缓存在服务端已失效时，不使用缓存重试一次
+            if cache_name is None or not is_invalid_cache_error(e):
+                raise
+            self.prompt_cache.invalidate(model, cache_name)
+            contents, config, cache_name = self.build_analysis_request(video_part, model, use_cache=False)
+            response = self.genai_dependency.call(generate, contents, config)
+        if self.prompt_cache is not None:
+            self.prompt_cache.record_usage(response.usage_metadata, cached=cache_name is not None)
+        print(f"video {video_path} processed by {model}: {response.text}")
         return json.loads(response.text)
-    
-    # 保存分镜信息
-    def save_storyboard(self, shot_data):
-        self.supabase_client.table("video_storyboard").upsert(shot_data).execute()
-        print(f"已保存镜头: {shot_data}")
+
+    # 用路由选择的模型分析视频，返回的 JSON 不完整或不符合 schema 时换成更大的模型重试
+    # 返回 (分析结果, 实际使用的模型)
+    def analyze_video_routed(self, video_path: str, model: str, start_offset: float = None, end_offset: float = None):
+        while True:
+            try:
+                result = self.analyze_video(video_path, start_offset, end_offset, model=model)
+                validate_video_analysis(result)
+                return result, model
+            except ValueError as e:
+                larger = self.model_router.escalate(model)
+                if larger is None:
+                    raise
+                print(f"video {video_path} 使用 {model} 的分析结果无效，换成 {larger} 重试: {e}")
+                model = larger
+
+    # 构造视频分析请求的 contents 和 config，返回 (contents, config, 使用的缓存名称)
+    # 开启提示词缓存且缓存可用时，提示词从缓存读取，请求中只发送视频
+    def build_analysis_request(self, video_part: Part, model: str, use_cache: bool = True):
+        cache_name = None
+        if use_cache and self.prompt_cache is not None:
+            cache_name = self.prompt_cache.get(model)
+        contents, config = build_analysis_contents(video_part, self.video_process_schema, cache_name)
+        return contents, config, cache_name
+
+    # 流式分析视频，逐段返回生成的 JSON 文本
+    def analyze_video_stream(self, video_path: str, model: str = None):
+        model = model or self.analysis_model
+        uri = f"gs://{video_path}"
+        video_part = build_video_part(uri)
+
+        def open_stream(contents, config):
+            stream = self.genai_client.models.generate_content_stream(
+                model=model,
+                contents=contents,
+                config=with_deadline_http_options(config),
+            )
+            # 请求在读取第一段时才发出，缓存失效的错误在这里抛出
+            return stream, next(stream, None)
+
+        # 只有建立流（读取第一段）经过 genai 依赖的熔断和重试，已经输出内容后出错不重试
+        contents, config, cache_name = self.build_analysis_request(video_part, model)
+        try:
+            stream, chunk = self.genai_dependency.call(open_stream, contents, config)
+        except Exception as e:
+            if cache_name is None or not is_invalid_cache_error(e):
+                raise
+            self.prompt_cache.invalidate(model, cache_name)
+            contents, config, cache_name = self.build_analysis_request(video_part, model, use_cache=False)
+            stream, chunk = self.genai_dependency.call(open_stream, contents, config)
+
+        usage_metadata = None
+        while chunk is not None:
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            if chunk.text:
+                yield chunk.text
+            chunk = next(stream, None)
+        if self.prompt_cache is not None:
+            self.prompt_cache.record_usage(usage_metadata, cached=cache_name is not None)
+
+    # 流式分析视频并保存分镜：每个镜头生成完成后立即 embedding 并写入暂存表，生成结束后一次性发布
+    # 结果不符合 schema 时暂存的分镜被丢弃，换成更大的模型重新处理
+    # 返回 (完整的分析结果, 实际使用的模型)
+    def analyze_and_store_streaming(self, material_id: int, video_path: str, model: str = None):
+        model = model or self.analysis_model
+        started = time.monotonic()
+        pipeline = StreamingStoryboardPipeline(self, batch_size=self.streaming_batch_size)
+        while True:
+            try:
+                result = pipeline.run(material_id, self.analyze_video_stream(video_path, model),
+                                      validate=validate_video_analysis)
+                break
+            except ValueError as e:
+                larger = self.model_router.escalate(model)
+                if larger is None:
+                    raise
+                print(f"video {video_path} 使用 {model} 的分析结果无效，换成 {larger} 重试: {e}")
+                model = larger
+        print(f"video {video_path} 流式处理完成，{len(result['shots'])} 个镜头，耗时 {time.monotonic() - started:.1f} 秒")
+        return result, model
+
+    # 是否对该时长的视频分段分析
+    def should_segment(self, duration) -> bool:
+        return bool(self.segment_min_duration and duration and duration > self.segment_min_duration)
+
+    # 分段分析长视频：各窗口在线程池中并发分析，最后合并成整段视频的分镜信息
+    # 每个窗口经过 genai 依赖的重试和熔断（只重试失败的窗口），返回的 JSON 无效时换成更大的模型
+    # duration 视频时长（秒），model 为路由选择的模型，各窗口单独升级
+    # 返回 (合并后的分析结果, 各窗口实际使用的模型中最大的一个)
+    def analyze_video_segmented(self, video_path: str, duration: float, model: str = None):
+        model = model or self.analysis_model
+        segments = plan_video_segments(duration, self.segment_window, self.segment_overlap)
+        if len(segments) == 1:
+            return self.analyze_video_routed(video_path, model)
+
+        started = time.monotonic()
+        # 工作线程中使用调用方的上下文（请求的截止时间）
+        analyze_segment = bind_context(lambda segment: self.analyze_video_routed(video_path, model, *segment))
+        with ThreadPoolExecutor(max_workers=min(self.segment_max_workers, len(segments))) as executor:
+            outputs = list(executor.map(analyze_segment, segments))
+        result = merge_segment_results(segments, [output[0] for output in outputs])
+        print(f"video {video_path} 分 {len(segments)} 段分析完成，合并后 {len(result['shots'])} 个镜头，"
+              f"耗时 {time.monotonic() - started:.1f} 秒")
+        return result, self.model_router.largest([output[1] for output in outputs])
+
+    @property
+    def storage_client(self):
+        if self._storage_client is None:
+            self._storage_client = storage.Client()
+        return self._storage_client
+
+    # 获取视频的内容指纹，读取 GCS 元数据失败时返回 None（此时总是重新分析）
+    # model 为路由选择的模型，路由结果变化时重新分析
+    def get_video_fingerprint(self, video_path: str, model: str = None):
+        try:
+            return build_video_fingerprint(self.storage_client, video_path, model or self.analysis_model,
+                                           self.embedding_model, get_prompt_version(self.prompt_cache))
+        except Exception as e:
+            print(f"获取视频 {video_path} 的指纹失败：{e}")
+            return None
+
+    # 执行 Supabase 查询，临时性错误按 supabase 依赖的策略重试，Supabase 持续不可用时熔断、直接失败
+    # 只用于幂等的查询：读取、upsert、update、按条件删除和事务中的整体替换
+    # HTTP 超时不超过请求的剩余时间
+    def _execute(self, query):
+        return self.supabase_dependency.call(with_deadline_timeout(query).execute)
+
+    # 读取已保存的分析结果作为检查点：指纹与本次一致（同一视频、模型和提示词版本）时返回 (result, 使用的模型)，
+    # 否则返回 None。上次处理在分析完成后失败（embedding、写入分镜或更新状态）时，重试不再调用 Gemini
+    def load_analysis(self, material_id: int, fingerprint: str):
+        if fingerprint is None:
+            return None
+        response = self._execute(
+            self.supabase_client.table("video_analysis")
+            .select("raw, analysis_model")
+            .eq("material_id", material_id)
+            .eq("fingerprint", fingerprint)
+            .limit(1)
+        )
+        if not response.data:
+            return None
+        return response.data[0]["raw"], response.data[0]["analysis_model"]
+
+    # 保存完整的分析结果（包括 video_brief、metadata），之后修改向量化方式时不需要重新分析视频
+    # model 为实际使用的模型，routing 为模型路由的决策
+    def save_analysis(self, material_id: int, result: dict, fingerprint: str = None, model: str = None,
+                      routing: dict = None):
+        self._execute(self.supabase_client.table("video_analysis").upsert(
+            build_analysis_record(material_id, result, fingerprint, model or self.analysis_model, routing,
+                                  get_prompt_version(self.prompt_cache))
+        ))
+
+    # 统计素材已保存的分镜数
+    def count_storyboard(self, material_id: int) -> int:
+        response = self._execute(
+            self.supabase_client.table("video_storyboard")
+            .select("shot_id", count="exact")
+            .eq("material_id", material_id)
+            .limit(1)
+        )
+        return response.count or 0
+
+    # 在一个事务中替换某个素材的所有分镜信息，返回新分镜的 shot_id 列表
+    def replace_storyboard(self, material_id: int, shots: list):
+        response = self._execute(self.supabase_client.rpc(
+            "replace_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_shots": shots
+            }
+        ))
+        pairs = match_storyboard_rows(shots, response.data)
+        self.search_cache.invalidate()
+
+        # 同步更新进程内向量索引
+        self.update_index_for_material(material_id, pairs)
+
+        print(f"已替换素材 {material_id} 的分镜信息，共 {len(shots)} 个镜头")
+        return storyboard_shot_ids(response.data, pairs)
+
+    # 流式处理时写入一批分镜到暂存表，shots 中每个分镜带有 seq（在视频中的顺序）
+    def stage_storyboard(self, material_id: int, run_id: str, shots: list):
+        self._execute(self.supabase_client.rpc(
+            "stage_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_run_id": run_id,
+                "p_shots": shots
+            }
+        ))
+
+    # 发布暂存的分镜，一次性替换素材的所有分镜信息，shots 为按 seq 排序的暂存分镜
+    # 数据库中重复发布同一批暂存不会修改分镜，可以安全重试；没有镜头时没有暂存，直接清空素材的分镜
+    def publish_storyboard(self, material_id: int, run_id: str, shots: list):
+        if not shots:
+            return self.replace_storyboard(material_id, [])
+        response = self._execute(self.supabase_client.rpc(
+            "publish_storyboard",
+            {
+                "p_material_id": material_id,
+                "p_run_id": run_id
+            }
+        ))
+        pairs = match_storyboard_rows(shots, response.data, key="seq")
+        self.search_cache.invalidate()
+
+        self.update_index_for_material(material_id, pairs)
+
+        print(f"已发布素材 {material_id} 的分镜信息，共 {len(response.data)} 个镜头")
+        return storyboard_shot_ids(response.data, pairs)
+
+    # 用写入的分镜替换进程内向量索引中该素材的分镜；返回的行与写入的分镜对不上时不更新，由索引的定期重建补齐
+    def update_index_for_material(self, material_id: int, pairs):
+        vector_index = self.get_vector_index()
+        if vector_index is None:
+            return
+        if pairs is None:
+            print(f"素材 {material_id} 返回的分镜与本次写入的不一致（已被其它处理替换），跳过向量索引的更新")
+            return
+        vector_index.replace_material(material_id, build_index_rows(material_id, pairs))
+
+    # 清除流式处理失败时暂存的分镜
+    def discard_staging(self, run_id: str):
+        try:
+            self._execute(self.supabase_client.table("video_storyboard_staging").delete().eq("run_id", run_id))
+        except Exception as e:
+            # 清除失败不影响原有的错误，遗留的暂存会在该素材下次发布时清理
+            print(f"清除暂存分镜 {run_id} 失败: {e}")
 
     # 清楚某个素材的所有分镜信息
     def clear_storyboard(self, material_id: int):
-        self.supabase_client.table("video_storyboard").delete().eq("material_id", material_id).execute()
+        self._execute(self.supabase_client.table("video_storyboard").delete().eq("material_id", material_id))
+        self.search_cache.invalidate()
+        vector_index = self.get_vector_index()
+        if vector_index is not None:
+            vector_index.remove_material(material_id)
         print(f"已清除素材 {material_id} 的所有分镜信息")
 
+    # 获取进程内向量索引，未开启时返回 None
+    # 共享索引会被后台定期重建替换，因此每次使用时重新获取
+    def get_vector_index(self):
+        return self.vector_index if self.vector_index is not None else get_default_vector_index()
+
     # 根据关键词搜索视频分镜信息
-    def semantic_search(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10):
+    # ef_search / probes 为数据库向量索引的检索参数，越大召回率越高、速度越慢，不传时使用数据库默认值；
+    # 进程内向量索引不使用这两个参数
+    # filters 为素材属性过滤条件（见 normalize_search_filters），带过滤条件时总是由 match_videos 在数据库中检索
+    def semantic_search(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                        ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+
+        # 先查结果缓存，命中则不再调用 Gemini 和数据库
+        cache_key = search_cache_key(query_str, match_threshold, match_count,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
         # 获取查询字符串的向量表示
-        query_embedding = self.get_embedding([query_str])
-        # 提取向量值
-        embedding_vector = query_embedding.embeddings[0].values
+        embedding_vector = self.get_query_embedding(query_str)
         
-        # 使用supabase的match_videos函数进行相似度搜索
-        response = self.supabase_client.rpc(
-            "match_videos", 
-            {
-                "query_embedding": embedding_vector,
+        vector_index = select_search_index(self.get_vector_index(), filters)
+        if vector_index is not None:
+            # 开启了进程内向量索引时直接在本地检索，结果与 match_videos 一致（已删除素材在刷新间隔内生效）
+            results = vector_index.search(embedding_vector, match_threshold, match_count)
+        else:
+            # 使用supabase的match_videos函数进行相似度搜索
+            response = self._execute(self.supabase_client.rpc(
+                "match_videos",
+                build_match_params(embedding_vector, match_threshold, match_count,
+                                   ef_search=ef_search, probes=probes, filters=filters)
+            ))
+            results = response.data
+        
+        # 缓存并返回搜索结果
+        self.search_cache.set(cache_key, results, cache_version)
+        return results
+
+    # 按素材聚合的语义搜索：返回最相关的 match_count 个素材，每个素材附带最匹配的 shots_per_material 个分镜
+    # aggregate_mode 为素材打分方式，max 取最高相似度，mean_top_n 取最相似的 top_n 个分镜的平均相似度
+    # 聚合在数据库中完成（match_materials），不使用进程内向量索引
+    def semantic_search_materials(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                                  aggregate_mode: str = "max", top_n: int = 3, shots_per_material: int = 3,
+                                  ef_search: int = None, probes: int = None, filters: dict = None):
+        if aggregate_mode not in MATERIAL_AGGREGATE_MODES:
+            raise ValueError(f"aggregate_mode must be one of {', '.join(MATERIAL_AGGREGATE_MODES)}")
+        filters = normalize_search_filters(filters)
+
+        cache_key = search_cache_key(query_str, match_threshold, match_count, group_by="material",
+                                     aggregate_mode=aggregate_mode, top_n=top_n, shots_per_material=shots_per_material,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = self.get_query_embedding(query_str)
+        response = self._execute(self.supabase_client.rpc(
+            "match_materials",
+            build_match_params(embedding_vector, match_threshold, match_count,
+                               aggregate_mode=aggregate_mode, top_n=top_n, shots_per_material=shots_per_material,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        self.search_cache.set(cache_key, response.data, cache_version)
+        return response.data
+
+    # 混合检索：关键词检索（分镜文本的三元组倒排索引）和向量检索在一次 match_videos_hybrid 调用中完成，
+    # 用倒数排名融合（RRF）合并，适合包含商品名、字幕原文等精确关键词的查询
+    # candidate_count 为每一路的候选数，rrf_k 为 RRF 的平滑参数；结果附带 similarity、lexical_score、rrf_score
+    # 查询文本少于 3 个字符时数据库中跳过关键词检索，结果只按向量检索排序
+    def semantic_search_hybrid(self, query_str: str, match_threshold: float = 0.7, match_count: int = 10,
+                               candidate_count: int = 100, rrf_k: int = 60,
+                               ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+
+        cache_key = search_cache_key(query_str, match_threshold, match_count, mode="hybrid",
+                                     candidate_count=candidate_count, rrf_k=rrf_k,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = self.get_query_embedding(query_str)
+        response = self._execute(self.supabase_client.rpc(
+            "match_videos_hybrid",
+            build_match_params(embedding_vector, match_threshold, match_count, query_text=query_str,
+                               candidate_count=candidate_count, rrf_k=rrf_k,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        self.search_cache.set(cache_key, response.data, cache_version)
+        return response.data
+
+    # 批量语义搜索：多个查询的向量在一次 get_embedding 调用中生成，检索在一次 match_videos_batch 调用中完成
+    # 返回与 query_strs 一一对应的结果列表，每个查询的结果与 semantic_search 相同，并共用结果缓存
+    def semantic_search_batch(self, query_strs: list, match_threshold: float = 0.7, match_count: int = 10,
+                              ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+        cache_version = self.search_cache.version
+        cache_keys = [
+            search_cache_key(query_str, match_threshold, match_count, ef_search=ef_search, probes=probes, filters=filters)
+            for query_str in query_strs
+        ]
+        results = [self.search_cache.get(cache_key) for cache_key in cache_keys]
+        pending = [i for i, cached in enumerate(results) if cached is None]
+        if not pending:
+            return results
+
+        embeddings = self.get_embedding([query_strs[i] for i in pending])
+        vector_index = select_search_index(self.get_vector_index(), filters)
+        if vector_index is not None:
+            for i, embedding_vector in zip(pending, embeddings):
+                results[i] = vector_index.search(embedding_vector, match_threshold, match_count)
+        else:
+            params = {
+                "query_embeddings": embeddings,
                 "match_threshold": match_threshold,
                 "match_count": match_count
             }
-        ).execute()
-        
-        # 返回搜索结果
-        return response.data
+            params.update({name: value for name, value in
+                           (("ef_search", ef_search), ("probes", probes), ("filters", filters)) if value is not None})
+            response = self._execute(self.supabase_client.rpc("match_videos_batch", params))
+            for i in pending:
+                results[i] = []
+            for row in response.data:
+                results[pending[row.pop("query_index")]].append(row)
+
+        for i in pending:
+            self.search_cache.set(cache_keys[i], results[i], cache_version)
+        return results
+
+    # 分页的语义搜索，按 (相似度降序, shot_id 升序) 翻页，没有 match_videos 50 条的上限
+    # cursor 为上一页返回的 next_cursor，第一页不传；返回 {"results": [...], "next_cursor": 下一页游标，没有下一页时为 None}
+    # 查询向量有缓存，翻页不会重复调用 embedding 接口；分页总是在数据库中检索
+    def semantic_search_page(self, query_str: str, match_threshold: float = 0.7, page_size: int = 20, cursor: str = None,
+                             ef_search: int = None, probes: int = None, filters: dict = None):
+        filters = normalize_search_filters(filters)
+        page_size = min(page_size, MAX_SEARCH_PAGE_SIZE)
+        digest = search_cursor_digest(query_str, match_threshold, filters)
+        after_similarity, after_shot_id = decode_search_cursor(cursor, digest) if cursor else (None, None)
+
+        cache_key = search_cache_key(query_str, match_threshold, page_size, cursor=cursor,
+                                     ef_search=ef_search, probes=probes, filters=filters)
+        cache_version = self.search_cache.version
+        cached = self.search_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+        embedding_vector = self.get_query_embedding(query_str)
+        response = self._execute(self.supabase_client.rpc(
+            "match_videos_page",
+            build_match_params(embedding_vector, match_threshold, page_size=page_size,
+                               after_similarity=after_similarity, after_shot_id=after_shot_id,
+                               ef_search=ef_search, probes=probes, filters=filters)
+        ))
+
+        page = build_search_page(response.data, page_size, digest)
+        self.search_cache.set(cache_key, page, cache_version)
+        return page
+
+    # 逐页返回搜索结果，最多返回 max_results 个分镜，用于流式输出；每次只在内存中保留一页
+    def iter_semantic_search_pages(self, query_str: str, match_threshold: float = 0.7, page_size: int = 50,
+                                   max_results: int = 1000, cursor: str = None, **options):
+        remaining = max_results
+        while remaining > 0:
+            page = self.semantic_search_page(query_str, match_threshold, min(page_size, remaining), cursor, **options)
+            yield page
+            remaining -= len(page["results"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return
+
+    # 健康检查：用一个最小的查询确认 Supabase 连接可用
+    def health_check(self):
+        self.supabase_client.table("material").select("material_id").limit(1).execute()
+        return True
 
     # 更新素材处理状态
-    def update_material_status(self, material_id: int, status: str, msg: str = None):
+    def update_material_status(self, material_id: int, status: str, msg: str = None, fingerprint: str = None):
         """
         更新素材处理状态
         
@@ -128,88 +997,105 @@ class VideoAiProcessor:
             material_id (int): 素材 ID
             status (str): 状态值 ("Processing", "Completed", "Failed")
             msg (str, optional): 处理消息，将更新到 ai_process_msg 字段
+            fingerprint (str, optional): 视频内容指纹，将更新到 ai_process_fingerprint 字段
         """
-        update_data = {"ai_process_status": status}
-        if msg is not None:
-            update_data["ai_process_msg"] = msg
-        
-        self.supabase_client.table("material").update(update_data).eq("material_id", material_id).execute()
+        update_data = build_status_update(status, msg, fingerprint)
+        self._execute(self.supabase_client.table("material").update(update_data).eq("material_id", material_id))
         print(f"素材 {material_id} 的状态已更新为 {status}" + (f"，消息：{msg}" if msg else ""))
 
 
+    # 为分析结果中的每个镜头生成向量，一次性替换素材的所有分镜信息
+    def store_storyboard(self, material_id: int, result: dict):
+        # 为每个shot准备embedding文本，批量获取embeddings，重试时已生成的向量从缓存中读取
+        texts_to_embed = [build_shot_text(shot) for shot in result["shots"]]
+        embeddings = self.get_embedding(texts_to_embed)
+
+        # 组装每个shot的数据
+        shots_data = [build_shot_data(shot, embeddings[i]) for i, shot in enumerate(result["shots"])]
+
+        # 一次性替换素材的所有分镜信息
+        self.replace_storyboard(material_id, shots_data)
+
     # 分析视频，生成分镜信息，并保存到数据库
     # material_id 素材id
     # video_path 视频在GCS上的路径
-    def run(self, material_id: int, video_path: str):
+    # force 为 False 时，视频内容指纹与上次成功处理时一致则跳过分析，直接返回已保存的分镜数；
+    # 上次处理已保存了相同指纹的分析结果（之后的步骤失败）时复用该结果，只重新生成向量和写入分镜
+    def run(self, material_id: int, video_path: str, force: bool = False):
         try:
-            # 更新状态为处理中
-            self.update_material_status(material_id, "Processing")
-            
-            # 检查material_id是否存在        
-            material = self.supabase_client.table("material").select("*").eq("material_id", material_id).execute()
+            # 检查material_id是否存在
+            material = self._execute(
+                self.supabase_client.table("material")
+                .select(MATERIAL_PROCESS_COLUMNS)
+                .eq("material_id", material_id)
+            )
             if len(material.data) == 0:
-                # 更新状态为失败
-                self.update_material_status(material_id, "Failed")
                 raise ValueError(f"material_id {material_id} not found")
+            previous = material.data[0]
 
-            # 处理视频内容
-            result = self.analyze_video(video_path)
-            
-            # 准备用于embedding的文本数组
-            texts_to_embed = []
-            
-            # 遍历shots，为每个shot准备embedding文本
-            for shot in result["shots"]:
-                shot_text = ""
-                if "shot_content" in shot and shot["shot_content"]:
-                    shot_text += shot["shot_content"] + "\n"
-                if "subtitle" in shot and shot["subtitle"]:
-                    shot_text += shot["subtitle"] + "\n"
-                if "narration" in shot and shot["narration"]:
-                    shot_text += shot["narration"]
-                
-                texts_to_embed.append(shot_text.strip())
-            
-            # 批量获取embeddings
-            embeddings = self.get_embedding(texts_to_embed)
-            
-            # 清楚素材的所有分镜信息
-            self.clear_storyboard(material_id)
-
-            # 保存每个shot到数据库
-            for i, shot in enumerate(result["shots"]):
-                shot_data = {
-                    "material_id": material_id,
-                    "start_time": shot["start_time"],
-                    "end_time": shot["end_time"],
-                    "content_vector": embeddings.embeddings[i].values
-                }
-                
-                # 添加可选字段
-                if "shot_content" in shot and shot["shot_content"]:
-                    shot_data["shot_content"] = shot["shot_content"]
-                if "subtitle" in shot and shot["subtitle"]:
-                    shot_data["subtitle"] = shot["subtitle"]
-                if "narration" in shot and shot["narration"]:
-                    shot_data["narration"] = shot["narration"]
-                if "tags" in shot and shot["tags"]:
-                    shot_data["tags"] = shot["tags"]
-                
-                # 保存到数据库
-                self.save_storyboard(shot_data)
+            # 按时长、文件大小和分辨率选择模型
+            routing = self.model_router.route(previous)
+            print(f"素材 {material_id} 使用模型 {routing['model']}（{routing['reason']}）")
+
+            # 视频没有变化时跳过分析，重复提交和重试不再调用 Gemini
+            fingerprint = self.get_video_fingerprint(video_path, routing["model"])
+            if is_unchanged_material(previous, fingerprint, force):
+                processed_shots = self.count_storyboard(material_id)
+                print(f"素材 {material_id} 的视频没有变化，跳过分析，已有 {processed_shots} 个镜头")
+                return processed_shots
+
+            # 更新状态为处理中
+            self.update_material_status(material_id, "Processing")
+
+            # 分析结果是检查点：已有相同指纹的分析结果时不再调用 Gemini
+            checkpoint = None if force else self.load_analysis(material_id, fingerprint)
+            if checkpoint is not None:
+                result, model = checkpoint
+                print(f"素材 {material_id} 复用已保存的分析结果（{model}），跳过视频分析")
+                self.store_storyboard(material_id, result)
+            # 流式处理时生成、embedding、写入同时进行，分镜在生成结束后已经保存
+            elif not self.should_segment(previous["duration"]) and self.streaming_enabled:
+                result, model = self.analyze_and_store_streaming(material_id, video_path, routing["model"])
+                self.save_analysis(material_id, result, fingerprint, model, dict(routing, used_model=model))
+            else:
+                # 处理视频内容，长视频分段并发分析，先保存完整的分析结果，之后的步骤失败时重试可以复用
+                if self.should_segment(previous["duration"]):
+                    result, model = self.analyze_video_segmented(video_path, previous["duration"], routing["model"])
+                else:
+                    result, model = self.analyze_video_routed(video_path, routing["model"])
+                self.save_analysis(material_id, result, fingerprint, model, dict(routing, used_model=model))
+                self.store_storyboard(material_id, result)
             
-            # 更新状态为已完成
-            self.update_material_status(material_id, "Completed")
+            # 更新状态为已完成，记录本次处理的视频指纹
+            self.update_material_status(material_id, "Completed", fingerprint=fingerprint)
             
             return len(result["shots"])
             
         except Exception as e:
-            # 更新状态为失败，并记录错误信息
+            # 更新状态为失败，并记录错误信息；Supabase 不可用时更新状态也会失败，此时保留原始异常
             error_msg = str(e)
-            self.update_material_status(material_id, "Failed", error_msg)
+            try:
+                self.update_material_status(material_id, "Failed", error_msg)
+            except Exception as status_error:
+                print(f"更新素材 {material_id} 的失败状态失败: {status_error}")
             # 重新抛出异常，让上层处理
             raise e
 
+    # 批量处理多个素材，在有界线程池中并发执行 run，所有任务共享同一组 Gemini / Supabase 客户端
+    # materials 为 [{"material_id": int, "video_path": str, "force": bool (可选)}, ...]，force 未指定时使用参数 force
+    # 返回与 materials 一一对应的处理结果，单个素材失败不影响其它素材
+    def run_batch(self, materials: list, max_workers: int = 4, force: bool = False):
+        def run_one(item):
+            try:
+                return build_batch_item_result(item, self.run(item["material_id"], item["video_path"],
+                                                              item.get("force", force)))
+            except Exception as e:
+                return build_batch_item_result(item, error=e)
+
+        # 线程池中的任务沿用调用方的截止时间
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(bind_context(run_one), materials))
+
 
 if __name__ == "__main__":
     processor = VideoAiProcessor()
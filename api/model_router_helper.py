@@ -0,0 +1,97 @@
+import os
+import re
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+# 解析 material.resolution，返回像素数，无法解析时返回 None
+# 支持 "1920x1080"、"1080*1920"、"1080p"、"4k" 等写法
+def parse_resolution_pixels(resolution):
+    if not resolution:
+        return None
+    text = str(resolution).strip().lower()
+    match = re.match(r"^(\d+)\s*[x×*]\s*(\d+)$", text)
+    if match:
+        return int(match.group(1)) * int(match.group(2))
+    match = re.match(r"^(\d+)p$", text)
+    if match:
+        # 按 16:9 估算
+        height = int(match.group(1))
+        return height * height * 16 // 9
+    if text in ("4k", "2160p", "uhd"):
+        return 3840 * 2160
+    return None
+
+
+# 按素材的时长、文件大小和分辨率选择视频分析的模型：
+# - 短视频、低分辨率视频使用更便宜、更快的 lite 模型
+# - 时长未知、较长、码率高（文件大）的视频使用完整模型
+# - 分析结果不符合 schema 时，调用方通过 escalate 换成更大的模型重试
+# MODEL_ROUTING_ENABLED 不为 true 时所有视频使用完整模型
+class ModelRouter:
+    def __init__(self, full_model: str, lite_model: str = None, enabled: bool = None, lite_max_duration: float = None,
+                 low_res_max_pixels: int = None, low_res_max_duration: float = None, lite_max_file_size: int = None):
+        """
+        初始化 ModelRouter 实例
+
+        Args:
+            full_model (str): 完整模型
+            lite_model (str, optional): 低成本模型，默认从环境变量 ANALYSIS_MODEL_LITE 获取，否则为 gemini-2.0-flash-lite-001
+            enabled (bool, optional): 是否按素材路由，默认从环境变量 MODEL_ROUTING_ENABLED 获取
+            lite_max_duration (float, optional): 不超过该时长（秒）的视频使用 lite 模型，默认 ROUTER_LITE_MAX_DURATION 或 30
+            low_res_max_pixels (int, optional): 不超过该像素数的视为低分辨率，默认 ROUTER_LOW_RES_MAX_PIXELS 或 854x480
+            low_res_max_duration (float, optional): 低分辨率视频不超过该时长（秒）时使用 lite 模型，默认 ROUTER_LOW_RES_MAX_DURATION 或 120
+            lite_max_file_size (int, optional): 文件超过该大小（字节）时始终使用完整模型，默认 ROUTER_LITE_MAX_FILE_SIZE 或 100MB
+        """
+        self.full_model = full_model
+        self.lite_model = lite_model or os.getenv("ANALYSIS_MODEL_LITE", "gemini-2.0-flash-lite-001")
+        self.enabled = enabled if enabled is not None else os.getenv("MODEL_ROUTING_ENABLED", "false").lower() == "true"
+        self.lite_max_duration = lite_max_duration or float(os.getenv("ROUTER_LITE_MAX_DURATION", 30))
+        self.low_res_max_pixels = low_res_max_pixels or int(os.getenv("ROUTER_LOW_RES_MAX_PIXELS", 854 * 480))
+        self.low_res_max_duration = low_res_max_duration or float(os.getenv("ROUTER_LOW_RES_MAX_DURATION", 120))
+        self.lite_max_file_size = lite_max_file_size or int(os.getenv("ROUTER_LITE_MAX_FILE_SIZE", 100 * 2 ** 20))
+        # 从小到大排列，escalate 依次升级
+        self.tiers = [self.lite_model, self.full_model]
+
+    def route(self, material: dict) -> dict:
+        """
+        为素材选择模型
+
+        Args:
+            material (dict): material 表的一行，使用 duration、file_size、resolution
+
+        Returns:
+            dict: {"model": str, "reason": str}
+        """
+        if not self.enabled:
+            return {"model": self.full_model, "reason": "routing disabled"}
+
+        duration = material.get("duration")
+        file_size = material.get("file_size")
+        pixels = parse_resolution_pixels(material.get("resolution"))
+
+        if not duration:
+            return {"model": self.full_model, "reason": "unknown duration"}
+        if file_size and file_size > self.lite_max_file_size:
+            return {"model": self.full_model, "reason": f"file_size {file_size} > {self.lite_max_file_size}"}
+        if duration <= self.lite_max_duration:
+            return {"model": self.lite_model, "reason": f"duration {duration}s <= {self.lite_max_duration:g}s"}
+        if pixels is not None and pixels <= self.low_res_max_pixels and duration <= self.low_res_max_duration:
+            return {"model": self.lite_model,
+                    "reason": f"low resolution {material.get('resolution')}, duration {duration}s"}
+        return {"model": self.full_model, "reason": f"duration {duration}s"}
+
+    def escalate(self, model: str):
+        """返回比 model 更大的模型，已经是最大的模型时返回 None"""
+        if model not in self.tiers:
+            return None
+        index = self.tiers.index(model)
+        return self.tiers[index + 1] if index + 1 < len(self.tiers) else None
+
+    def largest(self, models: list) -> str:
+        """返回 models 中最大的模型，用于记录分段分析实际使用的模型"""
+        known = [model for model in models if model in self.tiers]
+        if not known:
+            return models[0] if models else self.full_model
+        return max(known, key=self.tiers.index)
@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def is_invalid_cache_error(e: Exception) -> bool:
+    """判断 generate_content 的异常是否由缓存失效引起（已过期、被删除或不属于当前模型），可以不使用缓存重试"""
+    # 延迟导入，避免 cloud_run_main 导入本模块时加载整个 google.genai
+    from google.genai import errors
+
+    return isinstance(e, errors.ClientError) and e.code in (400, 403, 404) and "cache" in str(e).lower()
+
+
+# 各模型显式缓存的最小 token 数，按模型名前缀匹配，未列出的模型使用 DEFAULT_MIN_CACHE_TOKENS
+MIN_CACHE_TOKENS = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-pro": 2048,
+}
+DEFAULT_MIN_CACHE_TOKENS = 4096
+
+
+def get_min_cache_tokens(model: str) -> int:
+    """返回模型显式缓存的最小 token 数，可以用环境变量 PROMPT_CACHE_MIN_TOKENS 覆盖"""
+    if os.getenv("PROMPT_CACHE_MIN_TOKENS"):
+        return int(os.getenv("PROMPT_CACHE_MIN_TOKENS"))
+    for prefix, min_tokens in MIN_CACHE_TOKENS.items():
+        if model.startswith(prefix):
+            return min_tokens
+    return DEFAULT_MIN_CACHE_TOKENS
+
+
+# 放入缓存的系统指令：提示词加上输出 schema 的说明，只在创建缓存（和检查最小 token 数）时构造，不使用缓存的请求仍只发送提示词
+def build_cached_instruction(prompt: str, schema: dict) -> str:
+    return (prompt.strip() + "\n\n输出必须是符合以下 JSON Schema 的 JSON 对象：\n"
+            + json.dumps(schema, ensure_ascii=False, indent=2))
+
+
+# 管理 Gemini 显式上下文缓存（cached content）：把每次视频分析都相同的系统指令（提示词和输出 schema 的说明）缓存起来，
+# 请求时只发送视频，系统指令部分按缓存计费，并缩短首 token 的时间。
+# 缓存的输入与不使用缓存时（视频 + 提示词）不同，开启缓存时分析结果使用另一个提示词版本（见 genai_helper.get_prompt_version）。
+# 1. 每个模型首次使用时用 count_tokens 检查系统指令是否达到模型的最小缓存 token 数，达不到时该模型不再使用缓存
+# 2. 每个模型一个缓存，首次使用时创建；距离过期不足 refresh_margin 秒时延长 TTL，延长失败时重新创建
+# 3. 创建失败时返回 None，调用方不使用缓存，retry_after 秒内不再尝试
+# 4. 记录每次调用的 token 用量，统计缓存节省的输入 token
+# 网络调用（count_tokens、创建、延长）不持有锁，同一模型同时只有一个线程在调用，其它线程不等待：
+# 延长期间继续使用原缓存，创建期间不使用缓存。
+# 注意：response_schema 属于生成配置，不能放入缓存，仍随每次请求发送
+class PromptCacheManager:
+    def __init__(self, genai_client, prompt: str, schema: dict, display_name: str = "process_video_prompt",
+                 ttl_seconds: int = None, refresh_margin: int = 300, retry_after: int = 600):
+        """
+        初始化 PromptCacheManager 实例
+
+        Args:
+            genai_client (genai.Client): genai 客户端
+            prompt (str): 视频分析的提示词
+            schema (dict): 输出的 JSON Schema，与提示词一起构造缓存的系统指令
+            display_name (str, optional): 缓存的显示名称
+            ttl_seconds (int, optional): 缓存的有效期（秒），默认从环境变量 PROMPT_CACHE_TTL 获取，否则为 3600
+            refresh_margin (int, optional): 距离过期不足该秒数时延长有效期
+            retry_after (int, optional): 创建失败后多久再次尝试（秒）
+        """
+        self.genai_client = genai_client
+        self.prompt = prompt
+        self.schema = schema
+        self.display_name = display_name
+        self.ttl_seconds = ttl_seconds or int(os.getenv("PROMPT_CACHE_TTL", 3600))
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        # model -> (缓存名称, 过期时间 monotonic)
+        self._caches = {}
+        # model -> 下次允许尝试创建的时间 monotonic，系统指令低于最小 token 数的模型为 inf
+        self._disabled_until = {}
+        # 已检查过最小 token 数的模型
+        self._checked_models = set()
+        # 正在创建或延长缓存的模型
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._usage = Counter()
+
+    def get(self, model: str):
+        """
+        获取模型可用的缓存名称，需要时创建或延长有效期
+
+        Args:
+            model (str): 生成模型名称
+
+        Returns:
+            str: 缓存名称，缓存不可用时返回 None
+        """
+        with self._lock:
+            now = time.monotonic()
+            if now < self._disabled_until.get(model, 0):
+                return None
+            cached = self._caches.get(model)
+            if cached is not None and cached[1] - now > self.refresh_margin:
+                return cached[0]
+            if model in self._pending:
+                return cached[0] if cached is not None and cached[1] > now else None
+            self._pending.add(model)
+            check = model not in self._checked_models
+
+        try:
+            if check and not self._check_min_tokens(model):
+                return None
+            if cached is not None and self._refresh(model, cached[0]):
+                return cached[0]
+            return self._create(model)
+        finally:
+            with self._lock:
+                self._pending.discard(model)
+
+    # 系统指令低于模型的最小缓存 token 数时，该模型不再使用缓存；count_tokens 失败时不检查，由创建的结果决定
+    def _check_min_tokens(self, model: str) -> bool:
+        try:
+            total_tokens = self.genai_client.models.count_tokens(
+                model=model, contents=build_cached_instruction(self.prompt, self.schema)).total_tokens
+        except Exception as e:
+            print(f"统计提示词 token 数失败，跳过最小缓存 token 数的检查: {e}")
+            total_tokens = None
+        with self._lock:
+            self._checked_models.add(model)
+            min_tokens = get_min_cache_tokens(model)
+            if total_tokens is not None and total_tokens < min_tokens:
+                self._disabled_until[model] = float("inf")
+                print(f"提示词只有 {total_tokens} 个 token，低于模型 {model} 的最小缓存 token 数 {min_tokens}，不使用提示词缓存")
+                return False
+        return True
+
+    def _refresh(self, model: str, name: str) -> bool:
+        try:
+            self.genai_client.caches.update(name=name, config={"ttl": f"{self.ttl_seconds}s"})
+        except Exception as e:
+            print(f"延长提示词缓存 {name} 失败，重新创建: {e}")
+            with self._lock:
+                if self._caches.get(model, (None,))[0] == name:
+                    del self._caches[model]
+            return False
+        with self._lock:
+            self._caches[model] = (name, time.monotonic() + self.ttl_seconds)
+            self._usage["refreshes"] += 1
+        return True
+
+    def _create(self, model: str):
+        try:
+            cache = self.genai_client.caches.create(
+                model=model,
+                config={
+                    "system_instruction": build_cached_instruction(self.prompt, self.schema),
+                    "display_name": self.display_name,
+                    "ttl": f"{self.ttl_seconds}s",
+                },
+            )
+        except Exception as e:
+            with self._lock:
+                self._disabled_until[model] = time.monotonic() + self.retry_after
+                self._usage["create_failures"] += 1
+            print(f"创建提示词缓存失败，{self.retry_after} 秒内不使用缓存: {e}")
+            return None
+
+        with self._lock:
+            self._caches[model] = (cache.name, time.monotonic() + self.ttl_seconds)
+            self._usage["creates"] += 1
+        print(f"已创建模型 {model} 的提示词缓存 {cache.name}，有效期 {self.ttl_seconds} 秒")
+        return cache.name
+
+    def invalidate(self, model: str, name: str):
+        """缓存在服务端已失效时丢弃，下次 get 重新创建"""
+        with self._lock:
+            if self._caches.get(model, (None,))[0] == name:
+                del self._caches[model]
+            self._usage["fallbacks"] += 1
+
+    def record_usage(self, usage_metadata, cached: bool):
+        """
+        记录一次调用的 token 用量
+
+        Args:
+            usage_metadata (GenerateContentResponseUsageMetadata): 响应中的 usage_metadata
+            cached (bool): 本次调用是否使用了缓存
+        """
+        if usage_metadata is None:
+            return
+        with self._lock:
+            self._usage["calls_cached" if cached else "calls_uncached"] += 1
+            self._usage["prompt_tokens"] += usage_metadata.prompt_token_count or 0
+            self._usage["cached_tokens"] += usage_metadata.cached_content_token_count or 0
+            self._usage["output_tokens"] += usage_metadata.candidates_token_count or 0
+
+    def stats(self) -> dict:
+        """返回缓存状态和 token 用量，cached_tokens 为按缓存计费的输入 token 数"""
+        with self._lock:
+            usage = dict(self._usage)
+            now = time.monotonic()
+            caches = {model: {"name": name, "expires_in": round(expire_at - now)}
+                      for model, (name, expire_at) in self._caches.items()}
+            disabled = sorted(model for model, until in self._disabled_until.items() if until == float("inf"))
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        usage["cached_token_ratio"] = usage.get("cached_tokens", 0) / prompt_tokens if prompt_tokens else 0.0
+        return {"caches": caches, "below_min_tokens": disabled, "usage": usage}
+
+
+_default_prompt_cache = None
+_default_prompt_cache_lock = threading.Lock()
+
+
+def get_default_prompt_cache(genai_client=None):
+    """
+    获取进程内共享的提示词缓存管理实例
+
+    环境变量:
+        PROMPT_CACHE_ENABLED: 为 true 时开启，默认关闭
+        PROMPT_CACHE_TTL: 缓存的有效期（秒），默认 3600
+        PROMPT_CACHE_MIN_TOKENS: 模型的最小缓存 token 数，默认按 MIN_CACHE_TOKENS
+
+    Args:
+        genai_client (genai.Client, optional): 首次创建时使用的 genai 客户端，不提供且尚未创建时返回 None
+
+    Returns:
+        PromptCacheManager: 管理实例，未开启时返回 None
+    """
+    global _default_prompt_cache
+    if os.getenv("PROMPT_CACHE_ENABLED", "false").lower() != "true":
+        return None
+    with _default_prompt_cache_lock:
+        if _default_prompt_cache is None and genai_client is not None:
+            from genai_helper import VIDEO_PROCESS_SCHEMA
+            from prompt import PROCESS_VIDEO_PROMPT
+            _default_prompt_cache = PromptCacheManager(genai_client, PROCESS_VIDEO_PROMPT, VIDEO_PROCESS_SCHEMA)
+        return _default_prompt_cache
@@ -0,0 +1,616 @@
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from dotenv import load_dotenv
+from resilience_helper import DeadlineExceeded, remaining_time, with_deadline_timeout
+
+load_dotenv()
+
+# 估算视频输入的 token 数：每秒画面约 258 个 token，音频约 32 个
+VIDEO_TOKENS_PER_SECOND = 290
+
+
+def is_rate_limit_error(e: Exception) -> bool:
+    """判断调用 genai 接口的异常是否为配额限流（429）"""
+    # 延迟导入，避免 cloud_run_main 导入本模块时加载整个 google.genai
+    from google.genai import errors
+
+    return isinstance(e, errors.APIError) and e.code == 429
+
+
+# 进程内的令牌桶，每个 key（模型）一组请求数桶和 token 数桶。
+# 每个实例单独限流，多实例部署时配额需要按实例数均分（RATE_LIMIT_INSTANCES）。
+# 共享后端（如 SupabaseRateLimitBackend，或自行实现的 Redis 后端）只需要提供相同的 acquire / adjust 方法。
+class LocalRateLimitBackend:
+    shared = False
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, requests: float, tokens: float, rpm: float, tpm: float, burst_seconds: float) -> float:
+        """
+        尝试从令牌桶中取出 requests 个请求和 tokens 个 token，两个桶都足够时扣除
+
+        Args:
+            key (str): 令牌桶的标识
+            requests (float): 请求数
+            tokens (float): 预估的 token 数
+            rpm (float): 每分钟请求数上限，为 0 时不限制
+            tpm (float): 每分钟 token 数上限，为 0 时不限制
+            burst_seconds (float): 桶容量为多少秒的配额，决定允许的突发量
+
+        Returns:
+            float: 0 表示已取出；否则为还需要等待的秒数，本次没有扣除
+        """
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = {"requests": rpm * burst_seconds / 60, "tokens": tpm * burst_seconds / 60,
+                                               "updated_at": now}
+            elapsed = now - bucket["updated_at"]
+            bucket["updated_at"] = now
+
+            wait = 0.0
+            for name, amount, limit in (("requests", requests, rpm), ("tokens", tokens, tpm)):
+                if not limit:
+                    continue
+                capacity = limit * burst_seconds / 60
+                bucket[name] = min(capacity, bucket[name] + elapsed * limit / 60)
+                # 单次用量超过桶容量时，桶满即可放行，避免永远等待
+                deficit = min(amount, capacity) - bucket[name]
+                wait = max(wait, deficit * 60 / limit)
+
+            if wait <= 0:
+                bucket["requests"] -= requests if rpm else 0
+                bucket["tokens"] -= tokens if tpm else 0
+            return max(wait, 0.0)
+
+    def adjust(self, key: str, tokens: float):
+        """按实际用量修正 token 桶，tokens 为实际用量减去预估用量，可以为负"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket["tokens"] -= tokens
+
+
+# 所有实例共享的令牌桶，保存在数据库的 rate_limit_bucket 表中，由 acquire_rate_limit 在行锁内完成补充和扣除。
+# 每次调用多一次数据库往返（几十毫秒），相对 Gemini 的调用耗时可以忽略。
+# Supabase 调用失败时不影响 Gemini 调用：改用进程内令牌桶（配额按 instances 均分），恢复后继续使用共享令牌桶
+class SupabaseRateLimitBackend:
+    shared = True
+
+    def __init__(self, supabase_client, instances: int = None):
+        """
+        初始化 SupabaseRateLimitBackend 实例
+
+        Args:
+            supabase_client (supabase.Client): Supabase 客户端
+            instances (int, optional): 改用进程内令牌桶时配额均分的实例数，默认 RATE_LIMIT_INSTANCES 或 1
+        """
+        self.supabase_client = supabase_client
+        self.instances = instances or int(os.getenv("RATE_LIMIT_INSTANCES", 1))
+        self.fallback = LocalRateLimitBackend()
+        self.fallback_calls = 0
+        self._failing = False
+
+    def acquire(self, key: str, requests: float, tokens: float, rpm: float, tpm: float, burst_seconds: float) -> float:
+        try:
+            response = with_deadline_timeout(self.supabase_client.rpc("acquire_rate_limit", {
+                "p_key": key,
+                "p_requests": requests,
+                "p_tokens": tokens,
+                "p_rpm": rpm,
+                "p_tpm": tpm,
+                "p_burst_seconds": burst_seconds
+            })).execute()
+        except Exception as e:
+            self._on_failure(e)
+            return self.fallback.acquire(key, requests, tokens, rpm / self.instances, tpm / self.instances,
+                                         burst_seconds)
+        if self._failing:
+            self._failing = False
+            print("共享令牌桶已恢复")
+        return float(response.data or 0)
+
+    def adjust(self, key: str, tokens: float):
+        if self._failing:
+            self.fallback.adjust(key, tokens)
+            return
+        with_deadline_timeout(self.supabase_client.rpc("adjust_rate_limit", {"p_key": key, "p_tokens": tokens})).execute()
+
+    # 连续失败时只在第一次打印
+    def _on_failure(self, e: Exception):
+        self.fallback_calls += 1
+        if not self._failing:
+            self._failing = True
+            print(f"共享令牌桶不可用，改用进程内令牌桶（配额按 {self.instances} 个实例均分）: {e}")
+
+
+# AIMD 自适应并发：
+# - 请求成功且延迟正常时，并发上限每个“窗口”（约 limit 个请求）加 1
+# - 收到 429，或单位 token 的延迟超过历史均值的 latency_tolerance 倍时，并发上限减半
+# - 两次减小之间至少间隔 cooldown 秒，同一波 429 只减一次，避免上限剧烈震荡
+# 延迟按每千 token 计算，不同长度的视频可以互相比较
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, initial: int = 8, min_limit: int = 1, max_limit: int = 64, latency_tolerance: float = 3.0,
+                 decrease_factor: float = 0.5, cooldown: float = 2.0, warmup: int = 20):
+        """
+        初始化 AdaptiveConcurrencyLimiter 实例
+
+        Args:
+            initial (int, optional): 初始并发上限
+            min_limit (int, optional): 并发上限的最小值
+            max_limit (int, optional): 并发上限的最大值
+            latency_tolerance (float, optional): 延迟超过均值的多少倍时视为过载
+            decrease_factor (float, optional): 过载时并发上限乘以的系数
+            cooldown (float, optional): 两次减小之间的最小间隔（秒）
+            warmup (int, optional): 累计多少个延迟样本后才使用延迟信号
+        """
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.warmup = warmup
+        self.in_flight = 0
+        self._latency_ewma = None
+        self._samples = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+        self._stats = Counter()
+
+    def try_acquire(self) -> bool:
+        """有空闲并发时占用一个并发并返回 True"""
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self, timeout: float = None):
+        """
+        等待空闲并发
+
+        Args:
+            timeout (float, optional): 最长等待时间（秒），为 None 时一直等待
+
+        Raises:
+            DeadlineExceeded: 超过 timeout 仍没有空闲并发
+        """
+        expire_at = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                if expire_at is not None and time.monotonic() >= expire_at:
+                    self._stats["timeouts"] += 1
+                    raise DeadlineExceeded("等待 Gemini 并发超过请求的截止时间")
+                self._stats["waits"] += 1
+                self._condition.wait(0.1 if expire_at is None else max(min(0.1, expire_at - time.monotonic()), 0))
+            self.in_flight += 1
+
+    async def aacquire(self, timeout: float = None):
+        """acquire 的异步版本，轮询等待，不占用线程"""
+        expire_at = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire():
+            if expire_at is not None and time.monotonic() >= expire_at:
+                self._stats["timeouts"] += 1
+                raise DeadlineExceeded("等待 Gemini 并发超过请求的截止时间")
+            self._stats["waits"] += 1
+            await asyncio.sleep(0.05)
+
+    def release(self, latency: float = None, throttled: bool = False):
+        """
+        释放并发并根据结果调整并发上限
+
+        Args:
+            latency (float, optional): 请求成功时每千 token 的耗时（秒），失败时为 None
+            throttled (bool, optional): 是否收到 429
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self._stats["throttled"] += 1
+                self._decrease("throttled")
+            elif latency is not None:
+                if (self._samples >= self.warmup and self._latency_ewma
+                        and latency > self._latency_ewma * self.latency_tolerance):
+                    self._decrease("latency")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+                self._latency_ewma = latency if self._latency_ewma is None else 0.9 * self._latency_ewma + 0.1 * latency
+                self._samples += 1
+            self._condition.notify_all()
+
+    def _decrease(self, reason: str):
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+        self._stats[f"decrease_{reason}"] += 1
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {"limit": round(self.limit, 2), "in_flight": self.in_flight,
+                    "latency_per_1k_tokens": self._latency_ewma, **self._stats}
+
+
+# Gemini / embedding 调用的限流器，按模型分别限流：
+# 1. 令牌桶控制每分钟请求数（RPM）和 token 数（TPM），配额乘以 target_utilization，吞吐稳定在配额以下
+# 2. 令牌按预估的 token 数扣除，请求完成后按实际用量修正
+# 3. 取得令牌后再占用自适应并发，429 和延迟升高时自动降低并发
+class GenaiRateLimiter:
+    def __init__(self, backend=None, quotas: dict = None, default_rpm: float = None, default_tpm: float = None,
+                 target_utilization: float = None, burst_seconds: float = None, instances: int = None,
+                 initial_concurrency: int = None, max_concurrency: int = None):
+        """
+        初始化 GenaiRateLimiter 实例
+
+        Args:
+            backend (optional): 令牌桶后端，默认为进程内的 LocalRateLimitBackend
+            quotas (dict, optional): 各模型的配额 {model: {"rpm": int, "tpm": int}}，默认从环境变量 RATE_LIMIT_QUOTAS（JSON）获取
+            default_rpm (float, optional): 未配置模型的 RPM，默认 RATE_LIMIT_DEFAULT_RPM 或 0（不限制）
+            default_tpm (float, optional): 未配置模型的 TPM，默认 RATE_LIMIT_DEFAULT_TPM 或 0（不限制）
+            target_utilization (float, optional): 使用配额的比例，默认 RATE_LIMIT_TARGET_UTILIZATION 或 0.9
+            burst_seconds (float, optional): 允许的突发量（秒的配额），默认 RATE_LIMIT_BURST_SECONDS 或 6
+            instances (int, optional): 使用进程内后端时配额均分的实例数，默认 RATE_LIMIT_INSTANCES 或 1
+            initial_concurrency (int, optional): 每个模型的初始并发上限，默认 RATE_LIMIT_INITIAL_CONCURRENCY 或 8
+            max_concurrency (int, optional): 每个模型的最大并发上限，默认 RATE_LIMIT_MAX_CONCURRENCY 或 64
+        """
+        self.backend = backend or LocalRateLimitBackend()
+        self.quotas = quotas if quotas is not None else json.loads(os.getenv("RATE_LIMIT_QUOTAS", "{}"))
+        self.default_rpm = default_rpm if default_rpm is not None else float(os.getenv("RATE_LIMIT_DEFAULT_RPM", 0))
+        self.default_tpm = default_tpm if default_tpm is not None else float(os.getenv("RATE_LIMIT_DEFAULT_TPM", 0))
+        self.target_utilization = target_utilization or float(os.getenv("RATE_LIMIT_TARGET_UTILIZATION", 0.9))
+        self.burst_seconds = burst_seconds or float(os.getenv("RATE_LIMIT_BURST_SECONDS", 6))
+        self.instances = instances or int(os.getenv("RATE_LIMIT_INSTANCES", 1))
+        self.initial_concurrency = initial_concurrency or int(os.getenv("RATE_LIMIT_INITIAL_CONCURRENCY", 8))
+        self.max_concurrency = max_concurrency or int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", 64))
+        self._concurrency = {}
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    def quota(self, model: str) -> tuple:
+        """返回模型实际使用的 (rpm, tpm)"""
+        quota = self.quotas.get(model, {})
+        rpm = float(quota.get("rpm", self.default_rpm))
+        tpm = float(quota.get("tpm", self.default_tpm))
+        share = self.target_utilization / (1 if self.backend.shared else self.instances)
+        return rpm * share, tpm * share
+
+    def concurrency(self, model: str) -> AdaptiveConcurrencyLimiter:
+        with self._lock:
+            limiter = self._concurrency.get(model)
+            if limiter is None:
+                limiter = self._concurrency[model] = AdaptiveConcurrencyLimiter(
+                    initial=min(self.initial_concurrency, self.max_concurrency), max_limit=self.max_concurrency)
+            return limiter
+
+    def acquire(self, model: str, tokens: float) -> float:
+        """
+        等待令牌和并发，返回开始时间，调用结束后必须调用 release
+        设置了请求截止时间时，等待不超过剩余时间
+
+        Args:
+            model (str): 模型名称
+            tokens (float): 预估的 token 数
+
+        Raises:
+            DeadlineExceeded: 截止时间前取不到令牌或并发
+        """
+        rpm, tpm = self.quota(model)
+        while rpm or tpm:
+            wait = self.backend.acquire(model, 1, tokens, rpm, tpm, self.burst_seconds)
+            if wait <= 0:
+                break
+            self._check_deadline(model, wait)
+            self._record_wait(wait)
+            time.sleep(min(wait, 5))
+        self.concurrency(model).acquire(self._remaining(model))
+        return time.monotonic()
+
+    async def aacquire(self, model: str, tokens: float) -> float:
+        """acquire 的异步版本，共享后端的调用在线程中执行"""
+        rpm, tpm = self.quota(model)
+        while rpm or tpm:
+            if self.backend.shared:
+                wait = await asyncio.to_thread(self.backend.acquire, model, 1, tokens, rpm, tpm, self.burst_seconds)
+            else:
+                wait = self.backend.acquire(model, 1, tokens, rpm, tpm, self.burst_seconds)
+            if wait <= 0:
+                break
+            self._check_deadline(model, wait)
+            self._record_wait(wait)
+            await asyncio.sleep(min(wait, 5))
+        await self.concurrency(model).aacquire(self._remaining(model))
+        return time.monotonic()
+
+    # 令牌桶需要等待 wait 秒，超过请求的剩余时间时不再等待
+    def _check_deadline(self, model: str, wait: float):
+        remaining = remaining_time()
+        if remaining is not None and wait >= remaining:
+            with self._lock:
+                self._stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded(f"模型 {model} 的令牌桶需要等待 {wait:.1f} 秒，超过请求的剩余时间")
+
+    # 等待并发的最长时间：请求的剩余时间，没有截止时间时为 None
+    def _remaining(self, model: str):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            with self._lock:
+                self._stats["deadline_exceeded"] += 1
+            raise DeadlineExceeded(f"模型 {model} 的调用已超过请求的截止时间")
+        return remaining
+
+    def release(self, model: str, started: float, estimated_tokens: float, actual_tokens: float = None,
+                error: BaseException = None):
+        """
+        释放并发，按实际用量修正令牌桶
+
+        Args:
+            model (str): 模型名称
+            started (float): acquire 返回的开始时间
+            estimated_tokens (float): acquire 时预估的 token 数
+            actual_tokens (float, optional): 响应中的实际 token 数
+            error (BaseException, optional): 调用失败时的异常
+        """
+        throttled = isinstance(error, Exception) and is_rate_limit_error(error)
+        latency = None
+        if error is None:
+            latency = (time.monotonic() - started) * 1000 / max(actual_tokens or estimated_tokens, 1)
+        self.concurrency(model).release(latency, throttled)
+
+        with self._lock:
+            self._stats["calls"] += 1
+            self._stats["throttled"] += 1 if throttled else 0
+            self._stats["tokens"] += actual_tokens or estimated_tokens
+
+        if actual_tokens is not None and self.quota(model)[1]:
+            try:
+                self.backend.adjust(model, actual_tokens - estimated_tokens)
+            except Exception as e:
+                print(f"修正模型 {model} 的令牌桶失败: {e}")
+
+    def _record_wait(self, wait: float):
+        with self._lock:
+            self._stats["bucket_waits"] += 1
+            self._stats["bucket_wait_seconds"] += wait
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            models = list(self._concurrency)
+        stats["backend"] = type(self.backend).__name__
+        if hasattr(self.backend, "fallback_calls"):
+            stats["backend_fallback_calls"] = self.backend.fallback_calls
+        stats["models"] = {model: dict(self.concurrency(model).stats(), quota=self.quota(model)) for model in models}
+        return stats
+
+
+# 估算 generate_content 请求的输入 token 数：文本按字符数估算（偏保守），
+# 视频按时间范围估算，没有时间范围的视频使用 media_tokens
+def estimate_content_tokens(contents, media_tokens: int) -> int:
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return len(contents)
+    if isinstance(contents, (list, tuple)):
+        return sum(estimate_content_tokens(item, media_tokens) for item in contents)
+
+    parts = getattr(contents, "parts", None)
+    if parts is not None:
+        return estimate_content_tokens(list(parts), media_tokens)
+    text = getattr(contents, "text", None)
+    if text:
+        return len(text)
+    if getattr(contents, "file_data", None) is not None:
+        metadata = getattr(contents, "video_metadata", None)
+        start = _parse_offset(getattr(metadata, "start_offset", None))
+        end = _parse_offset(getattr(metadata, "end_offset", None))
+        if end is not None:
+            return int((end - (start or 0)) * VIDEO_TOKENS_PER_SECOND)
+        return media_tokens
+    return 0
+
+
+# 请求配置中的系统指令（提示词），与 contents 一起计入预估的 token 数
+def _system_instruction(kwargs: dict):
+    config = kwargs.get("config")
+    if isinstance(config, dict):
+        return config.get("system_instruction")
+    return getattr(config, "system_instruction", None)
+
+
+def _parse_offset(offset):
+    if offset is None:
+        return None
+    if hasattr(offset, "total_seconds"):
+        return offset.total_seconds()
+    match = re.match(r"^([\d.]+)s$", str(offset))
+    return float(match.group(1)) if match else None
+
+
+def _usage_tokens(usage_metadata):
+    if usage_metadata is None or usage_metadata.total_token_count is None:
+        return None
+    return usage_metadata.total_token_count
+
+
+def _embedding_tokens(response):
+    counts = [getattr(getattr(embedding, "statistics", None), "token_count", None)
+              for embedding in (response.embeddings or [])]
+    if not counts or any(count is None for count in counts):
+        return None
+    return sum(counts)
+
+
+# genai_client.models 的限流代理，generate_content / generate_content_stream / embed_content 经过限流器，
+# 其它方法直接调用原对象
+class RateLimitedModels:
+    def __init__(self, models, limiter: GenaiRateLimiter, media_tokens: int):
+        self._models = models
+        self._limiter = limiter
+        self._media_tokens = media_tokens
+
+    def __getattr__(self, name):
+        return getattr(self._models, name)
+
+    def generate_content(self, *, model: str, contents, **kwargs):
+        estimated = estimate_content_tokens([contents, _system_instruction(kwargs)], self._media_tokens)
+        started = self._limiter.acquire(model, estimated)
+        try:
+            response = self._models.generate_content(model=model, contents=contents, **kwargs)
+        except BaseException as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        self._limiter.release(model, started, estimated, _usage_tokens(response.usage_metadata))
+        return response
+
+    def generate_content_stream(self, *, model: str, contents, **kwargs):
+        # 与原方法一样，开始读取时才发出请求
+        estimated = estimate_content_tokens([contents, _system_instruction(kwargs)], self._media_tokens)
+        started = self._limiter.acquire(model, estimated)
+        usage_metadata = None
+        try:
+            for chunk in self._models.generate_content_stream(model=model, contents=contents, **kwargs):
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                yield chunk
+        except Exception as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        except BaseException:
+            # 调用方提前结束读取（GeneratorExit）
+            self._limiter.release(model, started, estimated, _usage_tokens(usage_metadata))
+            raise
+        self._limiter.release(model, started, estimated, _usage_tokens(usage_metadata))
+
+    def embed_content(self, *, model: str, contents, **kwargs):
+        estimated = estimate_content_tokens(contents, self._media_tokens)
+        started = self._limiter.acquire(model, estimated)
+        try:
+            response = self._models.embed_content(model=model, contents=contents, **kwargs)
+        except BaseException as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        self._limiter.release(model, started, estimated, _embedding_tokens(response))
+        return response
+
+
+# genai_client.aio.models 的限流代理
+class AsyncRateLimitedModels(RateLimitedModels):
+    async def generate_content(self, *, model: str, contents, **kwargs):
+        estimated = estimate_content_tokens([contents, _system_instruction(kwargs)], self._media_tokens)
+        started = await self._limiter.aacquire(model, estimated)
+        try:
+            response = await self._models.generate_content(model=model, contents=contents, **kwargs)
+        except BaseException as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        self._limiter.release(model, started, estimated, _usage_tokens(response.usage_metadata))
+        return response
+
+    async def generate_content_stream(self, *, model: str, contents, **kwargs):
+        # 与同步版本一样，开始读取时才取得令牌和并发、发出请求，不读取的调用方不会占用并发
+        return self._stream(model, contents, kwargs)
+
+    async def _stream(self, model: str, contents, kwargs: dict):
+        estimated = estimate_content_tokens([contents, _system_instruction(kwargs)], self._media_tokens)
+        started = await self._limiter.aacquire(model, estimated)
+        usage_metadata = None
+        try:
+            stream = await self._models.generate_content_stream(model=model, contents=contents, **kwargs)
+            async for chunk in stream:
+                usage_metadata = chunk.usage_metadata or usage_metadata
+                yield chunk
+        except Exception as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        except BaseException:
+            self._limiter.release(model, started, estimated, _usage_tokens(usage_metadata))
+            raise
+        self._limiter.release(model, started, estimated, _usage_tokens(usage_metadata))
+
+    async def embed_content(self, *, model: str, contents, **kwargs):
+        estimated = estimate_content_tokens(contents, self._media_tokens)
+        started = await self._limiter.aacquire(model, estimated)
+        try:
+            response = await self._models.embed_content(model=model, contents=contents, **kwargs)
+        except BaseException as e:
+            self._limiter.release(model, started, estimated, error=e)
+            raise
+        self._limiter.release(model, started, estimated, _embedding_tokens(response))
+        return response
+
+
+class _RateLimitedAio:
+    def __init__(self, aio, limiter: GenaiRateLimiter, media_tokens: int):
+        self._aio = aio
+        self.models = AsyncRateLimitedModels(aio.models, limiter, media_tokens)
+
+    def __getattr__(self, name):
+        return getattr(self._aio, name)
+
+
+# genai.Client 的限流代理，models 和 aio.models 的调用经过限流器，caches 等其它属性直接使用原客户端
+class RateLimitedGenaiClient:
+    def __init__(self, client, limiter: GenaiRateLimiter, media_tokens: int = None):
+        """
+        初始化 RateLimitedGenaiClient 实例
+
+        Args:
+            client (genai.Client): 原始 genai 客户端
+            limiter (GenaiRateLimiter): 限流器
+            media_tokens (int, optional): 没有时间范围的视频预估的 token 数，默认 RATE_LIMIT_MEDIA_TOKENS 或 50000
+        """
+        media_tokens = media_tokens or int(os.getenv("RATE_LIMIT_MEDIA_TOKENS", 50000))
+        self.client = client
+        self.limiter = limiter
+        self.models = RateLimitedModels(client.models, limiter, media_tokens)
+        self.aio = _RateLimitedAio(client.aio, limiter, media_tokens)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+_default_rate_limiter = None
+_default_rate_limiter_lock = threading.Lock()
+
+
+def get_default_rate_limiter():
+    """
+    获取进程内共享的限流器
+
+    环境变量:
+        RATE_LIMIT_ENABLED: 为 true 时开启，默认关闭
+        RATE_LIMIT_BACKEND: local（进程内，默认）或 supabase（所有实例共享，使用 SUPABASE_URL / SUPABASE_KEY）
+        其它配置见 GenaiRateLimiter
+
+    Returns:
+        GenaiRateLimiter: 限流器，未开启时返回 None
+    """
+    global _default_rate_limiter
+    if os.getenv("RATE_LIMIT_ENABLED", "false").lower() != "true":
+        return None
+    with _default_rate_limiter_lock:
+        if _default_rate_limiter is None:
+            backend = None
+            if os.getenv("RATE_LIMIT_BACKEND", "local") == "supabase":
+                from supabase import create_client
+                backend = SupabaseRateLimitBackend(
+                    create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")))
+            _default_rate_limiter = GenaiRateLimiter(backend)
+        return _default_rate_limiter
+
+
+def wrap_genai_client(client):
+    """开启限流时返回经过共享限流器的客户端，否则原样返回"""
+    limiter = get_default_rate_limiter()
+    if limiter is None or isinstance(client, RateLimitedGenaiClient):
+        return client
+    return RateLimitedGenaiClient(client, limiter)
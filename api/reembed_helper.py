@@ -0,0 +1,190 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from google import genai
+from google.genai.types import HttpOptions
+from supabase import create_client
+from embedding_helper import EmbeddingBatcher
+from genai_helper import build_shot_text
+from rate_limit_helper import wrap_genai_client
+from resilience_helper import get_dependency
+
+load_dotenv()
+
+# 重新生成向量需要读取的分镜字段
+REEMBED_COLUMNS = ["shot_id", "shot_content", "subtitle", "narration"]
+
+
+# 批量重新生成所有分镜的向量，用于更换 embedding 模型或修改 build_shot_text 的拼接方式，不需要重新分析视频：
+# 1. 按 shot_id 分页读取 video_storyboard，每次只在内存中保留一页
+# 2. 用 build_shot_text 重新拼接文本，EmbeddingBatcher 按大分片、有界并发地生成向量
+# 3. 通过 update_storyboard_vectors 批量写回，写回与下一页的 embedding 并行进行
+# 4. 每页写回完成后记录检查点（最后的 shot_id），中断后再次执行会从检查点继续
+# 5. 没有文本的分镜把向量置空，不会保留旧模型的向量；置空的分镜不参与语义搜索
+#
+# 注意：
+# - 新模型的向量维度必须与 video_storyboard.content_vector 一致（1536），否则需要先修改表结构
+# - 迁移完成后需要同步修改 VideoAiProcessor.embedding_model，否则新写入的分镜和查询向量仍使用旧模型
+# - 迁移期间新旧模型的向量混在一起，搜索结果会不准确，建议在低峰期执行
+# - 本工具在独立进程中运行，不会通知正在服务的实例。向量是原地更新的，shot_id 不变：服务实例的搜索结果缓存
+#   最多 SEARCH_CACHE_TTL 秒后过期，进程内向量索引和快照的增量补齐发现不了这些更新，
+#   要等 VECTOR_INDEX_RELOAD_INTERVAL 的全量重建（同时覆盖快照）后才会使用新向量
+# - 检查点文件必须放在持久化的位置（--checkpoint 必填），容器重启后 /tmp 下的文件会丢失
+class StoryboardReembedder:
+    def __init__(self, genai_client, supabase_client, model: str, checkpoint_path: str, page_size: int = 1000,
+                 write_batch_size: int = 100, max_workers: int = 8, max_batch_size: int = 250):
+        """
+        初始化 StoryboardReembedder 实例
+
+        Args:
+            genai_client (genai.Client): genai 客户端
+            supabase_client (supabase.Client): Supabase 客户端
+            model (str): 新的 embedding 模型名称
+            checkpoint_path (str): 检查点文件路径
+            page_size (int, optional): 每页读取的分镜数
+            write_batch_size (int, optional): 每次调用 update_storyboard_vectors 写回的分镜数
+            max_workers (int, optional): 并发请求 embedding 的分片数
+            max_batch_size (int, optional): 每个 embedding 分片最多的文本条数
+        """
+        self.supabase_client = supabase_client
+        self.model = model
+        self.checkpoint_path = checkpoint_path
+        self.page_size = page_size
+        self.write_batch_size = write_batch_size
+        # 读取和写回分镜经过 supabase 依赖的重试和熔断，与在线处理一致
+        self.supabase_dependency = get_dependency("supabase")
+        # 开启限流时与在线处理共享配额，批量任务不会把配额打满
+        self.embedding_batcher = EmbeddingBatcher(wrap_genai_client(genai_client), model, max_batch_size=max_batch_size,
+                                                  max_workers=max_workers)
+
+    def load_checkpoint(self) -> dict:
+        """读取检查点，不存在时从头开始；检查点属于其它模型时抛出 ValueError"""
+        if not os.path.exists(self.checkpoint_path):
+            return {"model": self.model, "last_shot_id": 0, "processed": 0}
+        with open(self.checkpoint_path, encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint["model"] != self.model:
+            raise ValueError(f"checkpoint {self.checkpoint_path} belongs to model {checkpoint['model']}, "
+                             f"use --restart to start over with {self.model}")
+        return checkpoint
+
+    def save_checkpoint(self, checkpoint: dict):
+        """先写临时文件再替换，进程中途退出也不会留下损坏的检查点"""
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def iter_pages(self, after_shot_id: int):
+        """按 shot_id 分页读取 shot_id 大于 after_shot_id 的分镜"""
+        while True:
+            query = (
+                self.supabase_client.table("video_storyboard")
+                .select(",".join(REEMBED_COLUMNS))
+                .gt("shot_id", after_shot_id)
+                .order("shot_id")
+                .limit(self.page_size)
+            )
+            response = self.supabase_dependency.call(query.execute)
+            if not response.data:
+                return
+            yield response.data
+            after_shot_id = response.data[-1]["shot_id"]
+
+    def embed_page(self, rows: list) -> list:
+        """
+        为一页分镜生成向量，相同的文本只请求一次；没有文本的分镜向量为 None，写回时置空，不保留旧模型的向量
+
+        Returns:
+            list: [{"shot_id": int, "content_vector": list | None}, ...]
+        """
+        texts = {row["shot_id"]: build_shot_text(row) for row in rows}
+        unique_texts = list(dict.fromkeys(text for text in texts.values() if text))
+        vectors = dict(zip(unique_texts, self.embedding_batcher.embed(unique_texts)))
+        return [
+            {"shot_id": shot_id, "content_vector": vectors[text] if text else None}
+            for shot_id, text in texts.items()
+        ]
+
+    def write_vectors(self, updates: list) -> int:
+        """分批调用 update_storyboard_vectors 写回向量，返回更新的行数"""
+        updated = 0
+        for start in range(0, len(updates), self.write_batch_size):
+            # update_storyboard_vectors 按 shot_id 覆盖向量，重试是幂等的
+            response = self.supabase_dependency.call(self.supabase_client.rpc(
+                "update_storyboard_vectors",
+                {"p_vectors": updates[start:start + self.write_batch_size]}
+            ).execute)
+            updated += response.data or 0
+        return updated
+
+    def run(self, restart: bool = False) -> int:
+        """
+        执行重新生成，返回本次处理的分镜数
+
+        Args:
+            restart (bool, optional): 忽略已有的检查点，从头开始
+        """
+        checkpoint = {"model": self.model, "last_shot_id": 0, "processed": 0} if restart else self.load_checkpoint()
+        print(f"开始重新生成分镜向量，模型 {self.model}，从 shot_id > {checkpoint['last_shot_id']} 开始")
+
+        started = time.monotonic()
+        processed = 0
+        cleared = 0
+        # 同一时间最多一页在写回，写回期间继续为下一页生成向量
+        with ThreadPoolExecutor(max_workers=1) as writer:
+            pending = None
+            for rows in self.iter_pages(checkpoint["last_shot_id"]):
+                updates = self.embed_page(rows)
+                cleared += sum(1 for update in updates if update["content_vector"] is None)
+                if pending is not None:
+                    self._finish(pending, checkpoint)
+                pending = (writer.submit(self.write_vectors, updates), rows[-1]["shot_id"], len(rows))
+                processed += len(rows)
+                rate = processed / max(time.monotonic() - started, 1e-6)
+                print(f"已生成 {processed} 个分镜的向量（{rate:.1f} 个/秒），最后的 shot_id {rows[-1]['shot_id']}")
+            if pending is not None:
+                self._finish(pending, checkpoint)
+
+        print(f"分镜向量重新生成完成，本次处理 {processed} 个（其中 {cleared} 个没有文本，向量已置空），"
+              f"累计 {checkpoint['processed']} 个")
+        return processed
+
+    def _finish(self, pending: tuple, checkpoint: dict):
+        """等待一页写回完成后更新检查点，写回失败时异常向上抛出，检查点停留在上一页"""
+        future, last_shot_id, count = pending
+        future.result()
+        checkpoint["last_shot_id"] = last_shot_id
+        checkpoint["processed"] += count
+        self.save_checkpoint(checkpoint)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量重新生成分镜向量")
+    parser.add_argument("--model", default="text-multilingual-embedding-002", help="embedding 模型名称")
+    parser.add_argument("--checkpoint", required=True, help="检查点文件路径，必须位于持久化存储上")
+    parser.add_argument("--page-size", type=int, default=1000, help="每页读取的分镜数")
+    parser.add_argument("--write-batch-size", type=int, default=100, help="每次写回的分镜数")
+    parser.add_argument("--max-workers", type=int, default=8, help="并发请求 embedding 的分片数")
+    parser.add_argument("--max-batch-size", type=int, default=250, help="每个 embedding 分片最多的文本条数")
+    parser.add_argument("--restart", action="store_true", help="忽略已有的检查点，从头开始")
+    args = parser.parse_args()
+
+    reembedder = StoryboardReembedder(
+        genai.Client(http_options=HttpOptions(api_version="v1")),
+        create_client(os.environ.get("SUPABASE_URL"), os.environ.get("SUPABASE_KEY")),
+        model=args.model,
+        checkpoint_path=args.checkpoint,
+        page_size=args.page_size,
+        write_batch_size=args.write_batch_size,
+        max_workers=args.max_workers,
+        max_batch_size=args.max_batch_size
+    )
+    reembedder.run(restart=args.restart)
+
+
+if __name__ == "__main__":
+    main()
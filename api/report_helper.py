@@ -5,6 +5,7 @@ from typing import List, Dict, Any, Tuple, Optional
 from datetime import datetime, date
 import os
 from dotenv import load_dotenv
+from resilience_helper import get_dependency, remaining_time
 
 load_dotenv()
 
@@ -18,6 +19,8 @@ class BigqueryReportService:
         """
         self.project_id = project_id
         self.credentials_json_str = credentials_json_str
+        # BigQuery 查询的重试策略和熔断器，进程内共享
+        self.dependency = get_dependency("bigquery")
         self._create_client()
         
     def _create_client(self):
@@ -41,6 +44,19 @@ class BigqueryReportService:
                 self.project_id = os.environ.get('GOOGLE_CLOUD_PROJECT') or self.client.project
         except Exception as e:
             raise Exception(f"创建BigQuery客户端失败: {str(e)}")
+
+    def _run_query(self, query: str) -> list:
+        """
+        执行查询并读取全部结果，临时性错误（限流、后端错误）时重新提交查询，BigQuery 持续不可用时熔断
+        等待结果的时间不超过请求剩余的时间
+
+        Args:
+            query (str): SQL 查询
+
+        Returns:
+            list: 结果行
+        """
+        return self.dependency.call(lambda: list(self.client.query(query).result(timeout=remaining_time())))
     
     def get_material_metrics(self, material_id: str = None, start_date: str = None, end_date: str = None, post_id: str = None) -> Dict[str, Any]:
         """
@@ -96,14 +112,12 @@ class BigqueryReportService:
         
         try:
             # 执行汇总查询
-            summary_job = self.client.query(summary_query)
-            summary_result = next(summary_job.result())
+            summary_result = self._run_query(summary_query)[0]
             
             # 执行时间趋势查询
-            trend_job = self.client.query(trend_query)
             trend_results = []
             
-            for row in trend_job.result():
+            for row in self._run_query(trend_query):
                 trend_results.append({
                     'stat_date': row['stat_date'].strftime('%Y-%m-%d') if isinstance(row['stat_date'], (datetime, date)) else row['stat_date'],
                     'gmv': float(row['gmv']) if row['gmv'] is not None else 0.0,
@@ -167,10 +181,9 @@ class BigqueryReportService:
         """
         
         try:
-            query_job = self.client.query(query)
             results = []
             
-            for row in query_job.result():
+            for row in self._run_query(query):
                 results.append({
                     id_field: row[id_field],
                     'gmv': float(row['gmv']) if row['gmv'] is not None else 0.0,
@@ -302,10 +315,9 @@ class BigqueryReportService:
         """
         
         try:
-            query_job = self.client.query(query)
             results = []
             
-            for row in query_job.result():
+            for row in self._run_query(query):
                 results.append({
                     'material_id': row['material_id'],
                     'material_category': row['material_category'],
@@ -374,10 +386,9 @@ class BigqueryReportService:
         """
         
         try:
-            query_job = self.client.query(query)
             results = []
             
-            for row in query_job.result():
+            for row in self._run_query(query):
                 results.append({
                     'advertiser_id': row['advertiser_id'],
                     'gmv': float(row['gmv']) if row['gmv'] is not None else 0.0,
@@ -0,0 +1,362 @@
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# 可重试的 HTTP 状态码：限流和服务端临时错误
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Postgres / PostgREST 的临时性错误码：序列化失败、死锁、连接数过多、数据库重启、连接池超时等
+TRANSIENT_PG_CODES = ("40001", "40P01", "53300", "57P01", "57P02", "57P03", "08000", "08003", "08006",
+                      "PGRST000", "PGRST001", "PGRST002", "PGRST003")
+# Google API 错误详情中的临时性原因，BigQuery 的限流返回 403 rateLimitExceeded
+TRANSIENT_ERROR_REASONS = ("rateLimitExceeded", "jobRateLimitExceeded", "backendError", "internalError")
+
+# 各依赖的默认配置，可以用环境变量 RESILIENCE_<依赖>_<配置> 覆盖，如 RESILIENCE_SUPABASE_MAX_ATTEMPTS
+DEPENDENCY_DEFAULTS = {
+    "supabase": {"max_attempts": 3, "base_delay": 0.2, "max_delay": 5.0, "failure_threshold": 5, "reset_timeout": 30.0},
+    "bigquery": {"max_attempts": 3, "base_delay": 1.0, "max_delay": 20.0, "failure_threshold": 5, "reset_timeout": 60.0},
+    "cloud_tasks": {"max_attempts": 3, "base_delay": 0.5, "max_delay": 10.0, "failure_threshold": 5,
+                    "reset_timeout": 30.0},
+    # Gemini 视频分析单次调用耗时长、费用高，只重试一次；分段分析的各窗口同样只经过这里的重试
+    "genai": {"max_attempts": 2, "base_delay": 2.0, "max_delay": 30.0, "failure_threshold": 5, "reset_timeout": 60.0},
+    # embedding 分片（EmbeddingBatcher）
+    "embedding": {"max_attempts": 4, "base_delay": 1.0, "max_delay": 20.0, "failure_threshold": 5,
+                  "reset_timeout": 30.0},
+}
+
+
+class CircuitOpenError(Exception):
+    """依赖处于熔断状态，调用被直接拒绝"""
+
+
+class DeadlineExceeded(TimeoutError):
+    """请求的截止时间已到，不再发起新的调用或重试"""
+
+
+def is_transient_error(e: Exception) -> bool:
+    """判断调用外部依赖（Supabase、BigQuery、Cloud Tasks、Gemini）的异常是否为临时性错误，可以重试"""
+    if isinstance(e, (CircuitOpenError, DeadlineExceeded)):
+        return False
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return True
+    try:
+        # 延迟导入，未安装 httpx 时只按错误码判断
+        import httpx
+        if isinstance(e, httpx.TransportError):
+            return True
+    except ImportError:
+        pass
+
+    for error in getattr(e, "errors", None) or []:
+        if isinstance(error, dict) and error.get("reason") in TRANSIENT_ERROR_REASONS:
+            return True
+
+    # postgrest 的 APIError.code 为 Postgres 错误码或 HTTP 状态码字符串，google.api_core / genai 的异常为 HTTP 状态码
+    code = getattr(e, "code", None)
+    if isinstance(code, str) and code in TRANSIENT_PG_CODES:
+        return True
+    try:
+        return int(code) in RETRYABLE_STATUS_CODES
+    except (TypeError, ValueError):
+        return False
+
+
+# 当前请求的截止时间（time.monotonic），通过 contextvars 传递给同一请求中的所有调用，asyncio 任务和 to_thread 自动继承
+_deadline = contextvars.ContextVar("resilience_deadline", default=None)
+
+
+@contextmanager
+def deadline(seconds: float = None):
+    """
+    在 with 块内设置截止时间，嵌套时取更早的截止时间
+
+    Args:
+        seconds (float, optional): 从现在起的秒数，为 None 或 0 时不设置
+    """
+    if not seconds:
+        yield
+        return
+    expire_at = time.monotonic() + seconds
+    current = _deadline.get()
+    token = _deadline.set(expire_at if current is None else min(current, expire_at))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time():
+    """返回距离截止时间的秒数，没有设置截止时间时返回 None"""
+    expire_at = _deadline.get()
+    return None if expire_at is None else expire_at - time.monotonic()
+
+
+# 包装 httpx 的 Client / AsyncClient：每个请求的超时取当前请求的剩余时间，没有截止时间时使用客户端的默认超时
+class DeadlineHttpSession:
+    def __init__(self, session):
+        self._session = session
+
+    def request(self, *args, **kwargs):
+        timeout = remaining_time()
+        if timeout is not None and "timeout" not in kwargs:
+            kwargs["timeout"] = max(timeout, 0.1)
+        return self._session.request(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._session, name)
+
+
+def with_deadline_timeout(query):
+    """
+    让 Supabase（postgrest）查询的 HTTP 超时不超过当前请求的剩余时间，返回同一个查询对象
+
+    Args:
+        query: postgrest 的请求构造器（table(...).select(...) 或 rpc(...) 的返回值），每次查询一个实例
+
+    Returns:
+        query
+    """
+    session = getattr(query, "session", None)
+    if session is not None and not isinstance(session, DeadlineHttpSession):
+        query.session = DeadlineHttpSession(session)
+    return query
+
+
+def bind_context(fn):
+    """
+    绑定当前的上下文（截止时间），返回的函数在线程池中执行时使用调用 bind_context 时的上下文
+    ThreadPoolExecutor 不会自动传递 contextvars，每次调用使用一份拷贝，可以在多个线程中同时执行
+    """
+    context = contextvars.copy_context()
+
+    def wrapper(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
+# 熔断器：连续 failure_threshold 次临时性错误后打开，打开期间直接拒绝调用（CircuitOpenError），
+# reset_timeout 秒后进入半开状态，只放行一个探测调用，成功则关闭，失败则重新打开。
+# 非临时性错误（如参数错误）说明依赖可用，按成功计。failure_threshold 为 0 时不熔断。
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        """
+        初始化 CircuitBreaker 实例
+
+        Args:
+            name (str): 依赖名称
+            failure_threshold (int, optional): 连续失败多少次后打开
+            reset_timeout (float, optional): 打开后多久（秒）放行探测调用
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def allow(self):
+        """检查是否允许调用，不允许时抛出 CircuitOpenError"""
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            if self.state == "open":
+                wait = self._opened_at + self.reset_timeout - time.monotonic()
+                if wait > 0:
+                    self._counts["rejected"] += 1
+                    raise CircuitOpenError(f"{self.name} 熔断中，{wait:.1f} 秒后重试")
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open":
+                # 探测调用被取消时没有结果，超过 reset_timeout 后放行新的探测
+                now = time.monotonic()
+                if self._probing and now - self._probe_started < self.reset_timeout:
+                    self._counts["rejected"] += 1
+                    raise CircuitOpenError(f"{self.name} 熔断探测中")
+                self._probing = True
+                self._probe_started = now
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"{self.name} 已恢复，关闭熔断")
+            self.state = "closed"
+            self._failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        if not self.failure_threshold:
+            return
+        with self._lock:
+            self._failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self._failures >= self.failure_threshold):
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._counts["opened"] += 1
+                print(f"{self.name} 连续失败 {self._failures} 次，熔断 {self.reset_timeout:g} 秒")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._counts, state=self.state, consecutive_failures=self._failures)
+
+
+# 一个外部依赖的重试策略和熔断器：
+# 1. 调用前检查截止时间和熔断状态，截止时间已到或熔断打开时立即失败
+# 2. 临时性错误按带抖动的指数退避重试，最多 max_attempts 次；剩余时间不够等待下一次重试时直接抛出
+# 3. 非临时性错误不重试
+# 只用于幂等的调用，或通过 retryable 只在请求确定没有被执行时重试
+class Dependency:
+    def __init__(self, name: str, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 10.0,
+                 failure_threshold: int = 5, reset_timeout: float = 30.0, is_transient=None):
+        """
+        初始化 Dependency 实例
+
+        Args:
+            name (str): 依赖名称
+            max_attempts (int, optional): 最多调用次数（包括第一次）
+            base_delay (float, optional): 首次重试前的等待时间（秒）
+            max_delay (float, optional): 单次重试等待时间的上限（秒）
+            failure_threshold (int, optional): 熔断器连续失败多少次后打开，为 0 时不熔断
+            reset_timeout (float, optional): 熔断器打开后多久（秒）放行探测调用
+            is_transient (callable, optional): 判断异常是否为临时性错误，默认 is_transient_error
+        """
+        self.name = name
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.is_transient = is_transient or is_transient_error
+        self.circuit_breaker = CircuitBreaker(name, failure_threshold, reset_timeout)
+        self._counts = Counter()
+        self._lock = threading.Lock()
+
+    def _before_call(self):
+        remaining = remaining_time()
+        if remaining is not None and remaining <= 0:
+            raise DeadlineExceeded(f"{self.name} 调用前已超过截止时间")
+        self.circuit_breaker.allow()
+
+    # 记录一次失败，返回重试前需要等待的秒数，不应重试时返回 None
+    def _on_failure(self, e: Exception, attempt: int, retryable):
+        transient = self.is_transient(e)
+        if transient:
+            self.circuit_breaker.record_failure()
+        else:
+            self.circuit_breaker.record_success()
+        with self._lock:
+            self._counts["failures"] += 1
+
+        if not transient or attempt + 1 >= self.max_attempts or (retryable is not None and not retryable(e)):
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        remaining = remaining_time()
+        if remaining is not None and remaining <= delay:
+            return None
+        with self._lock:
+            self._counts["retries"] += 1
+        print(f"{self.name} 调用失败，{delay:.2f} 秒后第 {attempt + 1} 次重试: {e}")
+        return delay
+
+    def _on_success(self):
+        self.circuit_breaker.record_success()
+        with self._lock:
+            self._counts["calls"] += 1
+
+    def call(self, fn, *args, retryable=None, **kwargs):
+        """
+        调用 fn(*args, **kwargs)，临时性错误时重试
+
+        Args:
+            fn (callable): 要调用的函数，重试时再次调用，需要是幂等的
+            retryable (callable, optional): 进一步限制哪些临时性错误可以重试，如非幂等调用只重试请求未被执行的错误
+
+        Returns:
+            fn 的返回值
+        """
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, retryable)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    async def acall(self, fn, *args, retryable=None, **kwargs):
+        """call 的异步版本，fn 返回 awaitable"""
+        attempt = 0
+        while True:
+            self._before_call()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                delay = self._on_failure(e, attempt, retryable)
+                if delay is None:
+                    raise
+                attempt += 1
+                await asyncio.sleep(delay)
+                continue
+            self._on_success()
+            return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        return dict(counts, circuit=self.circuit_breaker.stats())
+
+
+_dependencies = {}
+_dependencies_lock = threading.Lock()
+
+
+def get_dependency(name: str) -> Dependency:
+    """
+    获取进程内共享的依赖实例，同一依赖的所有调用共用一个熔断器
+
+    环境变量（<NAME> 为大写的依赖名称，如 SUPABASE、BIGQUERY、CLOUD_TASKS、GENAI、EMBEDDING）:
+        RESILIENCE_<NAME>_MAX_ATTEMPTS: 最多调用次数
+        RESILIENCE_<NAME>_BASE_DELAY / RESILIENCE_<NAME>_MAX_DELAY: 退避的初始等待和上限（秒）
+        RESILIENCE_<NAME>_FAILURE_THRESHOLD: 连续失败多少次后熔断，为 0 时不熔断
+        RESILIENCE_<NAME>_RESET_TIMEOUT: 熔断多久（秒）后放行探测调用
+
+    Args:
+        name (str): 依赖名称，默认配置见 DEPENDENCY_DEFAULTS
+
+    Returns:
+        Dependency: 依赖实例
+    """
+    with _dependencies_lock:
+        dependency = _dependencies.get(name)
+        if dependency is None:
+            config = dict(DEPENDENCY_DEFAULTS.get(name, DEPENDENCY_DEFAULTS["cloud_tasks"]))
+            for key, value in config.items():
+                env_value = os.getenv(f"RESILIENCE_{name.upper()}_{key.upper()}")
+                if env_value:
+                    config[key] = type(value)(env_value)
+            dependency = _dependencies[name] = Dependency(name, **config)
+        return dependency
+
+
+def get_dependency_stats() -> dict:
+    """返回所有已使用的依赖的调用、重试和熔断统计"""
+    with _dependencies_lock:
+        dependencies = dict(_dependencies)
+    return {name: dependency.stats() for name, dependency in dependencies.items()}
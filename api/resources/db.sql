@@ -31,6 +31,7 @@ CREATE TABLE material (
     ai_process_status VARCHAR(100) DEFAULT 'NotProcessed',
     ai_process_task_id TEXT,
     ai_process_msg TEXT,
+    ai_process_fingerprint TEXT,
     updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
     is_deleted BOOLEAN DEFAULT FALSE
 );
@@ -66,6 +67,7 @@ COMMENT ON COLUMN material.resolution IS '视频分辨率';
 COMMENT ON COLUMN material.ai_process_status IS 'AI处理进度状态：未拆解(NotProcessed)、已调度(Scheduled)、拆解中(Processing)、拆解完成(Processed)、拆解失败(Failed)';
 COMMENT ON COLUMN material.ai_process_task_id IS 'AI处理任务ID/Name字符串类型，用于查询任务状态';
 COMMENT ON COLUMN material.ai_process_msg IS 'AI处理结果信息，包含错误信息等';
+COMMENT ON COLUMN material.ai_process_fingerprint IS '上次拆解完成时的视频内容指纹（GCS generation/md5 + 模型 + 提示词版本），未变化时不再重复拆解';
 
 -- 创建索引
 CREATE INDEX idx_material_material_type ON material(material_type);
@@ -142,6 +144,11 @@ create extension if not exists vector
 with
   schema public;
 
+-- 三元组索引，用于分镜文本的关键词检索（支持中日韩等不以空格分词的文本）
+create extension if not exists pg_trgm
+with
+  schema public;
+
 CREATE TABLE video_storyboard (
     shot_id SERIAL PRIMARY KEY,          -- 自增主键
     material_id INT NOT NULL,                        -- 关联 materials 表
@@ -151,15 +158,26 @@ CREATE TABLE video_storyboard (
     subtitle TEXT,                       -- 字幕
     narration TEXT,                      -- 旁白
     tags JSONB,                          -- 标签，JSONB 类型
-    content_vector VECTOR,           -- 向量，
+    content_vector VECTOR(1536),         -- 向量，维度与 text-multilingual-embedding-002 一致
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, -- 创建时间
+    -- 关键词检索的文本：镜头内容 + 字幕 + 旁白，由数据库自动生成
+    search_text TEXT GENERATED ALWAYS AS (
+        coalesce(shot_content, '') || ' ' || coalesce(subtitle, '') || ' ' || coalesce(narration, '')
+    ) STORED
 );
 
 -- 为常用字段添加索引
-CREATE INDEX idx_shots_video_id ON Shots (video_id);
-CREATE INDEX idx_shots_start_time ON Shots (start_time);
-CREATE INDEX idx_shots_tags ON Shots USING GIN (tags);  -- GIN 索引支持 JSONB 查询
-CREATE INDEX idx_shots_content_vector ON Shots USING ivfflat (content_vector vector_l2_ops);  -- 向量索引
+CREATE INDEX idx_video_storyboard_material_id ON video_storyboard (material_id);
+CREATE INDEX idx_video_storyboard_start_time ON video_storyboard (start_time);
+CREATE INDEX idx_video_storyboard_tags ON video_storyboard USING GIN (tags);  -- GIN 索引支持 JSONB 查询
+-- 关键词检索的倒排索引，支持 ILIKE 子串匹配和 <% 词相似度匹配
+CREATE INDEX idx_video_storyboard_search_text ON video_storyboard USING GIN (search_text gin_trgm_ops);
+-- 向量索引，match_videos 按余弦距离（<=>）排序，必须使用 vector_cosine_ops 才会走索引
+CREATE INDEX idx_video_storyboard_content_vector ON video_storyboard
+    USING hnsw (content_vector vector_cosine_ops) WITH (m = 16, ef_construction = 64);
+-- match_videos 的素材过滤条件
+CREATE INDEX idx_material_labels ON material USING GIN (labels);
+CREATE INDEX idx_material_type_country ON material (material_type, target_country);
 
 
 
@@ -181,12 +199,155 @@ CREATE INDEX idx_shots_content_vector ON Shots USING ivfflat (content_vector vec
 -- $$;
 
 
+-- 视频分析结果表，保存 Gemini 返回的完整分析结果（每个素材保留最近一次）
+-- 修改 embedding 模型或分镜文本的拼接方式时，可以基于这里和 video_storyboard 重新生成向量，不需要重新分析视频
+CREATE TABLE video_analysis (
+    material_id INT PRIMARY KEY,                -- 关联 material 表
+    fingerprint TEXT,                           -- 分析时的视频内容指纹，与 material.ai_process_fingerprint 一致
+    analysis_model VARCHAR(100) NOT NULL,       -- 分析使用的模型
+    routing JSONB,                              -- 模型路由的决策：路由选择的模型、原因、实际使用的模型（结果无效时会升级）
+    prompt_version VARCHAR(50) NOT NULL,        -- 提示词和 schema 的版本
+    video_brief TEXT,                           -- 视频简介
+    metadata JSONB,                             -- 视频元数据
+    raw JSONB NOT NULL,                         -- 完整的分析结果（包含 shots）
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 流式处理视频时逐批写入的分镜，全部写完后由 publish_storyboard 一次性替换 video_storyboard 中该素材的分镜
+-- 搜索只读取 video_storyboard，处理过程中不会看到只写入了一部分的分镜
+CREATE TABLE video_storyboard_staging (
+    run_id VARCHAR(32) NOT NULL,                -- 本次处理的标识
+    seq INT NOT NULL,                           -- 分镜在视频中的顺序
+    material_id INT NOT NULL,                   -- 关联 material 表
+    start_time FLOAT NOT NULL,
+    end_time FLOAT NOT NULL,
+    shot_content TEXT,
+    subtitle TEXT,
+    narration TEXT,
+    tags JSONB,
+    content_vector VECTOR(1536),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE INDEX idx_video_storyboard_staging_material_id ON video_storyboard_staging (material_id);
+
+-- 所有实例共享的 Gemini / embedding 限流令牌桶（RATE_LIMIT_BACKEND=supabase 时使用），每个模型一行
+CREATE TABLE rate_limit_bucket (
+    key VARCHAR(200) PRIMARY KEY,               -- 令牌桶标识（模型名称）
+    requests DOUBLE PRECISION NOT NULL,         -- 剩余的请求数
+    tokens DOUBLE PRECISION NOT NULL,           -- 剩余的 token 数，按实际用量修正后可能为负
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+
+-- 设置本次调用（事务内）的向量检索参数，match_videos / match_materials / match_videos_page 共用
+-- ef_search：HNSW 检索的候选集大小，越大召回率越高、速度越慢，为空时使用数据库默认值（40）
+-- probes：使用 IVFFlat 索引时扫描的聚类数量，为空时使用数据库默认值（1）
+-- 同时开启 pgvector >= 0.8 的 iterative scan：索引返回的候选被过滤后数量不足时继续扫描
+-- iterative_scan：HNSW 的扫描方式，relaxed_order 更快但顺序可能略有出入；分页时使用 strict_order 保证翻页不遗漏
+--   （IVFFlat 只支持 relaxed_order）
+create or replace function set_vector_search_options (
+  ef_search int default null,
+  probes int default null,
+  iterative_scan text default 'relaxed_order'
+)
+returns void
+language plpgsql
+as $$
+begin
+  if ef_search is not null then
+    perform set_config('hnsw.ef_search', ef_search::text, true);
+  end if;
+  if probes is not null then
+    perform set_config('ivfflat.probes', probes::text, true);
+  end if;
+  perform set_config('hnsw.iterative_scan', iterative_scan, true);
+  perform set_config('ivfflat.iterative_scan', 'relaxed_order', true);
+end;
+$$;
+
+
+-- 按余弦距离检索与查询向量最接近的 candidate_count 个分镜，match_videos / match_materials 共用
+-- filters：素材属性过滤条件，在向量检索的同一个查询中过滤，均为可选
+--   material_type / target_country：字符串数组，素材的值等于其中之一
+--   labels：字符串数组，素材 labels 与之有交集
+--   tags：JSON，分镜 tags 包含该值（@>，使用 tags 的 GIN 索引）
+--   include_deleted：是否包含已删除（is_deleted）的素材，默认不包含
+-- after_similarity / after_shot_id：分页游标，只返回排在该分镜之后的分镜（按相似度降序、shot_id 升序）
+-- relaxed_order 下索引返回的顺序可能略有出入，调用方需按 distance 重新排序
+create or replace function match_storyboard_candidates (
+  query_embedding vector(1536),
+  candidate_count int,
+  filters jsonb default null,
+  after_similarity float default null,
+  after_shot_id int default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  distance float
+)
+language plpgsql
+as $$
+declare
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  return query
+  select
+    video_storyboard.shot_id,
+    video_storyboard.material_id,
+    video_storyboard.start_time,
+    video_storyboard.end_time,
+    video_storyboard.shot_content,
+    video_storyboard.subtitle,
+    video_storyboard.narration,
+    video_storyboard.tags,
+    video_storyboard.created_at,
+    video_storyboard.content_vector <=> query_embedding as distance
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+    -- 相似度的计算方式与返回给调用方的 similarity 完全一致，游标中的值可以精确比较
+    and (after_similarity is null
+      or 1 - (video_storyboard.content_vector <=> query_embedding) < after_similarity
+      or (1 - (video_storyboard.content_vector <=> query_embedding) = after_similarity
+        and video_storyboard.shot_id > after_shot_id))
+  order by video_storyboard.content_vector <=> query_embedding asc
+  limit candidate_count;
+end;
+$$;
+
+
 -- 搜索函数，返回视频分镜信息
 -- Match documents using cosine distance (<=>)
+-- ef_search / probes 见 set_vector_search_options，filters 见 match_storyboard_candidates
+-- 相似度阈值在取出 top-k 之后再过滤，避免阈值过高时索引扫描一直找不到满足条件的行
 create or replace function match_videos (
   query_embedding vector(1536),
   match_threshold float,
-  match_count int
+  match_count int,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
 )
 returns table (
   shot_id int,
@@ -200,9 +361,336 @@ returns table (
   created_at timestamp,
   similarity float
 )
-language sql
+language plpgsql
 as $$
-  select 
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  select
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  from match_storyboard_candidates(query_embedding, least(match_count, 50), filters) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by candidates.distance asc;
+end;
+$$;
+
+
+-- 按素材聚合的搜索函数，返回最相关的素材及其最匹配的分镜
+-- 先取最相似的 candidate_count 个分镜，再按素材分组打分：
+--   aggregate_mode = 'max'：素材得分为其分镜的最高相似度
+--   aggregate_mode = 'mean_top_n'：素材得分为其最相似的 top_n 个分镜的平均相似度（命中分镜不足 top_n 个时按实际数量平均）
+-- shots 为该素材最相似的 shots_per_material 个分镜（JSON 数组，按相似度降序）
+create or replace function match_materials (
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  aggregate_mode text default 'max',
+  top_n int default 3,
+  shots_per_material int default 3,
+  candidate_count int default 500,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  material_id int,
+  material_name text,
+  material_type text,
+  file_path text,
+  score float,
+  max_similarity float,
+  shot_count int,
+  shots jsonb
+)
+language plpgsql
+as $$
+begin
+  if aggregate_mode not in ('max', 'mean_top_n') then
+    raise exception 'unsupported aggregate_mode: %', aggregate_mode;
+  end if;
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  with hits as (
+    select
+      candidates.*,
+      1 - candidates.distance as similarity,
+      row_number() over (
+        partition by candidates.material_id
+        order by candidates.distance asc, candidates.shot_id asc
+      ) as shot_rank
+    from match_storyboard_candidates(query_embedding, least(candidate_count, 2000), filters) as candidates
+    where candidates.distance < 1 - match_threshold
+  ),
+  grouped as (
+    select
+      hits.material_id,
+      case when aggregate_mode = 'max' then max(hits.similarity)
+        else avg(hits.similarity) filter (where hits.shot_rank <= top_n)
+      end as score,
+      max(hits.similarity) as max_similarity,
+      count(*)::int as shot_count,
+      jsonb_agg(
+        jsonb_build_object(
+          'shot_id', hits.shot_id,
+          'start_time', hits.start_time,
+          'end_time', hits.end_time,
+          'shot_content', hits.shot_content,
+          'subtitle', hits.subtitle,
+          'narration', hits.narration,
+          'tags', hits.tags,
+          'similarity', hits.similarity
+        ) order by hits.shot_rank
+      ) filter (where hits.shot_rank <= shots_per_material) as shots
+    from hits
+    group by hits.material_id
+  )
+  select
+    grouped.material_id,
+    material.material_name::text,
+    material.material_type::text,
+    material.file_path,
+    grouped.score,
+    grouped.max_similarity,
+    grouped.shot_count,
+    grouped.shots
+  from grouped
+  join material on material.material_id = grouped.material_id
+  order by grouped.score desc, grouped.material_id asc
+  limit least(match_count, 50);
+end;
+$$;
+
+
+-- 分页的搜索函数，按 (similarity 降序, shot_id 升序) 做 keyset 分页，没有 50 条的上限
+-- 第一页 after_similarity / after_shot_id 传空，之后传上一页最后一条的 similarity 和 shot_id；
+-- 返回条数少于 page_size 说明没有下一页。翻页越深索引扫描的行数越多，但每页返回的数据量不变
+create or replace function match_videos_page (
+  query_embedding vector(1536),
+  match_threshold float,
+  page_size int,
+  after_similarity float default null,
+  after_shot_id int default null,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes, 'strict_order');
+
+  return query
+  select
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  -- 索引只能按距离排序，相同向量（距离完全相同）的分镜在页边界上的先后不确定，
+  -- 多取一些候选后再按 (similarity, shot_id) 排序截断，保证与游标的比较方式一致
+  from match_storyboard_candidates(
+    query_embedding, least(page_size, 200) + 50, filters, after_similarity, after_shot_id
+  ) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by 1 - candidates.distance desc, candidates.shot_id asc
+  limit least(page_size, 200);
+end;
+$$;
+
+
+-- 批量搜索函数，一次调用检索多个查询向量，返回每个查询的 top-k 分镜
+-- query_embeddings 为 JSON 数组，每个元素是一个 1536 维向量；返回结果中的 query_index 为查询在数组中的下标（从 0 开始）
+-- 其它参数与 match_videos 一致，所有查询共用
+create or replace function match_videos_batch (
+  query_embeddings jsonb,
+  match_threshold float,
+  match_count int,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  query_index int,
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  select
+    (queries.ordinality - 1)::int as query_index,
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  from jsonb_array_elements(query_embeddings) with ordinality as queries(embedding, ordinality)
+  cross join lateral match_storyboard_candidates(
+    queries.embedding::text::vector(1536), least(match_count, 50), filters
+  ) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by queries.ordinality asc, candidates.distance asc;
+end;
+$$;
+
+
+-- 关键词检索分镜，返回关键词得分最高的 candidate_count 个分镜，match_videos_hybrid 使用
+-- 命中条件：search_text 包含完整的查询文本（ILIKE），或与查询文本的词相似度达到 pg_trgm.word_similarity_threshold（<%）
+-- lexical_score：包含完整查询文本时为 1，否则为词相似度（0 ~ 1）
+-- 查询文本去掉首尾空白后少于 3 个字符时无法提取三元组，索引用不上，ILIKE 会扫描整个表，
+-- 因此不做关键词检索、直接返回空，match_videos_hybrid 退化为只有向量检索
+-- （中文的两字词如"口红"也属于这种情况，需要关键词匹配时请用更长的查询文本）
+-- filters 与 match_storyboard_candidates 一致
+create or replace function match_storyboard_lexical (
+  query_text text,
+  candidate_count int,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  lexical_score float
+)
+language plpgsql
+as $$
+declare
+  v_pattern text := '%' || replace(replace(replace(query_text, '\', '\\'), '%', '\%'), '_', '\_') || '%';
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  if char_length(btrim(query_text)) < 3 then
+    return;
+  end if;
+
+  return query
+  select
+    video_storyboard.shot_id,
+    case when video_storyboard.search_text ilike v_pattern then 1.0
+      else word_similarity(query_text, video_storyboard.search_text)
+    end::float
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (video_storyboard.search_text ilike v_pattern or query_text <% video_storyboard.search_text)
+    and (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+  order by 2 desc, 1 asc
+  limit candidate_count;
+end;
+$$;
+
+
+-- 混合检索函数：关键词检索和向量检索各取 candidate_count 个候选，用倒数排名融合（RRF）合并排序
+-- rrf_score = sum(1 / (rrf_k + 排名))，只被一路命中的分镜只计算一项
+-- similarity 为向量相似度（所有结果都会计算），lexical_score 为关键词得分（未被关键词命中时为空）
+-- match_threshold 只作用于向量检索的候选；其它参数与 match_videos 一致
+-- 两路检索在同一条语句中先后执行（CTE 不会并行），耗时是两路之和；查询文本少于 3 个字符时只有向量检索
+create or replace function match_videos_hybrid (
+  query_text text,
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  candidate_count int default 100,
+  rrf_k int default 60,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float,
+  lexical_score float,
+  rrf_score float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  with vector_hits as (
+    select
+      candidates.shot_id,
+      row_number() over (order by candidates.distance asc, candidates.shot_id asc) as hit_rank
+    from match_storyboard_candidates(query_embedding, least(candidate_count, 1000), filters) as candidates
+    where candidates.distance < 1 - match_threshold
+  ),
+  lexical_hits as (
+    select
+      lexical.shot_id,
+      lexical.lexical_score,
+      row_number() over (order by lexical.lexical_score desc, lexical.shot_id asc) as hit_rank
+    from match_storyboard_lexical(query_text, least(candidate_count, 1000), filters) as lexical
+  ),
+  fused as (
+    select
+      coalesce(vector_hits.shot_id, lexical_hits.shot_id) as fused_shot_id,
+      lexical_hits.lexical_score as fused_lexical_score,
+      coalesce(1.0 / (rrf_k + vector_hits.hit_rank), 0)
+        + coalesce(1.0 / (rrf_k + lexical_hits.hit_rank), 0) as fused_score
+    from vector_hits
+    full outer join lexical_hits on lexical_hits.shot_id = vector_hits.shot_id
+  )
+  select
     video_storyboard.shot_id,
     video_storyboard.material_id,
     video_storyboard.start_time,
@@ -212,9 +700,283 @@ as $$
     video_storyboard.narration,
     video_storyboard.tags,
     video_storyboard.created_at,
-    1 - (video_storyboard.content_vector <=> query_embedding) as similarity
-  from video_storyboard
-  where video_storyboard.content_vector <=> query_embedding < 1 - match_threshold
-  order by video_storyboard.content_vector <=> query_embedding asc
+    1 - (video_storyboard.content_vector <=> query_embedding) as similarity,
+    fused.fused_lexical_score,
+    fused.fused_score::float
+  from fused
+  join video_storyboard on video_storyboard.shot_id = fused.fused_shot_id
+  order by fused.fused_score desc, video_storyboard.shot_id asc
   limit least(match_count, 50);
-$$;
\ No newline at end of file
+end;
+$$;
+
+
+-- 批量替换素材的全部分镜信息
+-- 在同一个事务中删除旧分镜并插入新分镜，读者不会看到只写了一半的分镜
+-- p_shots 为分镜数组，每个元素包含 start_time、end_time、shot_content、subtitle、narration、tags、content_vector
+-- 返回每个新分镜的 shot_id、created_at 和它在 p_shots 中的位置 idx（从 0 开始），调用方按 idx 对应分镜，不依赖返回的顺序
+create or replace function replace_storyboard (
+  p_material_id int,
+  p_shots jsonb
+)
+returns table (
+  shot_id int,
+  created_at timestamp,
+  idx int
+)
+language plpgsql
+as $$
+declare
+  v_shot jsonb;
+  v_ordinality bigint;
+begin
+  -- 同一素材的并发替换串行执行
+  perform pg_advisory_xact_lock(p_material_id);
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  -- 按 p_shots 的顺序逐个插入，shot_id 随位置递增
+  for v_shot, v_ordinality in
+    select s.shot, s.ordinality
+    from jsonb_array_elements(p_shots) with ordinality as s(shot, ordinality)
+    order by s.ordinality
+  loop
+    insert into video_storyboard (
+      material_id,
+      start_time,
+      end_time,
+      shot_content,
+      subtitle,
+      narration,
+      tags,
+      content_vector
+    )
+    values (
+      p_material_id,
+      (v_shot ->> 'start_time')::float,
+      (v_shot ->> 'end_time')::float,
+      v_shot ->> 'shot_content',
+      v_shot ->> 'subtitle',
+      v_shot ->> 'narration',
+      v_shot -> 'tags',
+      (v_shot ->> 'content_vector')::vector
+    )
+    returning video_storyboard.shot_id, video_storyboard.created_at into shot_id, created_at;
+    idx := v_ordinality - 1;
+    return next;
+  end loop;
+end;
+$$;
+
+
+-- 批量更新分镜向量，重新生成 embedding（如更换模型）时使用
+-- p_vectors 为数组，每个元素包含 shot_id 和 content_vector（为 null 时置空向量），返回更新的行数
+create or replace function update_storyboard_vectors (
+  p_vectors jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  v_count int;
+begin
+  update video_storyboard
+  set content_vector = (item ->> 'content_vector')::vector
+  from jsonb_array_elements(p_vectors) as item
+  where video_storyboard.shot_id = (item ->> 'shot_id')::int;
+
+  get diagnostics v_count = row_count;
+  return v_count;
+end;
+$$;
+
+-- 流式处理时写入一批分镜到暂存表，p_shots 为数组，每个元素包含 seq 和分镜字段，返回写入的行数
+create or replace function stage_storyboard (
+  p_material_id int,
+  p_run_id text,
+  p_shots jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  v_count int;
+begin
+  insert into video_storyboard_staging (
+    run_id,
+    seq,
+    material_id,
+    start_time,
+    end_time,
+    shot_content,
+    subtitle,
+    narration,
+    tags,
+    content_vector
+  )
+  select
+    p_run_id,
+    (shot ->> 'seq')::int,
+    p_material_id,
+    (shot ->> 'start_time')::float,
+    (shot ->> 'end_time')::float,
+    shot ->> 'shot_content',
+    shot ->> 'subtitle',
+    shot ->> 'narration',
+    shot -> 'tags',
+    (shot ->> 'content_vector')::vector
+  from jsonb_array_elements(p_shots) as shot
+  -- 重试的批次覆盖已写入的分镜
+  on conflict (run_id, seq) do update set
+    start_time = excluded.start_time,
+    end_time = excluded.end_time,
+    shot_content = excluded.shot_content,
+    subtitle = excluded.subtitle,
+    narration = excluded.narration,
+    tags = excluded.tags,
+    content_vector = excluded.content_vector;
+
+  get diagnostics v_count = row_count;
+  return v_count;
+end;
+$$;
+
+-- 发布暂存的分镜：在一个事务中删除素材原有的分镜，按 seq 顺序写入本次暂存的分镜并清空暂存，
+-- 与 replace_storyboard 一样对同一素材串行执行；同时清理该素材一天前未发布的暂存（处理中断时遗留）
+-- 返回每个新分镜的 shot_id、created_at 和它的暂存序号 seq，调用方按 seq 对应分镜，不依赖返回的顺序
+-- 本次暂存已经发布过（上一次调用已提交但响应丢失，客户端重试）时不再修改，直接返回素材当前的分镜；
+-- 发布时按 seq 顺序逐个插入，shot_id 随 seq 递增，此时按 shot_id 排序还原 seq（暂存的 seq 从 0 开始连续编号）
+-- 期间素材的分镜已被其它处理替换时，返回的行数和 seq 与本次暂存对不上，调用方据此跳过向量索引的更新
+create or replace function publish_storyboard (
+  p_material_id int,
+  p_run_id text
+)
+returns table (
+  shot_id int,
+  created_at timestamp,
+  seq int
+)
+language plpgsql
+as $$
+declare
+  v_staged video_storyboard_staging%rowtype;
+begin
+  perform pg_advisory_xact_lock(p_material_id);
+
+  if not exists (select 1 from video_storyboard_staging s where s.run_id = p_run_id) then
+    return query
+    select v.shot_id, v.created_at, (row_number() over (order by v.shot_id) - 1)::int
+    from video_storyboard v
+    where v.material_id = p_material_id
+    order by v.shot_id;
+    return;
+  end if;
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  for v_staged in
+    select *
+    from video_storyboard_staging s
+    where s.run_id = p_run_id
+    order by s.seq
+  loop
+    insert into video_storyboard (
+      material_id,
+      start_time,
+      end_time,
+      shot_content,
+      subtitle,
+      narration,
+      tags,
+      content_vector
+    )
+    values (
+      p_material_id,
+      v_staged.start_time,
+      v_staged.end_time,
+      v_staged.shot_content,
+      v_staged.subtitle,
+      v_staged.narration,
+      v_staged.tags,
+      v_staged.content_vector
+    )
+    returning video_storyboard.shot_id, video_storyboard.created_at into shot_id, created_at;
+    seq := v_staged.seq;
+    return next;
+  end loop;
+
+  delete from video_storyboard_staging s
+  where s.run_id = p_run_id
+     or (s.material_id = p_material_id and s.created_at < now() - interval '1 day');
+end;
+$$;
+
+-- 从共享令牌桶中取出 p_requests 个请求和 p_tokens 个 token，与 rate_limit_helper.LocalRateLimitBackend.acquire 的逻辑一致：
+-- 先按经过的时间补充（不超过 p_burst_seconds 秒的配额），两个桶都足够时扣除并返回 0，否则返回还需要等待的秒数
+-- p_rpm / p_tpm 为 0 时不限制对应的桶
+create or replace function acquire_rate_limit (
+  p_key text,
+  p_requests float,
+  p_tokens float,
+  p_rpm float,
+  p_tpm float,
+  p_burst_seconds float
+)
+returns float
+language plpgsql
+as $$
+declare
+  v_bucket rate_limit_bucket%rowtype;
+  v_now timestamptz := clock_timestamp();
+  v_elapsed float;
+  v_request_capacity float := p_rpm * p_burst_seconds / 60;
+  v_token_capacity float := p_tpm * p_burst_seconds / 60;
+  v_wait float := 0;
+begin
+  insert into rate_limit_bucket (key, requests, tokens, updated_at)
+  values (p_key, v_request_capacity, v_token_capacity, v_now)
+  on conflict (key) do nothing;
+
+  select * into v_bucket from rate_limit_bucket where key = p_key for update;
+  v_elapsed := greatest(extract(epoch from v_now - v_bucket.updated_at), 0);
+
+  if p_rpm > 0 then
+    v_bucket.requests := least(v_request_capacity, v_bucket.requests + v_elapsed * p_rpm / 60);
+    v_wait := greatest(v_wait, (least(p_requests, v_request_capacity) - v_bucket.requests) * 60 / p_rpm);
+  end if;
+  if p_tpm > 0 then
+    v_bucket.tokens := least(v_token_capacity, v_bucket.tokens + v_elapsed * p_tpm / 60);
+    v_wait := greatest(v_wait, (least(p_tokens, v_token_capacity) - v_bucket.tokens) * 60 / p_tpm);
+  end if;
+
+  if v_wait <= 0 then
+    if p_rpm > 0 then
+      v_bucket.requests := v_bucket.requests - p_requests;
+    end if;
+    if p_tpm > 0 then
+      v_bucket.tokens := v_bucket.tokens - p_tokens;
+    end if;
+  end if;
+
+  update rate_limit_bucket
+  set requests = v_bucket.requests, tokens = v_bucket.tokens, updated_at = v_now
+  where key = p_key;
+
+  return greatest(v_wait, 0);
+end;
+$$;
+
+-- 按实际用量修正共享令牌桶，p_tokens 为实际用量减去预估用量，可以为负
+create or replace function adjust_rate_limit (
+  p_key text,
+  p_tokens float
+)
+returns void
+language sql
+as $$
+  update rate_limit_bucket
+  set tokens = tokens - p_tokens
+  where key = p_key;
+$$;
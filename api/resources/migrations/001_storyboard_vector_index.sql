@@ -0,0 +1,84 @@
+-- 迁移：video_storyboard 向量列改为 vector(1536)，建立余弦距离的 HNSW 索引
+-- 原表结构中 content_vector 没有维度，向量索引建在 vector_l2_ops 上且表名错误，
+-- match_videos 按余弦距离排序时用不上索引，每次搜索都是全表扫描。
+--
+-- 执行前注意：
+-- 1. 现有向量必须都是 1536 维，否则类型转换会失败，可以先用下面的语句检查
+--    select count(*) from video_storyboard where vector_dims(content_vector) <> 1536;
+-- 2. HNSW 建索引期间会占用较多内存，可在当前会话调大 maintenance_work_mem
+-- 3. 数据量较大时可以把第 3 步单独拿出来，改为 create index concurrently 执行（不能放在事务中）
+
+begin;
+
+-- 1. 向量列指定维度
+alter table video_storyboard alter column content_vector type vector(1536);
+
+-- 2. 删除错误的索引，补上常用字段的索引
+drop index if exists idx_shots_content_vector;
+create index if not exists idx_video_storyboard_material_id on video_storyboard (material_id);
+create index if not exists idx_video_storyboard_start_time on video_storyboard (start_time);
+create index if not exists idx_video_storyboard_tags on video_storyboard using gin (tags);
+
+-- 3. 余弦距离的 HNSW 索引
+set local maintenance_work_mem = '1GB';
+create index if not exists idx_video_storyboard_content_vector on video_storyboard
+    using hnsw (content_vector vector_cosine_ops) with (m = 16, ef_construction = 64);
+
+-- 4. match_videos 增加 ef_search / probes 参数
+-- 新参数带默认值，先删除旧函数，避免两个重载同时存在时按三个参数调用产生歧义
+drop function if exists match_videos(vector, float, int);
+
+-- 搜索函数，返回视频分镜信息
+-- Match documents using cosine distance (<=>)
+-- ef_search：HNSW 检索的候选集大小，越大召回率越高、速度越慢，为空时使用数据库默认值（40）
+-- probes：使用 IVFFlat 索引时扫描的聚类数量，为空时使用数据库默认值（1）
+-- 两个参数只在本次调用的事务内生效
+create or replace function match_videos (
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  ef_search int default null,
+  probes int default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  if ef_search is not null then
+    perform set_config('hnsw.ef_search', ef_search::text, true);
+  end if;
+  if probes is not null then
+    perform set_config('ivfflat.probes', probes::text, true);
+  end if;
+
+  return query
+  select
+    video_storyboard.shot_id,
+    video_storyboard.material_id,
+    video_storyboard.start_time,
+    video_storyboard.end_time,
+    video_storyboard.shot_content,
+    video_storyboard.subtitle,
+    video_storyboard.narration,
+    video_storyboard.tags,
+    video_storyboard.created_at,
+    1 - (video_storyboard.content_vector <=> query_embedding) as similarity
+  from video_storyboard
+  where video_storyboard.content_vector <=> query_embedding < 1 - match_threshold
+  order by video_storyboard.content_vector <=> query_embedding asc
+  limit least(match_count, 50);
+end;
+$$;
+
+commit;
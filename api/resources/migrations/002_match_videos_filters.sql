@@ -0,0 +1,108 @@
+-- 迁移：match_videos 支持素材属性过滤（filters 参数）
+-- 需要 pgvector >= 0.8（hnsw.iterative_scan），可用 select extversion from pg_extension where extname = 'vector' 确认
+-- 注意：match_videos 默认不再返回已删除素材（material.is_deleted）的分镜
+
+begin;
+
+create index if not exists idx_material_labels on material using gin (labels);
+create index if not exists idx_material_type_country on material (material_type, target_country);
+
+-- 新增带默认值的参数，先删除旧函数，避免重载产生歧义
+drop function if exists match_videos(vector, float, int, int, int);
+
+-- 搜索函数，返回视频分镜信息
+-- Match documents using cosine distance (<=>)
+-- ef_search：HNSW 检索的候选集大小，越大召回率越高、速度越慢，为空时使用数据库默认值（40）
+-- probes：使用 IVFFlat 索引时扫描的聚类数量，为空时使用数据库默认值（1）
+-- 两个参数只在本次调用的事务内生效
+-- filters：素材属性过滤条件，在向量检索的同一个查询中过滤，均为可选
+--   material_type / target_country：字符串数组，素材的值等于其中之一
+--   labels：字符串数组，素材 labels 与之有交集
+--   tags：JSON，分镜 tags 包含该值（@>，使用 tags 的 GIN 索引）
+--   include_deleted：是否包含已删除（is_deleted）的素材，默认不包含
+-- 带过滤条件时依赖 pgvector >= 0.8 的 iterative scan：索引返回的候选被过滤后不足 match_count 条时继续扫描，
+-- 一次调用即可返回完整的 top-k
+create or replace function match_videos (
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+declare
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  if ef_search is not null then
+    perform set_config('hnsw.ef_search', ef_search::text, true);
+  end if;
+  if probes is not null then
+    perform set_config('ivfflat.probes', probes::text, true);
+  end if;
+  perform set_config('hnsw.iterative_scan', 'relaxed_order', true);
+  perform set_config('ivfflat.iterative_scan', 'relaxed_order', true);
+
+  -- relaxed_order 下索引返回的顺序可能略有出入，先在 CTE 中取 top-k，再按距离重新排序；
+  -- 相似度阈值放在 CTE 外面，避免阈值过高时索引扫描一直找不到满足条件的行
+  return query
+  with candidates as materialized (
+    select
+      video_storyboard.shot_id,
+      video_storyboard.material_id,
+      video_storyboard.start_time,
+      video_storyboard.end_time,
+      video_storyboard.shot_content,
+      video_storyboard.subtitle,
+      video_storyboard.narration,
+      video_storyboard.tags,
+      video_storyboard.created_at,
+      video_storyboard.content_vector <=> query_embedding as distance
+    from video_storyboard
+    join material on material.material_id = video_storyboard.material_id
+    where (v_include_deleted or material.is_deleted is not true)
+      and (v_material_types is null or material.material_type = any(v_material_types))
+      and (v_target_countries is null or material.target_country = any(v_target_countries))
+      and (v_labels is null or material.labels && v_labels)
+      and (v_tags is null or video_storyboard.tags @> v_tags)
+    order by video_storyboard.content_vector <=> query_embedding asc
+    limit least(match_count, 50)
+  )
+  select
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  from candidates
+  where candidates.distance < 1 - match_threshold
+  order by candidates.distance asc;
+end;
+$$;
+
+commit;
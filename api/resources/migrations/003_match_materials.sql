@@ -0,0 +1,226 @@
+-- 迁移：新增按素材聚合的搜索函数 match_materials
+-- 检索参数设置和带过滤条件的候选检索拆成 set_vector_search_options / match_storyboard_candidates，
+-- 由 match_videos 和 match_materials 共用，match_videos 的参数和返回值不变
+
+begin;
+
+-- 设置本次调用（事务内）的向量检索参数，match_videos / match_materials 共用
+-- ef_search：HNSW 检索的候选集大小，越大召回率越高、速度越慢，为空时使用数据库默认值（40）
+-- probes：使用 IVFFlat 索引时扫描的聚类数量，为空时使用数据库默认值（1）
+-- 同时开启 pgvector >= 0.8 的 iterative scan：索引返回的候选被过滤后数量不足时继续扫描
+create or replace function set_vector_search_options (
+  ef_search int default null,
+  probes int default null
+)
+returns void
+language plpgsql
+as $$
+begin
+  if ef_search is not null then
+    perform set_config('hnsw.ef_search', ef_search::text, true);
+  end if;
+  if probes is not null then
+    perform set_config('ivfflat.probes', probes::text, true);
+  end if;
+  perform set_config('hnsw.iterative_scan', 'relaxed_order', true);
+  perform set_config('ivfflat.iterative_scan', 'relaxed_order', true);
+end;
+$$;
+
+
+-- 按余弦距离检索与查询向量最接近的 candidate_count 个分镜，match_videos / match_materials 共用
+-- filters：素材属性过滤条件，在向量检索的同一个查询中过滤，均为可选
+--   material_type / target_country：字符串数组，素材的值等于其中之一
+--   labels：字符串数组，素材 labels 与之有交集
+--   tags：JSON，分镜 tags 包含该值（@>，使用 tags 的 GIN 索引）
+--   include_deleted：是否包含已删除（is_deleted）的素材，默认不包含
+-- relaxed_order 下索引返回的顺序可能略有出入，调用方需按 distance 重新排序
+create or replace function match_storyboard_candidates (
+  query_embedding vector(1536),
+  candidate_count int,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  distance float
+)
+language plpgsql
+as $$
+declare
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  return query
+  select
+    video_storyboard.shot_id,
+    video_storyboard.material_id,
+    video_storyboard.start_time,
+    video_storyboard.end_time,
+    video_storyboard.shot_content,
+    video_storyboard.subtitle,
+    video_storyboard.narration,
+    video_storyboard.tags,
+    video_storyboard.created_at,
+    video_storyboard.content_vector <=> query_embedding as distance
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+  order by video_storyboard.content_vector <=> query_embedding asc
+  limit candidate_count;
+end;
+$$;
+
+
+-- 搜索函数，返回视频分镜信息
+-- Match documents using cosine distance (<=>)
+-- ef_search / probes 见 set_vector_search_options，filters 见 match_storyboard_candidates
+-- 相似度阈值在取出 top-k 之后再过滤，避免阈值过高时索引扫描一直找不到满足条件的行
+create or replace function match_videos (
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  select
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  from match_storyboard_candidates(query_embedding, least(match_count, 50), filters) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by candidates.distance asc;
+end;
+$$;
+
+
+-- 按素材聚合的搜索函数，返回最相关的素材及其最匹配的分镜
+-- 先取最相似的 candidate_count 个分镜，再按素材分组打分：
+--   aggregate_mode = 'max'：素材得分为其分镜的最高相似度
+--   aggregate_mode = 'mean_top_n'：素材得分为其最相似的 top_n 个分镜的平均相似度（命中分镜不足 top_n 个时按实际数量平均）
+-- shots 为该素材最相似的 shots_per_material 个分镜（JSON 数组，按相似度降序）
+create or replace function match_materials (
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  aggregate_mode text default 'max',
+  top_n int default 3,
+  shots_per_material int default 3,
+  candidate_count int default 500,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  material_id int,
+  material_name text,
+  material_type text,
+  file_path text,
+  score float,
+  max_similarity float,
+  shot_count int,
+  shots jsonb
+)
+language plpgsql
+as $$
+begin
+  if aggregate_mode not in ('max', 'mean_top_n') then
+    raise exception 'unsupported aggregate_mode: %', aggregate_mode;
+  end if;
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  with hits as (
+    select
+      candidates.*,
+      1 - candidates.distance as similarity,
+      row_number() over (
+        partition by candidates.material_id
+        order by candidates.distance asc, candidates.shot_id asc
+      ) as shot_rank
+    from match_storyboard_candidates(query_embedding, least(candidate_count, 2000), filters) as candidates
+    where candidates.distance < 1 - match_threshold
+  ),
+  grouped as (
+    select
+      hits.material_id,
+      case when aggregate_mode = 'max' then max(hits.similarity)
+        else avg(hits.similarity) filter (where hits.shot_rank <= top_n)
+      end as score,
+      max(hits.similarity) as max_similarity,
+      count(*)::int as shot_count,
+      jsonb_agg(
+        jsonb_build_object(
+          'shot_id', hits.shot_id,
+          'start_time', hits.start_time,
+          'end_time', hits.end_time,
+          'shot_content', hits.shot_content,
+          'subtitle', hits.subtitle,
+          'narration', hits.narration,
+          'tags', hits.tags,
+          'similarity', hits.similarity
+        ) order by hits.shot_rank
+      ) filter (where hits.shot_rank <= shots_per_material) as shots
+    from hits
+    group by hits.material_id
+  )
+  select
+    grouped.material_id,
+    material.material_name::text,
+    material.material_type::text,
+    material.file_path,
+    grouped.score,
+    grouped.max_similarity,
+    grouped.shot_count,
+    grouped.shots
+  from grouped
+  join material on material.material_id = grouped.material_id
+  order by grouped.score desc, grouped.material_id asc
+  limit least(match_count, 50);
+end;
+$$;
+
+commit;
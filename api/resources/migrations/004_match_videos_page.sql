@@ -0,0 +1,159 @@
+-- 迁移：新增分页搜索函数 match_videos_page
+-- set_vector_search_options 增加 iterative_scan 参数，match_storyboard_candidates 增加分页游标参数，
+-- 新增带默认值的参数需要先删除旧函数；match_videos / match_materials 在运行时按新签名调用，不需要重建
+
+begin;
+
+drop function if exists set_vector_search_options(int, int);
+drop function if exists match_storyboard_candidates(vector, int, jsonb);
+
+-- 设置本次调用（事务内）的向量检索参数，match_videos / match_materials / match_videos_page 共用
+-- ef_search：HNSW 检索的候选集大小，越大召回率越高、速度越慢，为空时使用数据库默认值（40）
+-- probes：使用 IVFFlat 索引时扫描的聚类数量，为空时使用数据库默认值（1）
+-- 同时开启 pgvector >= 0.8 的 iterative scan：索引返回的候选被过滤后数量不足时继续扫描
+-- iterative_scan：HNSW 的扫描方式，relaxed_order 更快但顺序可能略有出入；分页时使用 strict_order 保证翻页不遗漏
+--   （IVFFlat 只支持 relaxed_order）
+create or replace function set_vector_search_options (
+  ef_search int default null,
+  probes int default null,
+  iterative_scan text default 'relaxed_order'
+)
+returns void
+language plpgsql
+as $$
+begin
+  if ef_search is not null then
+    perform set_config('hnsw.ef_search', ef_search::text, true);
+  end if;
+  if probes is not null then
+    perform set_config('ivfflat.probes', probes::text, true);
+  end if;
+  perform set_config('hnsw.iterative_scan', iterative_scan, true);
+  perform set_config('ivfflat.iterative_scan', 'relaxed_order', true);
+end;
+$$;
+
+
+-- 按余弦距离检索与查询向量最接近的 candidate_count 个分镜，match_videos / match_materials 共用
+-- filters：素材属性过滤条件，在向量检索的同一个查询中过滤，均为可选
+--   material_type / target_country：字符串数组，素材的值等于其中之一
+--   labels：字符串数组，素材 labels 与之有交集
+--   tags：JSON，分镜 tags 包含该值（@>，使用 tags 的 GIN 索引）
+--   include_deleted：是否包含已删除（is_deleted）的素材，默认不包含
+-- after_similarity / after_shot_id：分页游标，只返回排在该分镜之后的分镜（按相似度降序、shot_id 升序）
+-- relaxed_order 下索引返回的顺序可能略有出入，调用方需按 distance 重新排序
+create or replace function match_storyboard_candidates (
+  query_embedding vector(1536),
+  candidate_count int,
+  filters jsonb default null,
+  after_similarity float default null,
+  after_shot_id int default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  distance float
+)
+language plpgsql
+as $$
+declare
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  return query
+  select
+    video_storyboard.shot_id,
+    video_storyboard.material_id,
+    video_storyboard.start_time,
+    video_storyboard.end_time,
+    video_storyboard.shot_content,
+    video_storyboard.subtitle,
+    video_storyboard.narration,
+    video_storyboard.tags,
+    video_storyboard.created_at,
+    video_storyboard.content_vector <=> query_embedding as distance
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+    -- 相似度的计算方式与返回给调用方的 similarity 完全一致，游标中的值可以精确比较
+    and (after_similarity is null
+      or 1 - (video_storyboard.content_vector <=> query_embedding) < after_similarity
+      or (1 - (video_storyboard.content_vector <=> query_embedding) = after_similarity
+        and video_storyboard.shot_id > after_shot_id))
+  order by video_storyboard.content_vector <=> query_embedding asc
+  limit candidate_count;
+end;
+$$;
+
+
+-- 分页的搜索函数，按 (similarity 降序, shot_id 升序) 做 keyset 分页，没有 50 条的上限
+-- 第一页 after_similarity / after_shot_id 传空，之后传上一页最后一条的 similarity 和 shot_id；
+-- 返回条数少于 page_size 说明没有下一页。翻页越深索引扫描的行数越多，但每页返回的数据量不变
+create or replace function match_videos_page (
+  query_embedding vector(1536),
+  match_threshold float,
+  page_size int,
+  after_similarity float default null,
+  after_shot_id int default null,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes, 'strict_order');
+
+  return query
+  select
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  -- 索引只能按距离排序，相同向量（距离完全相同）的分镜在页边界上的先后不确定，
+  -- 多取一些候选后再按 (similarity, shot_id) 排序截断，保证与游标的比较方式一致
+  from match_storyboard_candidates(
+    query_embedding, least(page_size, 200) + 50, filters, after_similarity, after_shot_id
+  ) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by 1 - candidates.distance desc, candidates.shot_id asc
+  limit least(page_size, 200);
+end;
+$$;
+
+commit;
@@ -0,0 +1,56 @@
+-- 迁移：新增批量搜索函数 match_videos_batch
+
+begin;
+
+-- 批量搜索函数，一次调用检索多个查询向量，返回每个查询的 top-k 分镜
+-- query_embeddings 为 JSON 数组，每个元素是一个 1536 维向量；返回结果中的 query_index 为查询在数组中的下标（从 0 开始）
+-- 其它参数与 match_videos 一致，所有查询共用
+create or replace function match_videos_batch (
+  query_embeddings jsonb,
+  match_threshold float,
+  match_count int,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  query_index int,
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  select
+    (queries.ordinality - 1)::int as query_index,
+    candidates.shot_id,
+    candidates.material_id,
+    candidates.start_time,
+    candidates.end_time,
+    candidates.shot_content,
+    candidates.subtitle,
+    candidates.narration,
+    candidates.tags,
+    candidates.created_at,
+    1 - candidates.distance as similarity
+  from jsonb_array_elements(query_embeddings) with ordinality as queries(embedding, ordinality)
+  cross join lateral match_storyboard_candidates(
+    queries.embedding::text::vector(1536), least(match_count, 50), filters
+  ) as candidates
+  where candidates.distance < 1 - match_threshold
+  order by queries.ordinality asc, candidates.distance asc;
+end;
+$$;
+
+commit;
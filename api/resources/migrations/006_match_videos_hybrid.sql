@@ -0,0 +1,147 @@
+-- 迁移：分镜文本的关键词检索（pg_trgm）和混合检索函数 match_videos_hybrid
+-- 新增的生成列会重写 video_storyboard 表，数据量大时请在低峰期执行
+-- 已知限制：
+-- 1. 三元组需要至少 3 个字符，少于 3 个字符的查询（包括中文的两字词）用不上 gin_trgm_ops 索引；
+--    013_lexical_short_query.sql 让这类查询跳过关键词检索，只做向量检索
+-- 2. 中日韩文字需要数据库的 LC_CTYPE 不是 C（如 en_US.UTF-8、C.UTF-8），否则 pg_trgm 不会为这些字符提取三元组
+-- 3. match_videos_hybrid 中的两路检索是先后执行的，耗时是两路之和
+
+begin;
+
+create extension if not exists pg_trgm with schema public;
+
+alter table video_storyboard add column if not exists search_text text generated always as (
+  coalesce(shot_content, '') || ' ' || coalesce(subtitle, '') || ' ' || coalesce(narration, '')
+) stored;
+
+create index if not exists idx_video_storyboard_search_text on video_storyboard using gin (search_text gin_trgm_ops);
+
+-- 关键词检索分镜，返回关键词得分最高的 candidate_count 个分镜，match_videos_hybrid 使用
+-- 命中条件：search_text 包含完整的查询文本（ILIKE），或与查询文本的词相似度达到 pg_trgm.word_similarity_threshold（<%）
+-- lexical_score：包含完整查询文本时为 1，否则为词相似度（0 ~ 1）
+-- 查询文本去掉首尾空白后少于 3 个字符时无法提取三元组，索引用不上，ILIKE 会扫描整个表，
+-- 因此不做关键词检索、直接返回空，match_videos_hybrid 退化为只有向量检索
+-- （中文的两字词如"口红"也属于这种情况，需要关键词匹配时请用更长的查询文本）
+-- filters 与 match_storyboard_candidates 一致
+create or replace function match_storyboard_lexical (
+  query_text text,
+  candidate_count int,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  lexical_score float
+)
+language plpgsql
+as $$
+declare
+  v_pattern text := '%' || replace(replace(replace(query_text, '\', '\\'), '%', '\%'), '_', '\_') || '%';
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  return query
+  select
+    video_storyboard.shot_id,
+    case when video_storyboard.search_text ilike v_pattern then 1.0
+      else word_similarity(query_text, video_storyboard.search_text)
+    end::float
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (video_storyboard.search_text ilike v_pattern or query_text <% video_storyboard.search_text)
+    and (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+  order by 2 desc, 1 asc
+  limit candidate_count;
+end;
+$$;
+
+
+-- 混合检索函数：关键词检索和向量检索各取 candidate_count 个候选，用倒数排名融合（RRF）合并排序
+-- rrf_score = sum(1 / (rrf_k + 排名))，只被一路命中的分镜只计算一项
+-- similarity 为向量相似度（所有结果都会计算），lexical_score 为关键词得分（未被关键词命中时为空）
+-- match_threshold 只作用于向量检索的候选；其它参数与 match_videos 一致
+-- 两路检索在同一条语句中先后执行（CTE 不会并行），耗时是两路之和；查询文本少于 3 个字符时只有向量检索
+create or replace function match_videos_hybrid (
+  query_text text,
+  query_embedding vector(1536),
+  match_threshold float,
+  match_count int,
+  candidate_count int default 100,
+  rrf_k int default 60,
+  ef_search int default null,
+  probes int default null,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  material_id int,
+  start_time float,
+  end_time float,
+  shot_content text,
+  subtitle text,
+  narration text,
+  tags jsonb,
+  created_at timestamp,
+  similarity float,
+  lexical_score float,
+  rrf_score float
+)
+language plpgsql
+as $$
+begin
+  perform set_vector_search_options(ef_search, probes);
+
+  return query
+  with vector_hits as (
+    select
+      candidates.shot_id,
+      row_number() over (order by candidates.distance asc, candidates.shot_id asc) as hit_rank
+    from match_storyboard_candidates(query_embedding, least(candidate_count, 1000), filters) as candidates
+    where candidates.distance < 1 - match_threshold
+  ),
+  lexical_hits as (
+    select
+      lexical.shot_id,
+      lexical.lexical_score,
+      row_number() over (order by lexical.lexical_score desc, lexical.shot_id asc) as hit_rank
+    from match_storyboard_lexical(query_text, least(candidate_count, 1000), filters) as lexical
+  ),
+  fused as (
+    select
+      coalesce(vector_hits.shot_id, lexical_hits.shot_id) as fused_shot_id,
+      lexical_hits.lexical_score as fused_lexical_score,
+      coalesce(1.0 / (rrf_k + vector_hits.hit_rank), 0)
+        + coalesce(1.0 / (rrf_k + lexical_hits.hit_rank), 0) as fused_score
+    from vector_hits
+    full outer join lexical_hits on lexical_hits.shot_id = vector_hits.shot_id
+  )
+  select
+    video_storyboard.shot_id,
+    video_storyboard.material_id,
+    video_storyboard.start_time,
+    video_storyboard.end_time,
+    video_storyboard.shot_content,
+    video_storyboard.subtitle,
+    video_storyboard.narration,
+    video_storyboard.tags,
+    video_storyboard.created_at,
+    1 - (video_storyboard.content_vector <=> query_embedding) as similarity,
+    fused.fused_lexical_score,
+    fused.fused_score::float
+  from fused
+  join video_storyboard on video_storyboard.shot_id = fused.fused_shot_id
+  order by fused.fused_score desc, video_storyboard.shot_id asc
+  limit least(match_count, 50);
+end;
+$$;
+
+commit;
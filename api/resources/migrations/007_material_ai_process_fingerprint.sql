@@ -0,0 +1,5 @@
+-- 迁移：material 增加视频内容指纹，视频未变化时跳过重复拆解
+
+alter table material add column if not exists ai_process_fingerprint text;
+
+comment on column material.ai_process_fingerprint is '上次拆解完成时的视频内容指纹（GCS generation/md5 + 模型 + 提示词版本），未变化时不再重复拆解';
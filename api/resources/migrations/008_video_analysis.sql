@@ -0,0 +1,40 @@
+-- 迁移：保存完整分析结果的 video_analysis 表，批量更新分镜向量的 update_storyboard_vectors
+
+begin;
+
+-- 视频分析结果表，保存 Gemini 返回的完整分析结果（每个素材保留最近一次）
+-- 修改 embedding 模型或分镜文本的拼接方式时，可以基于这里和 video_storyboard 重新生成向量，不需要重新分析视频
+CREATE TABLE IF NOT EXISTS video_analysis (
+    material_id INT PRIMARY KEY,                -- 关联 material 表
+    fingerprint TEXT,                           -- 分析时的视频内容指纹，与 material.ai_process_fingerprint 一致
+    analysis_model VARCHAR(100) NOT NULL,       -- 分析使用的模型
+    prompt_version VARCHAR(50) NOT NULL,        -- 提示词和 schema 的版本
+    video_brief TEXT,                           -- 视频简介
+    metadata JSONB,                             -- 视频元数据
+    raw JSONB NOT NULL,                         -- 完整的分析结果（包含 shots）
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
+-- 批量更新分镜向量，重新生成 embedding（如更换模型）时使用
+-- p_vectors 为数组，每个元素包含 shot_id 和 content_vector（为 null 时置空向量），返回更新的行数
+create or replace function update_storyboard_vectors (
+  p_vectors jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  v_count int;
+begin
+  update video_storyboard
+  set content_vector = (item ->> 'content_vector')::vector
+  from jsonb_array_elements(p_vectors) as item
+  where video_storyboard.shot_id = (item ->> 'shot_id')::int;
+
+  get diagnostics v_count = row_count;
+  return v_count;
+end;
+$$;
+
+commit;
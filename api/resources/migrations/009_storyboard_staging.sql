@@ -0,0 +1,123 @@
+-- 迁移：流式处理视频使用的分镜暂存表 video_storyboard_staging，以及 stage_storyboard / publish_storyboard
+
+begin;
+
+-- 流式处理视频时逐批写入的分镜，全部写完后由 publish_storyboard 一次性替换 video_storyboard 中该素材的分镜
+-- 搜索只读取 video_storyboard，处理过程中不会看到只写入了一部分的分镜
+CREATE TABLE IF NOT EXISTS video_storyboard_staging (
+    run_id VARCHAR(32) NOT NULL,                -- 本次处理的标识
+    seq INT NOT NULL,                           -- 分镜在视频中的顺序
+    material_id INT NOT NULL,                   -- 关联 material 表
+    start_time FLOAT NOT NULL,
+    end_time FLOAT NOT NULL,
+    shot_content TEXT,
+    subtitle TEXT,
+    narration TEXT,
+    tags JSONB,
+    content_vector VECTOR(1536),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_video_storyboard_staging_material_id ON video_storyboard_staging (material_id);
+
+-- 流式处理时写入一批分镜到暂存表，p_shots 为数组，每个元素包含 seq 和分镜字段，返回写入的行数
+create or replace function stage_storyboard (
+  p_material_id int,
+  p_run_id text,
+  p_shots jsonb
+)
+returns int
+language plpgsql
+as $$
+declare
+  v_count int;
+begin
+  insert into video_storyboard_staging (
+    run_id,
+    seq,
+    material_id,
+    start_time,
+    end_time,
+    shot_content,
+    subtitle,
+    narration,
+    tags,
+    content_vector
+  )
+  select
+    p_run_id,
+    (shot ->> 'seq')::int,
+    p_material_id,
+    (shot ->> 'start_time')::float,
+    (shot ->> 'end_time')::float,
+    shot ->> 'shot_content',
+    shot ->> 'subtitle',
+    shot ->> 'narration',
+    shot -> 'tags',
+    (shot ->> 'content_vector')::vector
+  from jsonb_array_elements(p_shots) as shot
+  -- 重试的批次覆盖已写入的分镜
+  on conflict (run_id, seq) do update set
+    start_time = excluded.start_time,
+    end_time = excluded.end_time,
+    shot_content = excluded.shot_content,
+    subtitle = excluded.subtitle,
+    narration = excluded.narration,
+    tags = excluded.tags,
+    content_vector = excluded.content_vector;
+
+  get diagnostics v_count = row_count;
+  return v_count;
+end;
+$$;
+
+-- 发布暂存的分镜：在一个事务中删除素材原有的分镜，按 seq 顺序写入本次暂存的分镜并清空暂存，
+-- 与 replace_storyboard 一样对同一素材串行执行；同时清理该素材一天前未发布的暂存（处理中断时遗留）
+create or replace function publish_storyboard (
+  p_material_id int,
+  p_run_id text
+)
+returns table (
+  shot_id int,
+  created_at timestamp
+)
+language plpgsql
+as $$
+begin
+  perform pg_advisory_xact_lock(p_material_id);
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  return query
+  insert into video_storyboard (
+    material_id,
+    start_time,
+    end_time,
+    shot_content,
+    subtitle,
+    narration,
+    tags,
+    content_vector
+  )
+  select
+    p_material_id,
+    s.start_time,
+    s.end_time,
+    s.shot_content,
+    s.subtitle,
+    s.narration,
+    s.tags,
+    s.content_vector
+  from video_storyboard_staging s
+  where s.run_id = p_run_id
+  order by s.seq
+  returning video_storyboard.shot_id, video_storyboard.created_at;
+
+  delete from video_storyboard_staging s
+  where s.run_id = p_run_id
+     or (s.material_id = p_material_id and s.created_at < now() - interval '1 day');
+end;
+$$;
+
+commit;
@@ -0,0 +1,7 @@
+-- 迁移：video_analysis 增加 routing 列，记录每个素材的模型路由决策
+
+begin;
+
+ALTER TABLE video_analysis ADD COLUMN IF NOT EXISTS routing JSONB;
+
+commit;
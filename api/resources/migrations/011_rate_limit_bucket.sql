@@ -0,0 +1,81 @@
+-- 迁移：所有实例共享的限流令牌桶 rate_limit_bucket，以及 acquire_rate_limit / adjust_rate_limit
+
+begin;
+
+-- 所有实例共享的 Gemini / embedding 限流令牌桶（RATE_LIMIT_BACKEND=supabase 时使用），每个模型一行
+CREATE TABLE IF NOT EXISTS rate_limit_bucket (
+    key VARCHAR(200) PRIMARY KEY,               -- 令牌桶标识（模型名称）
+    requests DOUBLE PRECISION NOT NULL,         -- 剩余的请求数
+    tokens DOUBLE PRECISION NOT NULL,           -- 剩余的 token 数，按实际用量修正后可能为负
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT clock_timestamp()
+);
+
+-- 从共享令牌桶中取出 p_requests 个请求和 p_tokens 个 token，与 rate_limit_helper.LocalRateLimitBackend.acquire 的逻辑一致：
+-- 先按经过的时间补充（不超过 p_burst_seconds 秒的配额），两个桶都足够时扣除并返回 0，否则返回还需要等待的秒数
+-- p_rpm / p_tpm 为 0 时不限制对应的桶
+create or replace function acquire_rate_limit (
+  p_key text,
+  p_requests float,
+  p_tokens float,
+  p_rpm float,
+  p_tpm float,
+  p_burst_seconds float
+)
+returns float
+language plpgsql
+as $$
+declare
+  v_bucket rate_limit_bucket%rowtype;
+  v_now timestamptz := clock_timestamp();
+  v_elapsed float;
+  v_request_capacity float := p_rpm * p_burst_seconds / 60;
+  v_token_capacity float := p_tpm * p_burst_seconds / 60;
+  v_wait float := 0;
+begin
+  insert into rate_limit_bucket (key, requests, tokens, updated_at)
+  values (p_key, v_request_capacity, v_token_capacity, v_now)
+  on conflict (key) do nothing;
+
+  select * into v_bucket from rate_limit_bucket where key = p_key for update;
+  v_elapsed := greatest(extract(epoch from v_now - v_bucket.updated_at), 0);
+
+  if p_rpm > 0 then
+    v_bucket.requests := least(v_request_capacity, v_bucket.requests + v_elapsed * p_rpm / 60);
+    v_wait := greatest(v_wait, (least(p_requests, v_request_capacity) - v_bucket.requests) * 60 / p_rpm);
+  end if;
+  if p_tpm > 0 then
+    v_bucket.tokens := least(v_token_capacity, v_bucket.tokens + v_elapsed * p_tpm / 60);
+    v_wait := greatest(v_wait, (least(p_tokens, v_token_capacity) - v_bucket.tokens) * 60 / p_tpm);
+  end if;
+
+  if v_wait <= 0 then
+    if p_rpm > 0 then
+      v_bucket.requests := v_bucket.requests - p_requests;
+    end if;
+    if p_tpm > 0 then
+      v_bucket.tokens := v_bucket.tokens - p_tokens;
+    end if;
+  end if;
+
+  update rate_limit_bucket
+  set requests = v_bucket.requests, tokens = v_bucket.tokens, updated_at = v_now
+  where key = p_key;
+
+  return greatest(v_wait, 0);
+end;
+$$;
+
+-- 按实际用量修正共享令牌桶，p_tokens 为实际用量减去预估用量，可以为负
+create or replace function adjust_rate_limit (
+  p_key text,
+  p_tokens float
+)
+returns void
+language sql
+as $$
+  update rate_limit_bucket
+  set tokens = tokens - p_tokens
+  where key = p_key;
+$$;
+
+commit;
@@ -0,0 +1,64 @@
+-- 迁移：publish_storyboard 可以安全重试，本次暂存已经发布过时直接返回素材当前的分镜，不会清空分镜
+
+begin;
+
+-- 发布暂存的分镜：在一个事务中删除素材原有的分镜，按 seq 顺序写入本次暂存的分镜并清空暂存，
+-- 与 replace_storyboard 一样对同一素材串行执行；同时清理该素材一天前未发布的暂存（处理中断时遗留）
+-- 本次暂存已经发布过（上一次调用已提交但响应丢失，客户端重试）时不再修改，直接返回素材当前的分镜
+create or replace function publish_storyboard (
+  p_material_id int,
+  p_run_id text
+)
+returns table (
+  shot_id int,
+  created_at timestamp
+)
+language plpgsql
+as $$
+begin
+  perform pg_advisory_xact_lock(p_material_id);
+
+  if not exists (select 1 from video_storyboard_staging s where s.run_id = p_run_id) then
+    return query
+    select v.shot_id, v.created_at
+    from video_storyboard v
+    where v.material_id = p_material_id
+    order by v.shot_id;
+    return;
+  end if;
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  return query
+  insert into video_storyboard (
+    material_id,
+    start_time,
+    end_time,
+    shot_content,
+    subtitle,
+    narration,
+    tags,
+    content_vector
+  )
+  select
+    p_material_id,
+    s.start_time,
+    s.end_time,
+    s.shot_content,
+    s.subtitle,
+    s.narration,
+    s.tags,
+    s.content_vector
+  from video_storyboard_staging s
+  where s.run_id = p_run_id
+  order by s.seq
+  returning video_storyboard.shot_id, video_storyboard.created_at;
+
+  delete from video_storyboard_staging s
+  where s.run_id = p_run_id
+     or (s.material_id = p_material_id and s.created_at < now() - interval '1 day');
+end;
+$$;
+
+commit;
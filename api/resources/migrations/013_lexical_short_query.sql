@@ -0,0 +1,58 @@
+-- 迁移：查询文本少于 3 个字符时关键词检索直接返回空，混合检索只做向量检索，
+-- 避免三元组索引用不上时 ILIKE 扫描整个 video_storyboard 表（见 006_match_videos_hybrid.sql 的已知限制）
+
+begin;
+
+-- 关键词检索分镜，返回关键词得分最高的 candidate_count 个分镜，match_videos_hybrid 使用
+-- 命中条件：search_text 包含完整的查询文本（ILIKE），或与查询文本的词相似度达到 pg_trgm.word_similarity_threshold（<%）
+-- lexical_score：包含完整查询文本时为 1，否则为词相似度（0 ~ 1）
+-- 查询文本去掉首尾空白后少于 3 个字符时无法提取三元组，索引用不上，ILIKE 会扫描整个表，
+-- 因此不做关键词检索、直接返回空，match_videos_hybrid 退化为只有向量检索
+-- （中文的两字词如"口红"也属于这种情况，需要关键词匹配时请用更长的查询文本）
+-- filters 与 match_storyboard_candidates 一致
+create or replace function match_storyboard_lexical (
+  query_text text,
+  candidate_count int,
+  filters jsonb default null
+)
+returns table (
+  shot_id int,
+  lexical_score float
+)
+language plpgsql
+as $$
+declare
+  v_pattern text := '%' || replace(replace(replace(query_text, '\', '\\'), '%', '\%'), '_', '\_') || '%';
+  v_material_types text[] := case when filters ? 'material_type'
+    then array(select jsonb_array_elements_text(filters -> 'material_type')) end;
+  v_target_countries text[] := case when filters ? 'target_country'
+    then array(select jsonb_array_elements_text(filters -> 'target_country')) end;
+  v_labels text[] := case when filters ? 'labels'
+    then array(select jsonb_array_elements_text(filters -> 'labels')) end;
+  v_tags jsonb := filters -> 'tags';
+  v_include_deleted boolean := coalesce((filters ->> 'include_deleted')::boolean, false);
+begin
+  if char_length(btrim(query_text)) < 3 then
+    return;
+  end if;
+
+  return query
+  select
+    video_storyboard.shot_id,
+    case when video_storyboard.search_text ilike v_pattern then 1.0
+      else word_similarity(query_text, video_storyboard.search_text)
+    end::float
+  from video_storyboard
+  join material on material.material_id = video_storyboard.material_id
+  where (video_storyboard.search_text ilike v_pattern or query_text <% video_storyboard.search_text)
+    and (v_include_deleted or material.is_deleted is not true)
+    and (v_material_types is null or material.material_type = any(v_material_types))
+    and (v_target_countries is null or material.target_country = any(v_target_countries))
+    and (v_labels is null or material.labels && v_labels)
+    and (v_tags is null or video_storyboard.tags @> v_tags)
+  order by 2 desc, 1 asc
+  limit candidate_count;
+end;
+$$;
+
+commit;
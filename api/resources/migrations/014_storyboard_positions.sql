@@ -0,0 +1,139 @@
+-- 迁移：replace_storyboard / publish_storyboard 返回每个新分镜在输入中的位置（idx / seq），
+-- 调用方按位置对应分镜和 shot_id，不再依赖 insert ... returning 的返回顺序
+-- 返回类型变化，需要先删除旧函数
+
+begin;
+
+drop function if exists replace_storyboard(int, jsonb);
+drop function if exists publish_storyboard(int, text);
+
+-- 批量替换素材的全部分镜信息
+-- 在同一个事务中删除旧分镜并插入新分镜，读者不会看到只写了一半的分镜
+-- p_shots 为分镜数组，每个元素包含 start_time、end_time、shot_content、subtitle、narration、tags、content_vector
+-- 返回每个新分镜的 shot_id、created_at 和它在 p_shots 中的位置 idx（从 0 开始），调用方按 idx 对应分镜，不依赖返回的顺序
+create or replace function replace_storyboard (
+  p_material_id int,
+  p_shots jsonb
+)
+returns table (
+  shot_id int,
+  created_at timestamp,
+  idx int
+)
+language plpgsql
+as $$
+declare
+  v_shot jsonb;
+  v_ordinality bigint;
+begin
+  -- 同一素材的并发替换串行执行
+  perform pg_advisory_xact_lock(p_material_id);
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  -- 按 p_shots 的顺序逐个插入，shot_id 随位置递增
+  for v_shot, v_ordinality in
+    select s.shot, s.ordinality
+    from jsonb_array_elements(p_shots) with ordinality as s(shot, ordinality)
+    order by s.ordinality
+  loop
+    insert into video_storyboard (
+      material_id,
+      start_time,
+      end_time,
+      shot_content,
+      subtitle,
+      narration,
+      tags,
+      content_vector
+    )
+    values (
+      p_material_id,
+      (v_shot ->> 'start_time')::float,
+      (v_shot ->> 'end_time')::float,
+      v_shot ->> 'shot_content',
+      v_shot ->> 'subtitle',
+      v_shot ->> 'narration',
+      v_shot -> 'tags',
+      (v_shot ->> 'content_vector')::vector
+    )
+    returning video_storyboard.shot_id, video_storyboard.created_at into shot_id, created_at;
+    idx := v_ordinality - 1;
+    return next;
+  end loop;
+end;
+$$;
+
+-- 发布暂存的分镜：在一个事务中删除素材原有的分镜，按 seq 顺序写入本次暂存的分镜并清空暂存，
+-- 与 replace_storyboard 一样对同一素材串行执行；同时清理该素材一天前未发布的暂存（处理中断时遗留）
+-- 返回每个新分镜的 shot_id、created_at 和它的暂存序号 seq，调用方按 seq 对应分镜，不依赖返回的顺序
+-- 本次暂存已经发布过（上一次调用已提交但响应丢失，客户端重试）时不再修改，直接返回素材当前的分镜；
+-- 发布时按 seq 顺序逐个插入，shot_id 随 seq 递增，此时按 shot_id 排序还原 seq（暂存的 seq 从 0 开始连续编号）
+-- 期间素材的分镜已被其它处理替换时，返回的行数和 seq 与本次暂存对不上，调用方据此跳过向量索引的更新
+create or replace function publish_storyboard (
+  p_material_id int,
+  p_run_id text
+)
+returns table (
+  shot_id int,
+  created_at timestamp,
+  seq int
+)
+language plpgsql
+as $$
+declare
+  v_staged video_storyboard_staging%rowtype;
+begin
+  perform pg_advisory_xact_lock(p_material_id);
+
+  if not exists (select 1 from video_storyboard_staging s where s.run_id = p_run_id) then
+    return query
+    select v.shot_id, v.created_at, (row_number() over (order by v.shot_id) - 1)::int
+    from video_storyboard v
+    where v.material_id = p_material_id
+    order by v.shot_id;
+    return;
+  end if;
+
+  delete from video_storyboard
+  where video_storyboard.material_id = p_material_id;
+
+  for v_staged in
+    select *
+    from video_storyboard_staging s
+    where s.run_id = p_run_id
+    order by s.seq
+  loop
+    insert into video_storyboard (
+      material_id,
+      start_time,
+      end_time,
+      shot_content,
+      subtitle,
+      narration,
+      tags,
+      content_vector
+    )
+    values (
+      p_material_id,
+      v_staged.start_time,
+      v_staged.end_time,
+      v_staged.shot_content,
+      v_staged.subtitle,
+      v_staged.narration,
+      v_staged.tags,
+      v_staged.content_vector
+    )
+    returning video_storyboard.shot_id, video_storyboard.created_at into shot_id, created_at;
+    seq := v_staged.seq;
+    return next;
+  end loop;
+
+  delete from video_storyboard_staging s
+  where s.run_id = p_run_id
+     or (s.material_id = p_material_id and s.created_at < now() - interval '1 day');
+end;
+$$;
+
+commit;
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from resilience_helper import bind_context
+
+# 流水线各阶段之间传递的结束标记
+_END = object()
+
+
+# 增量解析 generate_content_stream 返回的 JSON 文本，每当 shots 数组中的一个镜头对象完整时立即返回，
+# 不需要等待整个响应结束。只跟踪字符串、转义和括号层级，不校验 JSON 的其它语法，
+# 完整的结果在结束后由 result() 用 json.loads 解析。
+class ShotStreamParser:
+    def __init__(self, array_key: str = "shots"):
+        self.array_key = array_key
+        self._text = []
+        self._pos = 0
+        self._buffer = ""
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_key = None
+        self._in_array = False
+        self._item_start = None
+        self.count = 0
+
+    def feed(self, chunk: str) -> list:
+        """
+        输入新的一段文本，返回这段文本中完整结束的镜头对象
+
+        Args:
+            chunk (str): generate_content_stream 返回的一段文本
+
+        Returns:
+            list: 新完成的镜头（dict）列表
+        """
+        if not chunk:
+            return []
+        self._text.append(chunk)
+        self._buffer += chunk
+        shots = []
+
+        buffer = self._buffer
+        for i in range(self._pos, len(buffer)):
+            char = buffer[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    # 顶层对象中的字符串可能是键，遇到逗号时清除
+                    if len(self._stack) == 1:
+                        self._last_key = buffer[self._string_start + 1:i]
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                if char == "[" and len(self._stack) == 1 and self._last_key == self.array_key:
+                    self._in_array = True
+                elif char == "{" and self._in_array and len(self._stack) == 2:
+                    self._item_start = i
+                self._stack.append(char)
+            elif char in "}]":
+                self._stack.pop()
+                if char == "}" and self._in_array and len(self._stack) == 2 and self._item_start is not None:
+                    shots.append(json.loads(buffer[self._item_start:i + 1]))
+                    self._item_start = None
+                elif char == "]" and self._in_array and len(self._stack) == 1:
+                    self._in_array = False
+            elif char == "," and len(self._stack) == 1:
+                self._last_key = None
+
+        # 只保留尚未完成的镜头对象的文本，已处理的部分不再重复扫描
+        keep_from = self._item_start if self._item_start is not None else len(buffer)
+        if self._string_start is not None and self._in_string:
+            keep_from = min(keep_from, self._string_start)
+        self._buffer = buffer[keep_from:]
+        self._pos = len(buffer) - keep_from
+        if self._item_start is not None:
+            self._item_start -= keep_from
+        if self._string_start is not None:
+            self._string_start -= keep_from
+
+        self.count += len(shots)
+        return shots
+
+    def result(self) -> dict:
+        """解析完整的响应文本"""
+        return json.loads("".join(self._text))
+
+
+# 从队列中取出一个微批次：等待第一个元素，之后最多再等待 max_wait 秒凑满 batch_size 个
+# 返回 (batch, ended)，ended 为 True 表示已收到结束标记，或流水线已失败（stopped 被设置）
+def _take_batch(source: queue.Queue, batch_size: int, max_wait: float, stopped: threading.Event):
+    while True:
+        if stopped.is_set():
+            return [], True
+        try:
+            item = source.get(timeout=0.1)
+            break
+        except queue.Empty:
+            continue
+    if item is _END:
+        return [], True
+    batch = [item]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < batch_size:
+        try:
+            item = source.get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            break
+        if item is _END:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+# 流式处理单个视频的分镜：生成、embedding、写入三个阶段重叠执行
+# 1. 调用方线程读取 generate_content_stream，ShotStreamParser 解析出完整的镜头后放入 embedding 队列
+# 2. embedding 线程按微批次取出镜头生成向量，放入写入队列
+# 3. 写入线程按微批次调用 stage_storyboard 写入暂存表
+# 4. 生成结束且所有批次写完后，publish_storyboard 在一个事务中替换素材的分镜，搜索不会看到写了一半的分镜
+# 队列有界，下游变慢时上游阻塞，内存占用不随视频长度增长；任一阶段失败时其它阶段停止，暂存的分镜被清除
+class StreamingStoryboardPipeline:
+    def __init__(self, processor, batch_size: int = 8, max_wait: float = 0.2, queue_size: int = 64):
+        """
+        初始化 StreamingStoryboardPipeline 实例
+
+        Args:
+            processor (VideoAiProcessor): 提供 get_embedding、stage_storyboard、publish_storyboard、discard_staging
+            batch_size (int, optional): embedding 和写入的微批次大小
+            max_wait (float, optional): 凑满一个微批次最多等待的时间（秒）
+            queue_size (int, optional): 阶段之间队列的最大长度
+        """
+        self.processor = processor
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue_size = queue_size
+
+    def run(self, material_id: int, chunks, validate=None) -> dict:
+        """
+        处理一个视频的流式响应
+
+        Args:
+            material_id (int): 素材 ID
+            chunks (Iterable[str]): generate_content_stream 返回的文本片段
+            validate (callable, optional): 发布前校验完整的分析结果，不通过时抛出异常，暂存的分镜被丢弃
+
+        Returns:
+            dict: 完整的分析结果（video_brief、metadata、shots）
+        """
+        from genai_helper import build_shot_data, build_shot_text
+
+        run_id = uuid.uuid4().hex
+        embed_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        failed = threading.Event()
+        staged = []
+
+        def put(target: queue.Queue, item):
+            # 任一阶段失败后不再阻塞等待队列空位
+            while not failed.is_set():
+                try:
+                    target.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        def embed_stage():
+            try:
+                ended = False
+                while not ended:
+                    batch, ended = _take_batch(embed_queue, self.batch_size, self.max_wait, failed)
+                    if batch:
+                        vectors = self.processor.get_embedding([build_shot_text(shot) for _, shot in batch])
+                        for (seq, shot), vector in zip(batch, vectors):
+                            put(write_queue, dict(build_shot_data(shot, vector), seq=seq))
+                put(write_queue, _END)
+            except Exception:
+                failed.set()
+                raise
+
+        def write_stage():
+            try:
+                ended = False
+                while not ended:
+                    batch, ended = _take_batch(write_queue, self.batch_size, self.max_wait, failed)
+                    if batch:
+                        self.processor.stage_storyboard(material_id, run_id, batch)
+                        staged.extend(batch)
+            except Exception:
+                failed.set()
+                raise
+
+        parser = ShotStreamParser()
+        try:
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                # 写入阶段沿用调用方的截止时间
+                futures = [executor.submit(bind_context(embed_stage)), executor.submit(bind_context(write_stage))]
+                try:
+                    seq = 0
+                    for chunk in chunks:
+                        if failed.is_set():
+                            break
+                        for shot in parser.feed(chunk):
+                            put(embed_queue, (seq, shot))
+                            seq += 1
+                    put(embed_queue, _END)
+                except Exception:
+                    failed.set()
+                    raise
+                # 下游阶段的异常在这里抛出
+                for future in futures:
+                    future.result()
+
+            result = parser.result()
+            if validate is not None:
+                validate(result)
+            if len(result["shots"]) != len(staged):
+                raise ValueError(f"staged {len(staged)} shots while the response contains {len(result['shots'])}")
+
+            staged.sort(key=lambda shot: shot["seq"])
+            self.processor.publish_storyboard(material_id, run_id, staged)
+            return result
+        except Exception:
+            self.processor.discard_staging(run_id)
+            raise
+
+
+# 异步版本的 _take_batch，流水线失败时由调用方取消任务，不需要检查失败标记
+async def _atake_batch(source: asyncio.Queue, batch_size: int, max_wait: float):
+    item = await source.get()
+    if item is _END:
+        return [], True
+    batch = [item]
+    deadline = time.monotonic() + max_wait
+    while len(batch) < batch_size:
+        try:
+            item = await asyncio.wait_for(source.get(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            break
+        if item is _END:
+            return batch, True
+        batch.append(item)
+    return batch, False
+
+
+# StreamingStoryboardPipeline 的异步版本，三个阶段为同一事件循环中的任务，
+# processor 为 AsyncVideoAiProcessor，chunks 为异步迭代器
+class AsyncStreamingStoryboardPipeline(StreamingStoryboardPipeline):
+    async def run(self, material_id: int, chunks, validate=None) -> dict:
+        from genai_helper import build_shot_data, build_shot_text
+
+        run_id = uuid.uuid4().hex
+        embed_queue = asyncio.Queue(maxsize=self.queue_size)
+        write_queue = asyncio.Queue(maxsize=self.queue_size)
+        staged = []
+
+        async def embed_stage():
+            ended = False
+            while not ended:
+                batch, ended = await _atake_batch(embed_queue, self.batch_size, self.max_wait)
+                if batch:
+                    vectors = await self.processor.get_embedding([build_shot_text(shot) for _, shot in batch])
+                    for (seq, shot), vector in zip(batch, vectors):
+                        await write_queue.put(dict(build_shot_data(shot, vector), seq=seq))
+            await write_queue.put(_END)
+
+        async def write_stage():
+            ended = False
+            while not ended:
+                batch, ended = await _atake_batch(write_queue, self.batch_size, self.max_wait)
+                if batch:
+                    await self.processor.stage_storyboard(material_id, run_id, batch)
+                    staged.extend(batch)
+
+        async def generate_stage():
+            seq = 0
+            async for chunk in chunks:
+                for shot in parser.feed(chunk):
+                    await embed_queue.put((seq, shot))
+                    seq += 1
+            await embed_queue.put(_END)
+
+        parser = ShotStreamParser()
+        tasks = [asyncio.create_task(stage()) for stage in (generate_stage, embed_stage, write_stage)]
+        try:
+            # 任一阶段失败时取消其它阶段，避免阻塞在已满或已空的队列上
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+
+            result = parser.result()
+            if validate is not None:
+                validate(result)
+            if len(result["shots"]) != len(staged):
+                raise ValueError(f"staged {len(staged)} shots while the response contains {len(result['shots'])}")
+
+            staged.sort(key=lambda shot: shot["seq"])
+            await self.processor.publish_storyboard(material_id, run_id, staged)
+            return result
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.processor.discard_staging(run_id)
+            raise
@@ -4,10 +4,23 @@ import datetime
 import json
 import os
 from dotenv import load_dotenv
+from resilience_helper import get_dependency, remaining_time
 
 # 加载环境变量
 load_dotenv()
 
+
+def is_create_task_retryable(e):
+    """创建任务不是幂等的，只在请求确定没有被执行（限流 429、服务不可用 503）时重试，超时等结果未知的错误不重试"""
+    return getattr(e, 'code', None) in (429, 503)
+
+
+def deadline_options():
+    """设置了请求截止时间时，把剩余时间作为 Cloud Tasks 调用的超时"""
+    timeout = remaining_time()
+    return {'timeout': max(timeout, 0.1)} if timeout is not None else {}
+
+
 # 利用google cloud tasks 创建任务和查询任务
 class TaskService:
     def __init__(self, queue_name=None, project_id=None, location=None):
@@ -20,6 +33,8 @@ class TaskService:
             location (str, optional): 任务队列所在的区域，默认从环境变量获取
         """
         self.client = tasks_v2.CloudTasksClient()
+        # Cloud Tasks 调用的重试策略和熔断器，进程内共享
+        self.dependency = get_dependency("cloud_tasks")
         
         # 从环境变量读取项目ID和位置信息（如果未提供）
         self.project_id = project_id or os.getenv("GOOGLE_CLOUD_PROJECT")
@@ -91,8 +106,9 @@ class TaskService:
             task['schedule_time'] = timestamp
         
         # 创建任务
-        response = self.client.create_task(
-            request={"parent": self.parent, "task": task}
+        response = self.dependency.call(
+            lambda: self.client.create_task(request={"parent": self.parent, "task": task}, **deadline_options()),
+            retryable=is_create_task_retryable
         )
         
         return {
@@ -124,7 +140,9 @@ class TaskService:
         
         # 获取任务详情
         try:
-            response = self.client.get_task(request={"name": task_name})
+            response = self.dependency.call(
+                lambda: self.client.get_task(request={"name": task_name}, **deadline_options())
+            )
             
             # 格式化返回结果
             result = {
@@ -0,0 +1,824 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+from dotenv import load_dotenv
+
+# hnswlib 为可选依赖，未安装时只能使用暴力检索
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+load_dotenv()
+
+# 与 match_videos 返回的列保持一致（similarity 在检索时计算）
+STORYBOARD_COLUMNS = [
+    "shot_id",
+    "material_id",
+    "start_time",
+    "end_time",
+    "shot_content",
+    "subtitle",
+    "narration",
+    "tags",
+    "created_at",
+]
+
+# match_videos 单次最多返回的条数
+MAX_MATCH_COUNT = 50
+
+# 已删除素材列表的刷新间隔（秒），超过 3 倍间隔没有刷新时语义搜索改用数据库
+DELETED_REFRESH_INTERVAL = float(os.environ.get("VECTOR_INDEX_DELETED_REFRESH_INTERVAL", 30))
+
+
+def parse_vector(value) -> np.ndarray:
+    """PostgREST 以字符串 "[0.1,0.2,...]" 返回 vector 类型，统一转为 float32 数组"""
+    if isinstance(value, str):
+        value = json.loads(value)
+    return np.asarray(value, dtype=np.float32)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """按行做 L2 归一化，归一化后的内积即为余弦相似度"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# video_storyboard.content_vector 的进程内索引，检索结果与 match_videos 一致：
+# 余弦相似度大于 match_threshold 的分镜，按相似度降序，最多 least(match_count, 50) 条，不包括已删除素材的分镜。
+# 已删除的素材（material.is_deleted）由 refresh_deleted_materials 定期从数据库读取，软删除最多延迟一个刷新间隔生效
+class StoryboardVectorIndex:
+    def __init__(self, dim: int = 1536):
+        self.dim = dim
+        self.rows = {}
+        self.material_shots = {}
+        self.loaded_at = None
+        # 已从数据库同步到的最大 shot_id（高水位），保存在快照中，加载快照后从这里补齐之后的写入
+        self.high_water = 0
+        # 重建期间记录的写入（见 start_journal / hand_over），以及替换本索引的新索引
+        self._journal = None
+        self._successor = None
+        # 已删除的素材，检索时排除；刷新时间为 None 时尚未读取，不能代替 match_videos 检索
+        self.deleted_materials = set()
+        self.deleted_refreshed_at = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def upsert_rows(self, rows: list):
+        """
+        写入或更新分镜
+
+        Args:
+            rows (list): 分镜数据，包含 STORYBOARD_COLUMNS 中的字段以及 content_vector
+        """
+        # 同一批中重复的 shot_id 只保留最后一行，与数据库 upsert 的结果一致
+        rows = list({row["shot_id"]: row for row in rows if row.get("content_vector") is not None}.values())
+        if not rows:
+            return
+        vectors = normalize(np.stack([parse_vector(row["content_vector"]) for row in rows]))
+        with self._lock:
+            if self._forward("upsert_rows", rows):
+                return
+            for row in rows:
+                shot_id = row["shot_id"]
+                old = self.rows.get(shot_id)
+                if old is not None:
+                    self.material_shots.get(old["material_id"], set()).discard(shot_id)
+                self.rows[shot_id] = {column: row.get(column) for column in STORYBOARD_COLUMNS}
+                self.material_shots.setdefault(row["material_id"], set()).add(shot_id)
+            self._add_vectors([row["shot_id"] for row in rows], vectors)
+
+    def replace_material(self, material_id: int, rows: list):
+        """替换某个素材的所有分镜，与 replace_storyboard 对应"""
+        with self._lock:
+            self.remove_material(material_id)
+            self.upsert_rows(rows)
+
+    def remove_material(self, material_id: int):
+        """删除某个素材的所有分镜，与 clear_storyboard 对应"""
+        with self._lock:
+            if self._forward("remove_material", material_id):
+                return
+            shot_ids = self.material_shots.pop(material_id, set())
+            for shot_id in shot_ids:
+                self.rows.pop(shot_id, None)
+            if shot_ids:
+                self._remove_vectors(list(shot_ids))
+
+    def remove_shots(self, shot_ids: list):
+        """删除指定的分镜"""
+        with self._lock:
+            if self._forward("remove_shots", shot_ids):
+                return
+            removed = []
+            for shot_id in shot_ids:
+                row = self.rows.pop(shot_id, None)
+                if row is not None:
+                    self.material_shots.get(row["material_id"], set()).discard(shot_id)
+                    removed.append(shot_id)
+            if removed:
+                self._remove_vectors(removed)
+
+    def start_journal(self):
+        """开始记录写入，后台重建期间调用，重建完成后由 hand_over 在新索引上重放"""
+        with self._lock:
+            self._journal = []
+
+    def stop_journal(self):
+        """重建失败时停止记录写入"""
+        with self._lock:
+            self._journal = None
+
+    def hand_over(self, successor):
+        """
+        在新索引上重放重建期间的写入，之后本索引收到的写入（替换前取得本索引的调用方）转发给新索引
+
+        Args:
+            successor (StoryboardVectorIndex): 重建完成的新索引
+        """
+        with self._lock:
+            for method, args in self._journal or []:
+                getattr(successor, method)(*args)
+            self._journal = None
+            self._successor = successor
+
+    # 已被新索引替换时把写入转发给新索引，返回 True；重建期间记录写入。调用方持有 self._lock
+    def _forward(self, method: str, *args) -> bool:
+        if self._successor is not None:
+            getattr(self._successor, method)(*args)
+            return True
+        if self._journal is not None:
+            self._journal.append((method, args))
+        return False
+
+    def search(self, query_vector, match_threshold: float = 0.7, match_count: int = 10) -> list:
+        """
+        检索与查询向量最相似的分镜
+
+        Args:
+            query_vector (list): 查询向量
+            match_threshold (float): 相似度阈值
+            match_count (int): 返回结果数量，最多 50
+
+        Returns:
+            list: 分镜数据，附带 similarity 字段，按相似度降序
+        """
+        limit = min(match_count, MAX_MATCH_COUNT)
+        query = normalize(parse_vector(query_vector))
+        with self._lock:
+            if not self.rows:
+                return []
+            # 多取已删除素材的分镜数，过滤后仍有 limit 条
+            hidden = sum(len(self.material_shots.get(material_id, ())) for material_id in self.deleted_materials)
+            matches = self._search(query, limit + hidden)
+            results = []
+            for shot_id, similarity in matches:
+                if similarity <= match_threshold:
+                    continue
+                row = dict(self.rows[shot_id])
+                if row["material_id"] in self.deleted_materials:
+                    continue
+                row["similarity"] = float(similarity)
+                results.append(row)
+        return results[:limit]
+
+    def refresh_deleted_materials(self, supabase_client, page_size: int = 1000):
+        """从数据库读取所有已删除（is_deleted）的素材，检索时排除它们的分镜"""
+        deleted = set()
+        last_material_id = 0
+        while True:
+            response = (
+                supabase_client.table("material")
+                .select("material_id")
+                .eq("is_deleted", True)
+                .gt("material_id", last_material_id)
+                .order("material_id")
+                .limit(page_size)
+                .execute()
+            )
+            if not response.data:
+                break
+            deleted.update(row["material_id"] for row in response.data)
+            last_material_id = response.data[-1]["material_id"]
+        with self._lock:
+            self.deleted_materials = deleted
+            self.deleted_refreshed_at = time.monotonic()
+
+    def filters_deleted(self, max_age: float = None) -> bool:
+        """已删除素材列表在 max_age 秒（默认 3 倍刷新间隔）内刷新过时返回 True，否则检索结果可能包含已删除素材"""
+        max_age = max_age if max_age is not None else 3 * DELETED_REFRESH_INTERVAL
+        refreshed_at = self.deleted_refreshed_at
+        return refreshed_at is not None and time.monotonic() - refreshed_at <= max_age
+
+    def stats(self) -> dict:
+        """返回索引的实现、分镜数和同步状态，用于 /stats"""
+        with self._lock:
+            return {
+                "implementation": type(self).__name__,
+                "size": len(self.rows),
+                "high_water": self.high_water,
+                "loaded_at": self.loaded_at,
+                "deleted_materials": len(self.deleted_materials),
+                "filters_deleted": self.filters_deleted(),
+            }
+
+    def all_vectors(self):
+        """返回 (shot_id 列表, 归一化向量矩阵)，用于保存快照"""
+        raise NotImplementedError
+
+    def save(self, path: str):
+        """
+        保存快照，启动时可通过 load_snapshot 快速恢复
+
+        Args:
+            path (str): 快照文件路径（.npz）
+        """
+        with self._lock:
+            ids, vectors = self.all_vectors()
+            rows = [self.rows[shot_id] for shot_id in ids]
+            high_water = self.high_water
+        np.savez(
+            path,
+            ids=np.asarray(ids, dtype=np.int64),
+            vectors=vectors.astype(np.float32),
+            rows=np.array(json.dumps(rows, ensure_ascii=False, default=str)),
+            high_water=np.int64(high_water)
+        )
+        print(f"向量索引快照已保存到 {path}，共 {len(ids)} 个分镜")
+
+    def load_snapshot(self, path: str):
+        """从快照恢复索引"""
+        data = np.load(path)
+        rows = json.loads(data["rows"].item())
+        for row, vector in zip(rows, data["vectors"]):
+            row["content_vector"] = vector
+        self.upsert_rows(rows)
+        # 没有高水位的旧快照以其中最大的 shot_id 为准
+        if "high_water" in data.files:
+            self.high_water = int(data["high_water"])
+        else:
+            self.high_water = int(data["ids"].max()) if len(data["ids"]) else 0
+        self._after_load()
+        self.loaded_at = time.time()
+        print(f"已从快照 {path} 加载 {len(rows)} 个分镜，高水位 shot_id {self.high_water}")
+
+    def load_from_supabase(self, supabase_client, page_size: int = 1000):
+        """分页读取 video_storyboard 的全部分镜构建索引"""
+        columns = ",".join(STORYBOARD_COLUMNS + ["content_vector"])
+        total = 0
+        for page in iter_storyboard_pages(supabase_client, columns, 0, page_size):
+            self.upsert_rows(page)
+            total += len(page)
+            self.high_water = max(self.high_water, page[-1]["shot_id"])
+        self.refresh_deleted_materials(supabase_client)
+        self._after_load()
+        self.loaded_at = time.time()
+        print(f"已从数据库加载 {total} 个分镜到向量索引")
+
+    def catch_up(self, supabase_client, page_size: int = 1000) -> int:
+        """
+        从快照加载后补齐数据库中之后的变化，返回变化的分镜数：
+        1. shot_id 大于高水位的分镜是快照之后写入的（replace_storyboard / publish_storyboard 总是插入新行），
+           涉及的素材整体替换为这些分镜
+        2. 只读取 shot_id 列，删除数据库中已经不存在的分镜（clear_storyboard、重新分析后没有镜头）
+        注意：重新生成向量（reembed_helper）原地更新 content_vector，shot_id 不变，无法由此发现，要等全量重建
+
+        Args:
+            supabase_client (supabase.Client): Supabase 客户端
+            page_size (int, optional): 每页读取的分镜数
+
+        Returns:
+            int: 新增和删除的分镜数
+        """
+        columns = ",".join(STORYBOARD_COLUMNS + ["content_vector"])
+        new_rows = [row for page in iter_storyboard_pages(supabase_client, columns, self.high_water, page_size)
+                    for row in page]
+        live_ids = {row["shot_id"] for page in iter_storyboard_pages(supabase_client, "shot_id", 0, page_size)
+                    for row in page}
+
+        by_material = {}
+        for row in new_rows:
+            by_material.setdefault(row["material_id"], []).append(row)
+        with self._lock:
+            for material_id, rows in by_material.items():
+                self.replace_material(material_id, rows)
+            stale = [shot_id for shot_id in self.rows if shot_id not in live_ids]
+            self.remove_shots(stale)
+            if new_rows:
+                self.high_water = max(self.high_water, max(row["shot_id"] for row in new_rows))
+        self.refresh_deleted_materials(supabase_client)
+        print(f"向量索引已补齐快照之后的变化：新增 {len(new_rows)} 个分镜，删除 {len(stale)} 个分镜")
+        return len(new_rows) + len(stale)
+
+    def _after_load(self):
+        """全量加载（快照或数据库）完成后调用"""
+
+    def _add_vectors(self, shot_ids: list, vectors: np.ndarray):
+        raise NotImplementedError
+
+    def _remove_vectors(self, shot_ids: list):
+        raise NotImplementedError
+
+    def _search(self, query: np.ndarray, limit: int) -> list:
+        raise NotImplementedError
+
+
+# 暴力检索：归一化向量矩阵与查询向量做一次矩阵乘法，适合小规模语料
+# 删除的行只做标记，新行优先复用空闲行，容量不足时成倍扩容
+class BruteForceVectorIndex(StoryboardVectorIndex):
+    def __init__(self, dim: int = 1536, initial_capacity: int = 1024):
+        super().__init__(dim)
+        self._matrix = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._slot_ids = np.full(initial_capacity, -1, dtype=np.int64)
+        self._slots = {}
+        self._free = list(range(initial_capacity - 1, -1, -1))
+
+    def all_vectors(self):
+        ids = list(self._slots.keys())
+        slots = [self._slots[shot_id] for shot_id in ids]
+        return ids, self._matrix[slots]
+
+    def _add_vectors(self, shot_ids: list, vectors: np.ndarray):
+        for shot_id, vector in zip(shot_ids, vectors):
+            slot = self._slots.get(shot_id)
+            if slot is None:
+                if not self._free:
+                    self._grow()
+                slot = self._free.pop()
+                self._slots[shot_id] = slot
+                self._slot_ids[slot] = shot_id
+            self._matrix[slot] = vector
+
+    def _remove_vectors(self, shot_ids: list):
+        for shot_id in shot_ids:
+            slot = self._slots.pop(shot_id, None)
+            if slot is not None:
+                self._slot_ids[slot] = -1
+                self._matrix[slot] = 0
+                self._free.append(slot)
+
+    def _grow(self):
+        capacity = len(self._slot_ids)
+        self._matrix = np.vstack([self._matrix, np.zeros((capacity, self.dim), dtype=np.float32)])
+        self._slot_ids = np.concatenate([self._slot_ids, np.full(capacity, -1, dtype=np.int64)])
+        self._free.extend(range(2 * capacity - 1, capacity - 1, -1))
+
+    def _search(self, query: np.ndarray, limit: int) -> list:
+        similarities = self._matrix @ query
+        similarities[self._slot_ids < 0] = -np.inf
+        k = min(limit, len(self._slots))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [(int(self._slot_ids[slot]), similarities[slot]) for slot in top]
+
+
+# 压缩向量 + 全精度重排：
+# - 粗排在压缩向量上进行：fp16 半精度、int8 标量量化（每行一个缩放系数）或 PCA 降维
+# - 取 limit * oversample 个候选，再用全精度向量精确重排
+# - 全精度向量可以放在磁盘上的 memmap 文件中，内存中只常驻压缩向量，重排时只读取候选行
+class QuantizedVectorIndex(BruteForceVectorIndex):
+    COMPRESSIONS = ("fp16", "int8", "pca")
+    SCORE_BLOCK_SIZE = 4096
+
+    def __init__(self, dim: int = 1536, initial_capacity: int = 1024, compression: str = "int8",
+                 oversample: int = 4, pca_dim: int = 256, full_vectors_path: str = None,
+                 pca_refit_ratio: float = 2.0, pca_fit_sample: int = 20000):
+        """
+        初始化 QuantizedVectorIndex 实例
+
+        Args:
+            dim (int): 向量维度
+            initial_capacity (int): 初始容量
+            compression (str): 压缩方式，fp16 / int8 / pca
+            oversample (int): 粗排候选数相对返回条数的倍数
+            pca_dim (int): PCA 降维后的维度
+            full_vectors_path (str, optional): 全精度向量的 memmap 文件路径，不提供时保存在内存中
+            pca_refit_ratio (float): 向量数增长到上次训练时的多少倍后重新训练 PCA，语料增长后投影不再代表整体分布
+            pca_fit_sample (int): 训练 PCA 最多使用的向量数（随机抽样），限制训练时间
+        """
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(f"compression 只支持 {self.COMPRESSIONS}")
+        self.compression = compression
+        self.oversample = oversample
+        self.pca_dim = min(pca_dim, dim)
+        self.full_vectors_path = full_vectors_path
+        # PCA 的投影矩阵 (pca_dim, dim)，向量数达到 2 * pca_dim 后才训练，训练前粗排直接使用全精度向量
+        self._components = None
+        self.pca_refit_ratio = pca_refit_ratio
+        self.pca_fit_sample = pca_fit_sample
+        # 上次训练时的向量数和投影保留的方差比例（在训练样本上计算）
+        self._fitted_size = 0
+        self.explained_variance = None
+        super().__init__(dim, initial_capacity)
+        if full_vectors_path:
+            self._matrix = self._open_full_vectors(initial_capacity)
+        self._codes, self._scales = self._allocate_codes(initial_capacity)
+
+    def memory_bytes(self) -> int:
+        """常驻内存的向量数据大小（字节），全精度向量在 memmap 中时不计入"""
+        size = self._codes.nbytes + (self._scales.nbytes if self._scales is not None else 0)
+        if self._components is not None:
+            size += self._components.nbytes
+        if not isinstance(self._matrix, np.memmap):
+            size += self._matrix.nbytes
+        return size
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats.update(compression=self.compression, memory_bytes=self.memory_bytes())
+        if self.compression == "pca":
+            stats["pca"] = {"dim": self.pca_dim, "fitted_size": self._fitted_size,
+                            "explained_variance": self.explained_variance}
+        return stats
+
+    def fit(self):
+        """用当前的全精度向量（最多随机抽取 pca_fit_sample 个）训练 PCA 投影矩阵，并重新计算所有压缩向量"""
+        slots = list(self._slots.values())
+        if not slots:
+            return
+        fit_slots = slots
+        if len(slots) > self.pca_fit_sample:
+            fit_slots = np.sort(np.random.default_rng().choice(slots, self.pca_fit_sample, replace=False))
+        sample = np.asarray(self._matrix[fit_slots])
+        # 不做中心化的 SVD，使投影后的内积尽量保持原始内积
+        _, singular_values, vt = np.linalg.svd(sample, full_matrices=False)
+        self._components = vt[:self.pca_dim].astype(np.float32)
+        energy = singular_values ** 2
+        self.explained_variance = float(energy[:self.pca_dim].sum() / energy.sum()) if energy.sum() else None
+        self._fitted_size = len(slots)
+        self._codes, _ = self._allocate_codes(len(self._slot_ids))
+        for slot in slots:
+            self._encode(slot, self._matrix[slot])
+        print(f"PCA 投影矩阵训练完成：{self.dim} 维 -> {self._components.shape[0]} 维，样本数 {len(fit_slots)}，"
+              f"保留方差 {self.explained_variance or 0:.1%}")
+
+    def _allocate_codes(self, capacity: int):
+        if self.compression == "fp16":
+            return np.zeros((capacity, self.dim), dtype=np.float16), None
+        if self.compression == "int8":
+            return np.zeros((capacity, self.dim), dtype=np.int8), np.zeros(capacity, dtype=np.float32)
+        return np.zeros((capacity, self.pca_dim), dtype=np.float32), None
+
+    def _open_full_vectors(self, capacity: int, old=None):
+        """创建（或扩容）全精度向量的 memmap 文件"""
+        matrix = np.memmap(self.full_vectors_path, dtype=np.float32, mode="w+", shape=(capacity, self.dim))
+        if old is not None:
+            matrix[:len(old)] = old
+        return matrix
+
+    def _encode(self, slot: int, vector: np.ndarray):
+        if self.compression == "fp16":
+            self._codes[slot] = vector.astype(np.float16)
+        elif self.compression == "int8":
+            scale = float(np.abs(vector).max()) / 127 or 1.0
+            self._codes[slot] = np.round(vector / scale).astype(np.int8)
+            self._scales[slot] = scale
+        elif self._components is not None:
+            self._codes[slot] = self._components @ vector
+
+    def _add_vectors(self, shot_ids: list, vectors: np.ndarray):
+        super()._add_vectors(shot_ids, vectors)
+        for shot_id, vector in zip(shot_ids, vectors):
+            self._encode(self._slots[shot_id], vector)
+        if self.compression != "pca":
+            return
+        if self._components is None:
+            if len(self._slots) >= 2 * self.pca_dim:
+                self.fit()
+        elif len(self._slots) >= self._fitted_size * self.pca_refit_ratio:
+            # 语料增长后重新训练，避免投影只代表最早的一批向量、召回率下降
+            self.fit()
+
+    def _after_load(self):
+        # 全量加载（包括后台定期重建）过程中按增长比例训练过，加载完成后用完整语料再训练一次
+        if self.compression == "pca" and len(self._slots) >= 2 * self.pca_dim and self._fitted_size < len(self._slots):
+            self.fit()
+
+    def _remove_vectors(self, shot_ids: list):
+        slots = [self._slots[shot_id] for shot_id in shot_ids if shot_id in self._slots]
+        super()._remove_vectors(shot_ids)
+        self._codes[slots] = 0
+
+    def _grow(self):
+        capacity = len(self._slot_ids)
+        super()._grow()
+        if self.full_vectors_path:
+            # super()._grow() 已把数据复制到内存中的新矩阵，再写回扩容后的 memmap 文件
+            self._matrix = self._open_full_vectors(2 * capacity, self._matrix)
+        codes, scales = self._allocate_codes(2 * capacity)
+        codes[:capacity] = self._codes
+        self._codes = codes
+        if scales is not None:
+            scales[:capacity] = self._scales
+            self._scales = scales
+
+    def _coarse_scores(self, query: np.ndarray) -> np.ndarray:
+        # numpy 没有 fp16 / int8 的 BLAS 实现，分块转换为 float32 再做矩阵乘法，避免一次性复制整个矩阵
+        if self.compression == "pca":
+            query = self._components @ query
+        scores = np.empty(len(self._codes), dtype=np.float32)
+        for start in range(0, len(self._codes), self.SCORE_BLOCK_SIZE):
+            block = self._codes[start:start + self.SCORE_BLOCK_SIZE]
+            scores[start:start + len(block)] = block.astype(np.float32, copy=False) @ query
+        if self.compression == "int8":
+            scores *= self._scales
+        return scores
+
+    def _search(self, query: np.ndarray, limit: int) -> list:
+        # PCA 训练前没有压缩向量，直接精确检索
+        if self.compression == "pca" and self._components is None:
+            return super()._search(query, limit)
+
+        scores = self._coarse_scores(query)
+        scores[self._slot_ids < 0] = -np.inf
+        k = min(limit * self.oversample, len(self._slots))
+        candidates = np.argpartition(-scores, k - 1)[:k]
+
+        # 全精度重排
+        candidates = np.sort(candidates)
+        similarities = np.asarray(self._matrix[candidates]) @ query
+        order = np.argsort(-similarities)[:limit]
+        return [(int(self._slot_ids[candidates[i]]), similarities[i]) for i in order]
+
+
+# 近似检索：基于 hnswlib 的 HNSW 图，适合大规模语料
+class HnswVectorIndex(StoryboardVectorIndex):
+    def __init__(self, dim: int = 1536, initial_capacity: int = 10000, m: int = 16,
+                 ef_construction: int = 200, ef_search: int = 100):
+        if hnswlib is None:
+            raise ImportError("HnswVectorIndex 需要安装 hnswlib: pip install hnswlib")
+        super().__init__(dim)
+        self.ef_search = ef_search
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._index.init_index(max_elements=initial_capacity, ef_construction=ef_construction, M=m,
+                               allow_replace_deleted=True)
+        # 可检索的 label
+        self._ids = set()
+        # 写入过索引的 label（包括已标记删除、位置尚未被复用的）
+        self._labels = set()
+
+    def all_vectors(self):
+        ids = list(self._ids)
+        if not ids:
+            return ids, np.zeros((0, self.dim), dtype=np.float32)
+        return ids, np.asarray(self._index.get_items(ids), dtype=np.float32)
+
+    def _add_vectors(self, shot_ids: list, vectors: np.ndarray):
+        # hnswlib 的 label 仍在索引中（包括已标记删除的）时只能原地更新：先取消删除标记，再以 replace_deleted=False 写入；
+        # replace_deleted=True 只用于新的 label，复用其它已删除元素的位置，否则 label 映射会被破坏
+        existing, new = [], []
+        for i, shot_id in enumerate(shot_ids):
+            if shot_id not in self._ids and shot_id in self._labels:
+                try:
+                    self._index.unmark_deleted(shot_id)
+                except RuntimeError:
+                    # 已删除元素的位置被其它 label 复用，该 label 已不在索引中
+                    self._labels.discard(shot_id)
+            (existing if shot_id in self._labels else new).append(i)
+
+        if existing:
+            self._index.add_items(vectors[existing], np.asarray([shot_ids[i] for i in existing], dtype=np.int64),
+                                  replace_deleted=False)
+        if new:
+            needed = self._index.get_current_count() + len(new)
+            if needed > self._index.get_max_elements():
+                self._index.resize_index(max(needed, 2 * self._index.get_max_elements()))
+            self._index.add_items(vectors[new], np.asarray([shot_ids[i] for i in new], dtype=np.int64),
+                                  replace_deleted=True)
+        self._ids.update(shot_ids)
+        self._labels.update(shot_ids)
+
+    def _remove_vectors(self, shot_ids: list):
+        for shot_id in shot_ids:
+            if shot_id in self._ids:
+                self._index.mark_deleted(shot_id)
+                self._ids.discard(shot_id)
+
+    def _search(self, query: np.ndarray, limit: int) -> list:
+        k = min(limit, len(self._ids))
+        self._index.set_ef(max(self.ef_search, k))
+        labels, distances = self._index.knn_query(query, k=k)
+        # cosine 空间的距离为 1 - 余弦相似度
+        return [(int(label), 1 - float(distance)) for label, distance in zip(labels[0], distances[0])]
+
+
+def iter_storyboard_pages(supabase_client, columns: str, after_shot_id: int = 0, page_size: int = 1000):
+    """按 shot_id 升序分页读取 video_storyboard 中 shot_id 大于 after_shot_id 的分镜，每次返回一页"""
+    while True:
+        response = (
+            supabase_client.table("video_storyboard")
+            .select(columns)
+            .gt("shot_id", after_shot_id)
+            .order("shot_id")
+            .limit(page_size)
+            .execute()
+        )
+        if not response.data:
+            return
+        yield response.data
+        after_shot_id = response.data[-1]["shot_id"]
+
+
+def select_search_index(vector_index, filters):
+    """
+    选择语义搜索使用的进程内索引：没有开启、带过滤条件（由数据库过滤素材属性），
+    或已删除素材列表没有及时刷新（结果可能包含已删除素材）时返回 None，由数据库检索
+
+    Args:
+        vector_index (StoryboardVectorIndex): 进程内索引，可以为 None
+        filters (dict): 规范化后的过滤条件
+
+    Returns:
+        StoryboardVectorIndex: 可以使用的索引，或 None
+    """
+    if vector_index is None or filters is not None or not vector_index.filters_deleted():
+        return None
+    return vector_index
+
+
+def create_vector_index(expected_size: int = 0, dim: int = 1536) -> StoryboardVectorIndex:
+    """
+    选择索引实现：
+    - 设置了 VECTOR_INDEX_COMPRESSION（fp16 / int8 / pca）时使用压缩向量 + 全精度重排
+    - 否则超过 VECTOR_INDEX_HNSW_THRESHOLD（默认 50000）且安装了 hnswlib 时使用 HNSW，其余情况暴力检索
+
+    环境变量:
+        VECTOR_INDEX_OVERSAMPLE: 压缩检索粗排候选数的倍数，默认 4
+        VECTOR_INDEX_PCA_DIM: PCA 降维后的维度，默认 256
+        VECTOR_INDEX_FULL_VECTORS_PATH: 全精度向量的 memmap 文件路径，不设置时保存在内存中
+        VECTOR_INDEX_PCA_REFIT_RATIO: 向量数增长到上次训练时的多少倍后重新训练 PCA，默认 2
+        VECTOR_INDEX_PCA_FIT_SAMPLE: 训练 PCA 最多使用的向量数，默认 20000
+
+    Args:
+        expected_size (int): 预计的分镜数量
+        dim (int): 向量维度
+
+    Returns:
+        StoryboardVectorIndex: 索引实例
+    """
+    compression = os.environ.get("VECTOR_INDEX_COMPRESSION")
+    if compression:
+        return QuantizedVectorIndex(
+            dim=dim,
+            initial_capacity=max(expected_size, 1024),
+            compression=compression,
+            oversample=int(os.environ.get("VECTOR_INDEX_OVERSAMPLE", 4)),
+            pca_dim=int(os.environ.get("VECTOR_INDEX_PCA_DIM", 256)),
+            full_vectors_path=os.environ.get("VECTOR_INDEX_FULL_VECTORS_PATH"),
+            pca_refit_ratio=float(os.environ.get("VECTOR_INDEX_PCA_REFIT_RATIO", 2.0)),
+            pca_fit_sample=int(os.environ.get("VECTOR_INDEX_PCA_FIT_SAMPLE", 20000))
+        )
+    threshold = int(os.environ.get("VECTOR_INDEX_HNSW_THRESHOLD", 50000))
+    if expected_size >= threshold:
+        if hnswlib is not None:
+            return HnswVectorIndex(dim=dim, initial_capacity=max(expected_size, 10000))
+        print(f"警告：分镜数 {expected_size} 已达到 VECTOR_INDEX_HNSW_THRESHOLD={threshold}，但没有安装 hnswlib，"
+              f"改用暴力检索，每次检索的耗时随分镜数线性增长；请安装 hnswlib（见 requirements.txt）")
+    return BruteForceVectorIndex(dim=dim, initial_capacity=max(expected_size, 1024))
+
+
+_default_vector_index = None
+_default_vector_index_lock = threading.Lock()
+# 最近一次传入的 Supabase 客户端：ClientRegistry 重建处理器时新处理器会传入新客户端，后台线程每次使用时读取
+_supabase_client = None
+_warm_up_started = False
+
+# 定期全量重建的默认间隔（秒）。不重建时其它实例的写入永远不会出现在本实例的检索结果中
+DEFAULT_RELOAD_INTERVAL = 300
+
+
+def get_default_vector_index(supabase_client=None):
+    """
+    获取进程内共享的向量索引，未开启或尚未加载完成时返回 None（语义搜索使用数据库）
+    首次传入 supabase_client 时在后台线程中加载，不阻塞调用方；加载完成后启动定期重建和已删除素材列表的刷新
+
+    环境变量:
+        VECTOR_INDEX_ENABLED: 设置为 true 时开启进程内向量索引
+        VECTOR_INDEX_SNAPSHOT: 快照文件路径，存在时从快照加载并从数据库补齐之后的变化，否则从数据库加载后写入该路径
+        VECTOR_INDEX_EXPECTED_SIZE: 预计的分镜数量，用于选择索引实现
+        VECTOR_INDEX_RELOAD_INTERVAL: 定期从数据库全量重建的间隔（秒），用于同步其它实例的写入，默认 300；
+            设为 0 时不重建，只适用于单实例部署
+        VECTOR_INDEX_DELETED_REFRESH_INTERVAL: 刷新已删除素材列表的间隔（秒），默认 30
+
+    Args:
+        supabase_client (supabase.Client, optional): 用于加载和后台刷新的客户端，每次传入时替换之前的客户端
+
+    Returns:
+        StoryboardVectorIndex: 索引实例
+    """
+    global _supabase_client, _warm_up_started
+    if os.environ.get("VECTOR_INDEX_ENABLED", "false").lower() != "true":
+        return None
+    with _default_vector_index_lock:
+        if supabase_client is not None:
+            _supabase_client = supabase_client
+            if not _warm_up_started:
+                _warm_up_started = True
+                threading.Thread(target=_warm_up, name="vector-index-warm-up", daemon=True).start()
+        return _default_vector_index
+
+
+def _warm_up():
+    """后台线程：加载共享索引，成功后启动定期重建和已删除素材列表的刷新；失败时下次传入客户端再加载"""
+    global _default_vector_index, _warm_up_started
+    try:
+        index = load_vector_index(_supabase_client)
+    except Exception as e:
+        print(f"向量索引加载失败，语义搜索使用数据库: {e}")
+        with _default_vector_index_lock:
+            _warm_up_started = False
+        return
+    with _default_vector_index_lock:
+        _default_vector_index = index
+
+    reload_interval = float(os.environ.get("VECTOR_INDEX_RELOAD_INTERVAL", DEFAULT_RELOAD_INTERVAL))
+    if reload_interval > 0:
+        threading.Thread(
+            target=_reload_periodically,
+            args=(reload_interval,),
+            name="vector-index-reload",
+            daemon=True
+        ).start()
+    else:
+        print("警告：VECTOR_INDEX_RELOAD_INTERVAL=0，进程内向量索引不会同步其它实例的写入，检索结果可能与 match_videos 不一致")
+    threading.Thread(
+        target=_refresh_deleted_periodically,
+        args=(DELETED_REFRESH_INTERVAL,),
+        name="vector-index-deleted-refresh",
+        daemon=True
+    ).start()
+
+
+def load_vector_index(supabase_client) -> StoryboardVectorIndex:
+    """优先从快照加载索引，没有快照时从数据库加载并保存快照"""
+    index = create_vector_index(int(os.environ.get("VECTOR_INDEX_EXPECTED_SIZE", 0)))
+    snapshot = os.environ.get("VECTOR_INDEX_SNAPSHOT")
+    if snapshot and os.path.exists(snapshot):
+        index.load_snapshot(snapshot)
+        # 快照可能落后于数据库（其它实例的写入、快照保存后的处理），补齐后更新快照
+        if index.catch_up(supabase_client):
+            index.save(snapshot)
+    else:
+        index.load_from_supabase(supabase_client)
+        # 加载期间共享索引还不可用，本实例的写入没有记录到索引中，从数据库补齐
+        index.catch_up(supabase_client)
+        if snapshot:
+            index.save(snapshot)
+    return index
+
+
+def rebuild_default_vector_index(supabase_client) -> bool:
+    """
+    从数据库重建共享索引后整体替换，重建期间旧索引继续提供检索。
+    重建读取开始之后本实例的写入记录在旧索引中，替换前在新索引上重放，不会丢失；替换后更新快照
+
+    Args:
+        supabase_client (supabase.Client): 用于读取分镜
+
+    Returns:
+        bool: 是否重建成功，共享索引尚未创建或重建失败时返回 False
+    """
+    global _default_vector_index
+    current = _default_vector_index
+    if current is None:
+        return False
+    current.start_journal()
+    try:
+        index = create_vector_index(len(current))
+        index.load_from_supabase(supabase_client)
+    except Exception as e:
+        current.stop_journal()
+        print(f"向量索引重建失败: {e}")
+        return False
+    with _default_vector_index_lock:
+        current.hand_over(index)
+        _default_vector_index = index
+    snapshot = os.environ.get("VECTOR_INDEX_SNAPSHOT")
+    if snapshot:
+        try:
+            index.save(snapshot)
+        except Exception as e:
+            print(f"保存向量索引快照失败: {e}")
+    return True
+
+
+def _reload_periodically(interval: float):
+    """后台线程：定期调用 rebuild_default_vector_index 重建共享索引，同步其它实例的写入"""
+    while True:
+        time.sleep(interval)
+        rebuild_default_vector_index(_supabase_client)
+
+
+def _refresh_deleted_periodically(interval: float):
+    """后台线程：定期刷新共享索引的已删除素材列表，刷新失败超过 3 倍间隔后语义搜索改用数据库"""
+    while True:
+        time.sleep(interval)
+        try:
+            _default_vector_index.refresh_deleted_materials(_supabase_client)
+        except Exception as e:
+            print(f"刷新已删除素材列表失败: {e}")